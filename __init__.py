@@ -6,6 +6,7 @@
 
 from __future__ import absolute_import
 
+import bson
 import colorama
 import datetime
 import glob
@@ -14,6 +15,7 @@ import logging
 import netifaces
 import os
 import pymongo
+import pymongo.errors
 import signal
 import socket
 import sys
@@ -26,6 +28,18 @@ from master.models import *
 from master.models import Master as MasterModel
 from master.lib.mongo_oplog_watcher import OplogWatcher, OplogPrinter
 from master.lib.amqp_man import AmqpManager
+from master.lib.dispatch import Dispatcher
+from master.lib.job_aggregates import JobAggregates
+from master.lib.job_cache import JobCache
+from master.lib.job_log import JobLogStore
+from master.lib.oplog_capture import OplogRecorder
+from master.lib.scheduler import Scheduler
+from master.lib.webhook_delivery import WebhookDelivery
+from master.lib.webhook_registry import WebhookRegistry
+import master.lib.slaves as slaves
+from master.lib.metrics import Timings
+import master.lib.echo as echo
+import master.lib.transitions as transitions
 import master.watchers
 
 logging.basicConfig(
@@ -97,6 +111,14 @@ def _install_sig_handlers():
 class TalusDBWatcher(OplogWatcher):
     """A class to watch the mongodb for changes"""
 
+    # seconds to wait before re-querying the oplog when the tailable
+    # cursor has died or the connection was lost
+    POLL_TIME = 1.0
+
+    # how often (in seconds) the oplog position is saved
+    CHECKPOINT_INTERVAL = 5.0
+    CHECKPOINT_ID = "master"
+
     def __init__(self, parent_log=None, *args, **kwargs):
         """docstring for TalusDBWatcher constructor
         
@@ -105,22 +127,72 @@ class TalusDBWatcher(OplogWatcher):
         """
         OplogWatcher.__init__(self, *args, **kwargs)
 
-        # { <mod_name>: [watchers], ... }
-        self._watchers = {}
+        self._connection = kwargs["connection"]
+        self._oplog = self._connection.local["oplog.rs"]
+        self._checkpoints = self._connection.talus["oplog_checkpoint"]
+        self._last_checkpoint = time.time()
+        self._filter_changed = threading.Event()
 
         if parent_log is None:
             self._log = logging.getLogger("DB-WATCH")
         else:
             self._log = parent_log.getChild("DB-WATCH")
 
+        # events are watched from the last saved checkpoint if it's still
+        # in the oplog, else from the moment the watcher is created, even
+        # though it isn't started until all watchers have been added
+        self.resumed = False
+        self._start_ts = self._load_checkpoint()
+        if self._start_ts is None:
+            self._start_ts = self._latest_ts()
+        else:
+            self.resumed = True
+
+        # { <mod_name>: [watchers], ... }
+        self._watchers = {}
+
+        # watchers are called from the dispatcher's worker threads, never
+        # from the thread tailing the oplog. Events spilled before the last
+        # shutdown are read from the oplog again when resuming.
+        self._dispatcher = Dispatcher(parent_log=self._log, resume_spilled=not self.resumed)
+
+        self._recorder = None
+
     def run(self):
         self._log.info("running")
-        super(TalusDBWatcher, self).run()
+        self._running.set()
+        self.start_dispatching()
+        self._dispatcher.watermark.seen(self._start_ts)
+        self._tail_oplog(self._start_ts)
+
+        self.stop_dispatching()
+        self._save_checkpoint()
+
+    def start_dispatching(self):
+        """Start the workers that call into the watchers. This is done by
+        :any:`run`, and only needs to be called directly when events are
+        fed to :any:`insert`, :any:`update`, and :any:`delete` by hand (e.g.
+        when replaying a capture).
+        """
+        self._dispatcher.start()
+
+    def stop_dispatching(self):
+        """Wait for the watchers to handle everything that has been queued,
+        then stop them
+        """
+        self._dispatcher.stop()
 
         for collection, watchers in self._watchers.iteritems():
             for watcher in watchers:
                 watcher.stop()
 
+        if self._recorder is not None:
+            self._recorder.close()
+            self._log.info("recorded {} oplog events to {}".format(
+                self._recorder.count,
+                self._recorder.path,
+            ))
+
     def stop(self):
         """Stop the database watcher
         :returns: TODO
@@ -131,6 +203,120 @@ class TalusDBWatcher(OplogWatcher):
 
     def add_watcher(self, collection, watcher):
         self._watchers.setdefault(collection, []).append(watcher)
+        self._dispatcher.add_watcher(collection, watcher)
+        self._filter_changed.set()
+
+    def stats(self):
+        """Return the queue depth and lag of every watcher's dispatch
+        partitions
+        """
+        return self._dispatcher.stats()
+
+    def record_to(self, path):
+        """Record every event seen in the oplog to the capture file at
+        ``path``. See :any:`master.lib.oplog_capture`.
+        """
+        self._log.info("recording oplog events to {}".format(path))
+        self._recorder = OplogRecorder(path)
+
+    def _load_checkpoint(self):
+        """Return the saved oplog checkpoint if every entry after it is still
+        in the oplog, else None.
+        """
+        checkpoint = self._checkpoints.find_one({"_id": self.CHECKPOINT_ID})
+        if checkpoint is None:
+            self._log.info("no oplog checkpoint found")
+            return None
+
+        oldest = list(self._oplog.find().sort("$natural", pymongo.ASCENDING).limit(1))
+        if len(oldest) == 0 or oldest[0]["ts"] > checkpoint["ts"]:
+            self._log.warn("oplog checkpoint {} is no longer in the oplog".format(checkpoint["ts"]))
+            return None
+
+        self._log.info("resuming from oplog checkpoint {}".format(checkpoint["ts"]))
+        return checkpoint["ts"]
+
+    def _save_checkpoint(self):
+        """Save the newest oplog timestamp that it and every entry before it
+        have been handled
+        """
+        self._last_checkpoint = time.time()
+
+        ts = self._dispatcher.watermark.safe_ts()
+        if ts is None:
+            return
+
+        try:
+            self._checkpoints.update(
+                {"_id": self.CHECKPOINT_ID},
+                {"$set": {"ts": ts, "saved": datetime.datetime.utcnow()}},
+                upsert=True
+            )
+        except pymongo.errors.PyMongoError as e:
+            self._log.warn("could not save oplog checkpoint: {}".format(e))
+
+    def _latest_ts(self):
+        """Return the timestamp of the newest entry in the oplog
+        """
+        newest = list(self._oplog.find().sort("$natural", pymongo.DESCENDING).limit(1))
+        if len(newest) == 0:
+            return bson.timestamp.Timestamp(0, 0)
+        return newest[0]["ts"]
+
+    def _tail_oplog(self, ts):
+        """Tail the oplog, handling every entry newer than ``ts`` that the
+        watchers are subscribed to. Returns once the watcher is stopped.
+        """
+        while self._running.is_set():
+            self._filter_changed.clear()
+            query = self._dispatcher.oplog_filter()
+            query["ts"] = {"$gt": ts}
+
+            try:
+                cursor = self._oplog.find(
+                    query,
+                    tailable    = True,
+                    await_data  = True,
+                    oplog_replay= True,
+                )
+                while self._running.is_set() and cursor.alive and not self._filter_changed.is_set():
+                    for entry in cursor:
+                        ts = entry["ts"]
+                        self._handle_entry(entry)
+                        self._dispatcher.watermark.seen(ts)
+
+                        if time.time() - self._last_checkpoint > self.CHECKPOINT_INTERVAL:
+                            self._save_checkpoint()
+                        if not self._running.is_set():
+                            break
+
+                    if time.time() - self._last_checkpoint > self.CHECKPOINT_INTERVAL:
+                        self._save_checkpoint()
+
+            except pymongo.errors.AutoReconnect as e:
+                self._log.warn("lost connection to the oplog, retrying: {}".format(e))
+
+            if self._running.is_set() and not self._filter_changed.is_set():
+                time.sleep(self.POLL_TIME)
+
+    def _handle_entry(self, entry):
+        """Hand a single oplog entry to the insert/update/delete handlers
+        """
+        op = entry["op"]
+
+        if self._recorder is not None and op in ["i", "u", "d"]:
+            if op == "u":
+                id_ = entry["o2"].get("_id")
+            else:
+                id_ = entry["o"].get("_id")
+            self._recorder.record(entry["ns"], entry["ts"], op, id_, entry["o"] if op != "d" else None)
+
+        if op == "i":
+            self.insert(ns=entry["ns"], ts=entry["ts"], id=entry["o"].get("_id"), obj=entry["o"], raw=entry)
+        elif op == "u":
+            self.update(ns=entry["ns"], ts=entry["ts"], id=entry["o2"].get("_id"), mod=entry["o"], raw=entry)
+        elif op == "d":
+            self.delete(ns=entry["ns"], ts=entry["ts"], id=entry["o"].get("_id"), raw=entry)
 
     def insert(self, ns, ts, id, obj, raw, **kwargs):
         """Handle new insertions into the database
@@ -147,9 +333,7 @@ class TalusDBWatcher(OplogWatcher):
         self._log.info("watched insert in {}: {}".format(ns, id))
         # self._log.debug("received insert: {}".format(obj))
 
-        if ns in self._watchers:
-            for watcher in self._watchers[ns]:
-                watcher.insert(id, obj)
+        self._dispatcher.dispatch(ns, "insert", id, obj, ts=ts)
 
     def update(self, ns, ts, id, mod, raw, **kwargs):
         """Handle new updates in the database
@@ -166,9 +350,11 @@ class TalusDBWatcher(OplogWatcher):
         # self._log.info("update for {}:{}".format(ns, id))
         ##self._log.debug("modification: {}".format(mod))
 
-        if ns in self._watchers:
-            for watcher in self._watchers[ns]:
-                watcher.update(id, mod)
+        # the master's own writes don't need to be handled again
+        if echo.is_echo(ns, id, mod):
+            return
+
+        self._dispatcher.dispatch(ns, "update", id, mod, ts=ts)
 
     def delete(self, ns, ts, id, raw, **kwargs):
         """Handle new deletions in the database
@@ -183,9 +369,7 @@ class TalusDBWatcher(OplogWatcher):
         """
         self._log.info("watched delete in {}: {}".format(ns, id))
 
-        if ns in self._watchers:
-            for watcher in self._watchers[ns]:
-                watcher.delete(id)
+        self._dispatcher.dispatch(ns, "delete", id, ts=ts)
 
 
 MASTER_INTF = None
@@ -199,6 +383,17 @@ class Master(object):
     AMQP_SLAVE_QUEUE = "slaves"
     AMQP_SLAVE_STATUS_QUEUE = "slave_status"
 
+    # how often (in seconds) runtime stats are saved to the master document
+    STATS_INTERVAL = 10
+
+    # the number of unacknowledged slave status messages the broker will send
+    # the master, can be overridden with TALUS_SLAVE_STATUS_PREFETCH
+    STATUS_PREFETCH = 500
+    # the most slave status messages that are handled (and written to the db)
+    # together, and how long (in seconds) to wait for a batch to fill up
+    STATUS_BATCH_SIZE = 200
+    STATUS_BATCH_WAIT = 0.05
+
     # -------------------------
     # class methods
     # -------------------------
@@ -231,6 +426,19 @@ class Master(object):
         self._running = threading.Event()
         self._watcher = None
         self._amqp_man = AmqpManager.instance()
+        self._slaves = slaves.SlaveRegistry(parent_log=self._log)
+        self._scheduler = Scheduler.instance()
+        self._scheduler.attach(self._slaves)
+        self._webhooks = WebhookDelivery.instance()
+        self._job_logs = JobLogStore.instance()
+        self._job_aggregates = JobAggregates.instance()
+
+        self._status_prefetch = int(os.environ.get("TALUS_SLAVE_STATUS_PREFETCH", self.STATUS_PREFETCH))
+        # [(<method>, <props>, <body>), ...], only touched from amqp callbacks
+        self._status_batch = []
+        self._status_timeout = None
+        self._status_batch_time = Timings()
+        self._status_stats = dict(messages=0, batches=0, errors=0, unflushed=0, bson=0, resyncs=0)
 
         self._intf = intf
         # TODO need a better way than just eth0
@@ -260,15 +468,16 @@ class Master(object):
         """
         self._log.info("running")
         self._running.set()
-        self._start_watcher()
-        self._log.info("started watcher")
-
-        self._amqp_man.do_start()
-        self._amqp_listen_for_slaves()
+        self._start_services()
 
         # stupid GIL
         while self._watcher.is_alive():
-            self._watcher.join(2 ** 32)
+            self._watcher.join(self.STATS_INTERVAL)
+            # the master keeps running if its stats can't be saved
+            try:
+                self.update_status(stats=self._collect_stats())
+            except Exception:
+                self._log.exception("error updating the master's status")
 
         self._shutdown_singletons()
 
@@ -297,7 +506,7 @@ class Master(object):
     # private functions
     # -------------------------
 
-    def update_status(self, queues=None, vms=None):
+    def update_status(self, queues=None, vms=None, stats=None):
         """Update the master document in mongodb
         """
         with self._master_obj_lock:
@@ -305,9 +514,27 @@ class Master(object):
                 self._master_obj.queues = queues
             if vms is not None:
                 self._master_obj.vms = vms
+            if stats is not None:
+                self._master_obj.stats = stats
 
             self._master_obj.save()
 
+    def _collect_stats(self):
+        """Collect runtime stats from the master's subsystems
+        """
+        return dict(
+            dispatch=self._watcher.stats(),
+            echo=echo.stats(),
+            slaves=self._slaves.stats(),
+            scheduler=self._scheduler.stats(),
+            webhooks=self._webhooks.stats(),
+            job_cache=JobCache.instance().stats(),
+            job_log=self._job_logs.stats(),
+            job_aggregates=self._job_aggregates.stats(),
+            transitions=transitions.stats(),
+            slave_status=dict(self._status_stats, batch_time=self._status_batch_time.stats()),
+        )
+
     def _amqp_listen_for_slaves(self):
         """Setup amqp queues to listen/respond to slaves
         """
@@ -325,16 +552,72 @@ class Master(object):
                                      auto_delete=False,
                                      exclusive=False
                                      )
+        # the prefetch limit must be in place before the broker starts
+        # pushing the backlog of status messages. The master only consumes
+        # this one queue, so limiting the whole channel is fine.
+        self._amqp_man.set_prefetch(self._status_prefetch)
         self._amqp_man.consume_queue(self.AMQP_SLAVE_STATUS_QUEUE, self._on_slave_status)
 
     def _on_slave_status(self, channel, method, props, body):
         """Slaves will respond to commands/queries via this queue. Slaves
         will also send an initial connection message via this queue
-        in order to get configuration details and report basic stats
+        in order to get configuration details and report basic stats.
+
+        Messages are handled in batches of up to ``STATUS_BATCH_SIZE``, or
+        whatever arrived within ``STATUS_BATCH_WAIT`` seconds. Each batch is
+        written to the db in one bulk write and acknowledged at once.
         """
-        self._amqp_man.ack_method(method)
+        self._status_batch.append((method, props, body))
+
+        if len(self._status_batch) >= min(self.STATUS_BATCH_SIZE, self._status_prefetch):
+            if self._status_timeout is not None:
+                channel.connection.remove_timeout(self._status_timeout)
+            self._flush_status_batch(channel)
+        elif self._status_timeout is None:
+            self._status_timeout = channel.connection.add_timeout(
+                self.STATUS_BATCH_WAIT,
+                lambda: self._flush_status_batch(channel)
+            )
+
+    def _flush_status_batch(self, channel):
+        """Handle every message in the current batch of slave status
+        messages, write the changes to the db, and acknowledge the batch
+        """
+        batch = self._status_batch
+        self._status_batch = []
+        self._status_timeout = None
+        if len(batch) == 0:
+            return
+
+        start = time.time()
+        for method, props, body in batch:
+            try:
+                self._handle_slave_msg(props, body)
+            except Exception:
+                self._status_stats["errors"] += 1
+                self._log.exception("error handling slave message")
+
+        # the batch is acknowledged even if the write fails: the registry
+        # keeps the changes dirty and writes them on its next flush.
+        # Requeueing would only hand the same messages straight back while
+        # the db is down, and handle the new slave messages twice.
+        if not self._slaves.flush():
+            self._status_stats["unflushed"] += len(batch)
+        channel.basic_ack(delivery_tag=batch[-1][0].delivery_tag, multiple=True)
+
+        self._status_stats["messages"] += len(batch)
+        self._status_stats["batches"] += 1
+        self._status_batch_time.add(time.time() - start)
+
+    def _handle_slave_msg(self, props, body):
+        """Handle a single message from the slave status queue
+        """
+        if props is not None and props.content_type == "application/bson":
+            data = bson.BSON(body).decode()
+            self._status_stats["bson"] += 1
+        else:
+            data = json.loads(body)
 
-        data = json.loads(body)
         switch = dict(
             new=self._handle_slave_new,
             status=self._handle_slave_status,
@@ -347,38 +630,35 @@ class Master(object):
             switch[data["type"]](data)
 
     def _handle_slave_status(self, data):
-        """Handle slave status messages"""
+        """Handle slave status messages. Status messages with a ``seq``
+        number are either full (``"full": true``) or only contain the fields
+        that changed since the previous one (see :any:`master.lib.slaves`).
+        If a delta is missing, the slave is sent a ``resync`` message to
+        make it send a full status.
+        """
         if "uuid" not in data:
             self._log.warn("got a slave status message that does not include a uuid")
             self._log.debug(data)
             return
 
         uuid = data["uuid"]
+        hostname = data.setdefault("hostname", "")
         # self._log.info("got slave status update message")
 
-        slaves = Slave.objects(hostname=data.setdefault("hostname", ""), uuid=uuid)
-        if len(slaves) == 0:
+        # the registry writes the changes to the db in the background
+        result = self._slaves.update(uuid, hostname, data)
+        if result == slaves.UNKNOWN:
             self._log.warn("got a slave status for a slave that isn't defined yet, making a new one")
             self._handle_slave_new(data)
-            return
-        else:
-            slave = slaves[0]
-
-        attrs = [
-            "running_vms",
-            "total_jobs_run",
-            "vms",
-            "used_cpus",
-            "used_ram",
-            "max_cpus",
-            "max_ram",
-        ]
-        for attr in attrs:
-            if attr in data:
-                setattr(slave, attr, data[attr])
-
-        slave.timestamps["modified"] = time.time()
-        slave.save()
+            result = self._slaves.update(uuid, hostname, data)
+
+        if result == slaves.GAP and self._slaves.resync_due(uuid):
+            self._log.info("missed status updates from slave {}, requesting a resync".format(uuid))
+            self._status_stats["resyncs"] += 1
+            self._amqp_man.queue_msg(
+                json.dumps(dict(type="resync")),
+                self.AMQP_SLAVE_QUEUE + "_" + uuid
+            )
 
     def _handle_slave_new(self, data):
         """Handle new slave messages"""
@@ -399,6 +679,7 @@ class Master(object):
         slave.uuid = data["uuid"]
         slave.timestamps["created"] = datetime.datetime.utcnow()
         slave.save()
+        self._slaves.add(slave)
 
         self._amqp_man.queue_msg(
             json.dumps(dict(
@@ -418,12 +699,40 @@ class Master(object):
 
     def _handle_slave_heartbeat(self, data):
         """Handle slave heartbeats"""
-        self._log.info("handling slave heartbeat: {}".format(data))
+        if not self._slaves.heartbeat(data.get("uuid", None)):
+            self._log.debug("got a heartbeat from an unknown slave: {}".format(data))
 
     def _shutdown_singletons(self):
         self._log.info("shutting down singletons")
+        self._scheduler.stop()
+        self._webhooks.stop()
+        self._job_logs.stop()
+        self._job_aggregates.stop()
+        self._slaves.stop()
         AmqpManager.instance().stop()
 
+    def _start_services(self):
+        """Load the master's state and start the watcher and the background
+        services
+        """
+        # before the watcher, which keeps it current from then on
+        WebhookRegistry.instance().load()
+        # before the watchers' startup(), which resubmits the running jobs
+        # to the scheduler. The work units the slaves report as running
+        # must be known by then, or they would be placed again.
+        self._slaves.load()
+        self._start_watcher()
+        self._log.info("started watcher")
+
+        self._slaves.start()
+        self._scheduler.start()
+        self._webhooks.start()
+        self._job_logs.start()
+        self._job_aggregates.start()
+
+        self._amqp_man.do_start()
+        self._amqp_listen_for_slaves()
+
     def _start_watcher(self):
         """Create and start the DB watcher
         :returns: TODO
@@ -433,24 +742,53 @@ class Master(object):
             parent_log=self._log,
             connection=pymongo.MongoClient(self._db_conn_info.split(":")[0], 27017)
         )
+
+        record_path = os.environ.get("TALUS_OPLOG_RECORD", None)
+        if record_path is not None:
+            self._watcher.record_to(record_path)
+
+        watchers = load_watchers(self._log)
+        for watcher in watchers:
+            self._watcher.add_watcher(watcher.collection, watcher)
+
+        for watcher in watchers:
+            watcher.startup()
+
+        # anything that happened while the master was down will be replayed
+        # from the oplog, unless the checkpoint has already fallen off of it
+        if not self._watcher.resumed:
+            for watcher in watchers:
+                self._log.info("catching up {}".format(watcher.__class__.__name__))
+                watcher.catch_up()
+
+        # the oplog query is built from the subscriptions of the watchers,
+        # so only start once they've all been added
         self._watcher.start()
 
-        # import all of the DB watchers defined in master/watchers/
-        for filename in glob.glob(os.path.join(os.path.dirname(__file__), "watchers", "*.py")):
-            if os.path.basename(filename) == "__init__.py":
+
+def load_watchers(parent_log):
+    """Import and create all of the DB watchers defined in master/watchers/
+
+    :parent_log: The parent logger of the watchers
+    :returns: A list of the watcher instances
+    """
+    watchers = []
+    for filename in glob.glob(os.path.join(os.path.dirname(__file__), "watchers", "*.py")):
+        if os.path.basename(filename) == "__init__.py":
+            continue
+
+        mod_name = os.path.basename(filename).replace(".py", "")
+        mod_base = __import__("master.watchers", globals(), locals(), fromlist=[mod_name])
+        mod = getattr(mod_base, mod_name)
+
+        for name in dir(mod):
+            item = getattr(mod, name)
+            if type(item) is not type:
                 continue
+            if item != master.watchers.WatcherBase and issubclass(item, master.watchers.WatcherBase):
+                watchers.append(getattr(mod, name)(parent_log))
 
-            mod_name = os.path.basename(filename).replace(".py", "")
-            mod_base = __import__("master.watchers", globals(), locals(), fromlist=[mod_name])
-            mod = getattr(mod_base, mod_name)
-
-            for name in dir(mod):
-                item = getattr(mod, name)
-                if type(item) is not type:
-                    continue
-                if item != master.watchers.WatcherBase and issubclass(item, master.watchers.WatcherBase):
-                    watcher = getattr(mod, name)(self._log)
-                    self._watcher.add_watcher(watcher.collection, watcher)
+    return watchers
 
 
 def main(intf):
@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Tools for benchmarking the master against recorded or synthetic load.
+"""
+
+from mongoengine.connection import get_db
+
+
+def has_bulk_ops():
+    """Whether the db mongoengine is connected to can do the unordered bulk
+    writes the master batches its changes into. mongomock can't, and every
+    batch would fail.
+    """
+    # pymongo and mongomock collections return sub-collections for unknown
+    # attributes, so look at the class
+    return hasattr(type(get_db()["bench"]), "initialize_unordered_bulk_op")
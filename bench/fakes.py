@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+In-process stand-ins for the services the master talks to, for use by the
+benchmarks.
+"""
+
+
+import BaseHTTPServer
+import collections
+import heapq
+import itertools
+import logging
+import random
+import SocketServer
+import threading
+import time
+
+from master.lib.metrics import Timings
+
+
+class FakeMethod(object):
+    """Stands in for a pika ``Basic.Deliver`` method frame
+    """
+
+    def __init__(self, queue, delivery_tag):
+        self.routing_key = queue
+        self.delivery_tag = delivery_tag
+
+
+class FakeProperties(object):
+    """Stands in for pika ``BasicProperties``
+    """
+
+    def __init__(self, content_type=None):
+        self.content_type = content_type
+
+
+class FakeConnection(object):
+    """Stands in for a pika connection, only providing timeouts. The
+    timeouts are run on the delivery thread of the
+    :any:`FakeAmqpManager`, like pika runs them on its ioloop.
+    """
+
+    def __init__(self):
+        self._ids = itertools.count(1)
+        # [(<deadline>, <id>, <callback>), ...]
+        self.timeouts = []
+        self._removed = set()
+
+    def add_timeout(self, deadline, callback_method):
+        id_ = next(self._ids)
+        heapq.heappush(self.timeouts, (time.time() + deadline, id_, callback_method))
+        return id_
+
+    def remove_timeout(self, timeout_id):
+        self._removed.add(timeout_id)
+
+    def next_deadline(self):
+        while len(self.timeouts) > 0 and self.timeouts[0][1] in self._removed:
+            self._removed.discard(heapq.heappop(self.timeouts)[1])
+        if len(self.timeouts) == 0:
+            return None
+        return self.timeouts[0][0]
+
+    def pop_due(self, now):
+        """Return the callbacks of every timeout that is due at ``now``
+        """
+        due = []
+        while self.next_deadline() is not None and self.timeouts[0][0] <= now:
+            due.append(heapq.heappop(self.timeouts)[2])
+        return due
+
+
+class FakeChannel(object):
+    """Stands in for a pika channel, only tracking acknowledgements. The
+    latency of a message is the time from it being queued to it being
+    acknowledged.
+    """
+
+    def __init__(self):
+        self.connection = FakeConnection()
+        self.acked = 0
+        self.ack_calls = 0
+        self.nacked = 0
+        self.prefetch_count = 0
+        self.latency = Timings(samples=100000)
+        # { <delivery tag>: <queued at>, ... } of unacknowledged messages
+        self._unacked = collections.OrderedDict()
+
+    def delivered(self, delivery_tag, queued_at):
+        self._unacked[delivery_tag] = queued_at
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self.ack_calls += 1
+        self.acked += self._settle(delivery_tag, multiple)
+
+    def basic_nack(self, delivery_tag=None, multiple=False, requeue=True):
+        self.nacked += self._settle(delivery_tag, multiple)
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0, all_channels=False):
+        self.prefetch_count = prefetch_count
+
+    def _settle(self, delivery_tag, multiple):
+        if multiple:
+            tags = [tag for tag in self._unacked if tag <= delivery_tag]
+        else:
+            tags = [delivery_tag]
+
+        now = time.time()
+        for tag in tags:
+            self.latency.add(now - self._unacked.pop(tag))
+        return len(tags)
+
+
+class FakeAmqpManager(object):
+    """An in-process replacement for :any:`master.lib.amqp_man.AmqpManager`.
+    Messages queued to a consumed queue are delivered to the consumer's
+    callback on a single delivery thread, the same way pika would.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+
+        # { <queue>: <callback>, ... }
+        self._consumers = {}
+        # queues whose messages are not acknowledged
+        self._no_ack = set()
+        # (<queued at>, <queue>, <body>, <props>)
+        self._pending = collections.deque()
+        self._delivery_tag = 0
+
+        self._log = logging.getLogger("FakeAmqp")
+        self.channel = FakeChannel()
+        # { <queue>: [<body>, ...], ... } for queues nothing consumes
+        self.sent = collections.defaultdict(list)
+        self.delivered = 0
+        self.errors = 0
+
+    # -------------------------
+    # the AmqpManager interface
+    # -------------------------
+
+    def do_start(self):
+        with self._cond:
+            self._running = True
+        self._thread = threading.Thread(target=self._deliver, name="FakeAmqp")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop once every queued message has been delivered
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+    def declare_exchange(self, name, type_, *args, **kwargs):
+        pass
+
+    def declare_queue(self, name, *args, **kwargs):
+        pass
+
+    def consume_queue(self, queue, callback, no_ack=False, *args, **kwargs):
+        self._consumers[queue] = callback
+        if no_ack:
+            self._no_ack.add(queue)
+
+    def queue_msg(self, msg, queue, props=None):
+        with self._cond:
+            if queue not in self._consumers:
+                self.sent[queue].append(msg)
+                return
+            self._pending.append((time.time(), queue, msg, props or FakeProperties()))
+            self._cond.notify()
+
+    def set_prefetch(self, count):
+        """Limit the unacknowledged messages delivered on the channel
+        """
+        self.channel.basic_qos(prefetch_count=count, all_channels=True)
+
+    def ack_method(self, method):
+        self.channel.basic_ack(delivery_tag=method.delivery_tag)
+
+    # -------------------------
+
+    def pending(self):
+        with self._cond:
+            return len(self._pending)
+
+    def _deliver(self):
+        connection = self.channel.connection
+        while True:
+            for callback in connection.pop_due(time.time()):
+                self._call(callback)
+
+            with self._cond:
+                while self._running and len(self._pending) == 0:
+                    deadline = connection.next_deadline()
+                    if deadline is not None and deadline <= time.time():
+                        break
+                    self._cond.wait(1.0 if deadline is None else deadline - time.time())
+                if len(self._pending) == 0:
+                    if self._running:
+                        continue
+                    # run whatever was still waiting on a timeout before
+                    # stopping
+                    for callback in connection.pop_due(float("inf")):
+                        self._call(callback)
+                    return
+                queued_at, queue, body, props = self._pending.popleft()
+                self._delivery_tag += 1
+                method = FakeMethod(queue, self._delivery_tag)
+
+            if queue not in self._no_ack:
+                self.channel.delivered(method.delivery_tag, queued_at)
+            try:
+                self._consumers[queue](self.channel, method, props, body)
+            except Exception:
+                self.errors += 1
+                self._log.exception("error handling message on {}".format(queue))
+            self.delivered += 1
+
+    def _call(self, callback):
+        try:
+            callback()
+        except Exception:
+            self.errors += 1
+            self._log.exception("error running a timeout")
+
+
+class WebhookStandIn(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A local HTTP server that webhooks can be delivered to. Connections are
+    kept alive, and every request takes ``delay`` seconds to answer and fails
+    with a ``503`` with a chance of ``failure_rate``.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port=0, delay=0.0, failure_rate=0.0):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port), _WebhookHandler)
+        self.delay = delay
+        self.failure_rate = failure_rate
+        self._random = random.Random(1)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.failed = 0
+        self.connections = 0
+        self.bytes_received = 0
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/hook".format(self.server_address[1])
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="WebhookStandIn")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def _handle(self, body):
+        """:returns: The status code to respond with
+        """
+        time.sleep(self.delay)
+        with self._lock:
+            self.requests += 1
+            self.bytes_received += len(body)
+            if self._random.random() < self.failure_rate:
+                self.failed += 1
+                return 503
+        return 200
+
+
+class _WebhookHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # send the whole response at once instead of a packet per header
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server._lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader("content-length", 0)))
+        status = self.server._handle(body)
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
@@ -0,0 +1,602 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Synthetic load benchmark for the master daemon.
+
+A :any:`master.Master` is started with an in-process stand-in for the AMQP
+manager and a local MongoDB. Simulated slaves send
+``new``/``status``/``heartbeat`` messages to the master while job, result,
+and image events are fed through the :any:`master.TalusDBWatcher` at
+configurable rates:
+
+.. code-block:: bash
+
+    python -m master.bench.master_load --slaves 200 --duration 60
+    python -m master.bench.master_load --slaves 500 --result-rate 100 --db db.example.com
+    python -m master.bench.master_load --slaves 2000 --status-encoding delta-bson
+"""
+
+
+import argparse
+import bson
+import heapq
+import json
+import logging
+import mock
+import os
+import random
+import resource
+import sys
+import tabulate
+import threading
+import time
+import uuid
+
+import mongoengine
+from mongoengine.connection import get_connection
+
+import master
+import master.models as models
+from master.bench import has_bulk_ops
+from master.bench.fakes import FakeAmqpManager, FakeProperties
+from master.bench.replay import NullWatcher, report
+
+
+class SlaveSimulator(threading.Thread):
+    """Sends the messages of ``count`` slaves to the master's slave status
+    queue, and runs the jobs the master sends them
+    """
+
+    STATUS_ENCODINGS = ["full", "delta", "delta-bson"]
+
+    def __init__(self, amqp, count, status_interval=5.0, heartbeat_interval=2.0, vms_per_slave=4,
+                 vm_churn=0.2, encoding="full", max_vms=None, vm_duration=5.0, vm_startup=0.0, stragglers=0.0):
+        """Create a new slave simulator
+
+        :amqp: The :any:`master.bench.fakes.FakeAmqpManager` to send with
+        :count: The number of slaves to simulate
+        :status_interval: Seconds between status messages of each slave
+        :heartbeat_interval: Seconds between heartbeats of each slave
+        :vms_per_slave: The number of VMs each slave is running outside of the master's control
+        :vm_churn: The chance of one of those VMs being replaced between status messages
+        :encoding: How status messages are sent, one of ``STATUS_ENCODINGS``
+        :max_vms: The number of VMs each slave can run, ``vms_per_slave`` by default.
+            Slaves have 2 cpus and 2048MB of ram per VM.
+        :vm_duration: Seconds each index of a work unit sent by the master runs for
+        :vm_startup: Seconds it takes to start the VM of each work unit
+        :stragglers: The chance of a work unit running ten times slower
+        """
+        threading.Thread.__init__(self, name="SlaveSimulator")
+        self.daemon = True
+
+        self._amqp = amqp
+        self._status_interval = status_interval
+        self._heartbeat_interval = heartbeat_interval
+        self._vm_churn = vm_churn
+        self._encoding = encoding
+        self._max_vms = max_vms or vms_per_slave
+        self._vm_duration = vm_duration
+        self._vm_startup = vm_startup
+        self._stragglers = stragglers
+        self._running = threading.Event()
+        self._random = random.Random(1)
+        # slave messages from the master arrive on the fake amqp thread
+        self._lock = threading.Lock()
+        # (<end time>, <slave index>, <vm>)
+        self._vm_ends = []
+        self.sent = 0
+        self.bytes_sent = 0
+        self.resyncs = 0
+        self.units_run = 0
+        self.idxs_run = 0
+        self.preempted = 0
+        # work units that had to wait for their image to be downloaded
+        self.cold_starts = 0
+        self.prewarms = 0
+
+        self.slaves = []
+        for x in range(count):
+            slave = dict(
+                uuid     = str(uuid.uuid4()),
+                hostname = "slave-{}".format(x),
+                ip       = "10.0.{}.{}".format(x // 256, x % 256),
+                jobs_run = 0,
+                seq      = 0,
+                resync   = True,
+                vms      = [],
+                added    = [],
+                removed  = [],
+                images   = set(),
+                reported_images = None,
+            )
+            for _ in range(vms_per_slave):
+                self._start_vm(slave)
+            self.slaves.append(slave)
+
+            # the master sends config, resync, and job messages on the
+            # slave's own queue
+            self._amqp.consume_queue(
+                master.Master.AMQP_SLAVE_QUEUE + "_" + slave["uuid"],
+                self._on_slave_msg(x),
+                no_ack=True
+            )
+
+    def stop(self):
+        self._running.clear()
+        self.join()
+
+    def run(self):
+        self._running.set()
+
+        # (<send time>, <slave index>, <message type>)
+        schedule = []
+        now = time.time()
+        for idx, slave in enumerate(self.slaves):
+            self._send(self._new_msg(slave))
+            # spread the slaves out over the intervals
+            offset = float(idx) / max(1, len(self.slaves))
+            heapq.heappush(schedule, (now + offset * self._status_interval, idx, "status"))
+            heapq.heappush(schedule, (now + offset * self._heartbeat_interval, idx, "heartbeat"))
+
+        while self._running.is_set():
+            send_at, idx, type_ = heapq.heappop(schedule)
+            delay = send_at - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self._end_vms()
+
+            slave = self.slaves[idx]
+            if type_ == "status":
+                self._send(self._status_msg(slave))
+                heapq.heappush(schedule, (send_at + self._status_interval, idx, type_))
+            else:
+                self._send(dict(type="heartbeat", uuid=slave["uuid"], hostname=slave["hostname"]))
+                heapq.heappush(schedule, (send_at + self._heartbeat_interval, idx, type_))
+
+    def _on_slave_msg(self, slave_idx):
+        slave = self.slaves[slave_idx]
+
+        def callback(channel, method, props, body):
+            msg = json.loads(body)
+            with self._lock:
+                if msg["type"] == "resync":
+                    slave["resync"] = True
+                    self.resyncs += 1
+                elif msg["type"] == "prewarm":
+                    slave["images"].add(msg["image_md5"])
+                    self.prewarms += 1
+                elif msg["type"] == "job":
+                    if msg["image_md5"] is not None and msg["image_md5"] not in slave["images"]:
+                        self.cold_starts += 1
+                        slave["images"].add(msg["image_md5"])
+                    vm = self._start_vm(slave, msg)
+                    duration = self._vm_duration * msg.get("count", 1)
+                    if self._random.random() < self._stragglers:
+                        duration *= 10
+                    heapq.heappush(self._vm_ends, (time.time() + self._vm_startup + duration, slave_idx, vm))
+                elif msg["type"] == "preempt":
+                    for vm in slave["vms"]:
+                        if vm["job"] == msg["job"] and vm["idx"] == msg["idx"]:
+                            slave["vms"].remove(vm)
+                            slave["removed"].append(vm)
+                            self.preempted += 1
+                            break
+        return callback
+
+    def _end_vms(self):
+        now = time.time()
+        with self._lock:
+            while len(self._vm_ends) > 0 and self._vm_ends[0][0] <= now:
+                _, slave_idx, vm = heapq.heappop(self._vm_ends)
+                slave = self.slaves[slave_idx]
+                if vm not in slave["vms"]:
+                    # preempted
+                    continue
+                slave["vms"].remove(vm)
+                slave["removed"].append(vm)
+                self.units_run += 1
+                self.idxs_run += vm["count"]
+
+    def _send(self, msg):
+        if self._encoding == "delta-bson":
+            body = bson.BSON.encode(msg)
+            props = FakeProperties("application/bson")
+        else:
+            body = json.dumps(msg)
+            props = None
+        self._amqp.queue_msg(body, master.Master.AMQP_SLAVE_STATUS_QUEUE, props)
+        self.sent += 1
+        self.bytes_sent += len(body)
+
+    def _start_vm(self, slave, job_msg=None):
+        slave["jobs_run"] += 1
+        if job_msg is None:
+            vm = dict(job=str(bson.ObjectId()), idx=slave["jobs_run"], tool="BenchTool", cpu=1, ram=1024)
+        else:
+            vm = dict(job=job_msg["job"], idx=job_msg["idx"], count=job_msg.get("count", 1), tool=job_msg["tool"],
+                      cpu=job_msg["vm_cpu"], ram=job_msg["vm_ram"])
+        vm["vnc_port"] = 5900 + len(slave["vms"])
+        slave["vms"].append(vm)
+        slave["added"].append(vm)
+        return vm
+
+    def _new_msg(self, slave):
+        return dict(
+            type     = "new",
+            uuid     = slave["uuid"],
+            hostname = slave["hostname"],
+            ip       = slave["ip"],
+            max_vms  = self._max_vms,
+            max_cpus = self._max_vms * 2,
+            max_ram  = self._max_vms * 2048,
+        )
+
+    def _status_msg(self, slave):
+        with self._lock:
+            background = [vm for vm in slave["vms"] if vm["tool"] == "BenchTool"]
+            if len(background) > 0 and self._random.random() < self._vm_churn:
+                vm = self._random.choice(background)
+                slave["vms"].remove(vm)
+                slave["removed"].append(vm)
+                self._start_vm(slave)
+
+            added, slave["added"] = slave["added"], []
+            removed, slave["removed"] = slave["removed"], []
+            vms = list(slave["vms"])
+            images = sorted(slave["images"])
+
+        slave["seq"] += 1
+        msg = dict(
+            type     = "status",
+            uuid     = slave["uuid"],
+            hostname = slave["hostname"],
+        )
+
+        if self._encoding == "full" or slave["resync"]:
+            msg.update(dict(
+                running_vms    = len(vms),
+                total_jobs_run = slave["jobs_run"],
+                vms            = vms,
+                used_cpus      = sum(vm["cpu"] for vm in vms),
+                used_ram       = sum(vm["ram"] for vm in vms),
+                max_cpus       = self._max_vms * 2,
+                max_ram        = self._max_vms * 2048,
+                images         = images,
+            ))
+            slave["reported_images"] = images
+            if self._encoding != "full":
+                msg.update(dict(seq=slave["seq"], full=True))
+                slave["resync"] = False
+            return msg
+
+        msg["seq"] = slave["seq"]
+        if len(added) > 0 or len(removed) > 0:
+            msg.update(dict(
+                running_vms    = len(vms),
+                total_jobs_run = slave["jobs_run"],
+                used_cpus      = sum(vm["cpu"] for vm in vms),
+                used_ram       = sum(vm["ram"] for vm in vms),
+                vms_add        = added,
+                vms_remove     = [dict(job=vm["job"], idx=vm["idx"]) for vm in removed],
+            ))
+        if images != slave["reported_images"]:
+            msg["images"] = images
+            slave["reported_images"] = images
+        return msg
+
+
+class EventInjector(threading.Thread):
+    """Feeds job, result, and image events to the :any:`master.TalusDBWatcher`
+    at fixed rates (events/second). Unless ``fake_docs`` is set, the
+    documents the events are about are really written to the database.
+    """
+
+    def __init__(self, db_watcher, job_rate=10.0, result_rate=10.0, image_rate=1.0, fake_docs=False, run_jobs=None,
+                 distinct_images=False):
+        """Create a new event injector
+
+        :db_watcher: The :any:`master.TalusDBWatcher` to feed
+        :job_rate: Job progress updates per second
+        :result_rate: Result inserts per second
+        :image_rate: Image updates per second
+        :fake_docs: Don't write the documents to the database
+        :run_jobs: A list of ``(units, vm_cpu, vm_ram, priority, delay, tags)`` jobs to start on
+            the simulated slaves, ``delay`` seconds after the injector starts
+        :distinct_images: Give every job in ``run_jobs`` its own image
+        """
+        threading.Thread.__init__(self, name="EventInjector")
+        self.daemon = True
+
+        self._db_watcher = db_watcher
+        self._rates = dict(job=job_rate, result=result_rate, image=image_rate)
+        self._fake_docs = fake_docs
+        self._run_jobs = run_jobs or []
+        self._distinct_images = distinct_images
+        self._running = threading.Event()
+        self._inc = 0
+        self.sent = 0
+
+        self._job = None
+        self._image = None
+
+    def stop(self):
+        self._running.clear()
+        self.join()
+
+    def run(self):
+        self._running.set()
+        if not self._fake_docs:
+            self._make_fixtures()
+
+        schedule = []
+        now = time.time()
+        for kind, rate in self._rates.iteritems():
+            if rate > 0:
+                heapq.heappush(schedule, (now, kind))
+
+        while self._running.is_set() and len(schedule) > 0:
+            send_at, kind = heapq.heappop(schedule)
+            delay = send_at - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            getattr(self, "_send_" + kind)()
+            self.sent += 1
+            heapq.heappush(schedule, (send_at + 1.0 / self._rates[kind], kind))
+
+    # -----------------------
+
+    def _ts(self):
+        self._inc += 1
+        return bson.timestamp.Timestamp(int(time.time()), self._inc)
+
+    def _make_fixtures(self):
+        os_ = models.OS(name="bench-os-{}".format(uuid.uuid4()), version="1", type="linux", arch="x64")
+        os_.save()
+        self._image = self._make_image(os_)
+        tool = models.Code(name="BenchTool{}".format(uuid.uuid4().hex), type="tool")
+        tool.save()
+        task = models.Task(name="bench-task-{}".format(uuid.uuid4()), tool=tool, image=self._image)
+        task.save()
+        self._job = models.Job(name="bench-job", task=task, image=self._image, status={"name": "running"}, limit=1000000)
+        self._job.save()
+
+        for idx, (units, vm_cpu, vm_ram, priority, delay, tags) in enumerate(self._run_jobs):
+            job = models.Job(
+                name     = "bench-run-{}".format(idx),
+                task     = task,
+                image    = self._make_image(os_) if self._distinct_images else self._image,
+                status   = {"name": "run"},
+                limit    = units,
+                vm_cpu   = vm_cpu,
+                vm_ram   = vm_ram,
+                priority = priority,
+                tags     = tags,
+            )
+            timer = threading.Timer(delay, self._run_job, args=(job,))
+            timer.daemon = True
+            timer.start()
+
+    def _make_image(self, os_):
+        image = models.Image(
+            name   = "bench-image-{}".format(uuid.uuid4()),
+            os     = os_,
+            status = {"name": "ready"},
+            md5    = uuid.uuid4().hex,
+        )
+        image.save()
+        return image
+
+    def _run_job(self, job):
+        job.save()
+        self._db_watcher.insert(ns="talus.job", ts=self._ts(), id=job.id, obj=job.to_mongo(), raw=None)
+
+    def _send_job(self):
+        if self._fake_docs:
+            id_ = bson.ObjectId()
+        else:
+            id_ = self._job.id
+            models.Job.objects(id=id_).update(inc__progress=1)
+        self._db_watcher.update(ns="talus.job", ts=self._ts(), id=id_, mod={"$set": {"progress": self._inc}}, raw=None)
+
+    def _send_result(self):
+        if self._fake_docs:
+            doc = dict(_id=bson.ObjectId(), type="bench", tool="BenchTool", data={})
+        else:
+            result = models.Result(job=self._job, type="bench", tool="BenchTool", data={"inc": self._inc})
+            result.save()
+            doc = result.to_mongo()
+        self._db_watcher.insert(ns="talus.result", ts=self._ts(), id=doc["_id"], obj=doc, raw=None)
+
+    def _send_image(self):
+        id_ = bson.ObjectId() if self._fake_docs else self._image.id
+        self._db_watcher.update(ns="talus.image", ts=self._ts(), id=id_, mod={"$set": {"status": {"name": "ready"}}}, raw=None)
+
+
+def _max_rss_mb():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--intf", default="lo", help="The network interface the master reports")
+    parser.add_argument("--db", default="localhost",
+                        help="The mongodb host to use, mongomock://localhost uses an in-memory stand-in if it can do bulk writes")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds to run the benchmark for")
+    parser.add_argument("--slaves", type=int, default=50, help="The number of simulated slaves")
+    parser.add_argument("--vms-per-slave", type=int, default=4)
+    parser.add_argument("--status-interval", type=float, default=5.0)
+    parser.add_argument("--heartbeat-interval", type=float, default=2.0)
+    parser.add_argument("--vm-churn", type=float, default=0.2,
+                        help="The chance of a slave's VM being replaced between status messages")
+    parser.add_argument("--max-vms", type=int, default=None,
+                        help="The number of VMs each slave can run (2 cpus and 2048MB of ram each), --vms-per-slave by default")
+    parser.add_argument("--vm-duration", type=float, default=5.0, help="Seconds each index of a scheduled work unit runs for")
+    parser.add_argument("--vm-startup", type=float, default=0.0, help="Seconds it takes to start the VM of a scheduled work unit")
+    parser.add_argument("--stragglers", type=float, default=0.0,
+                        help="The chance of a scheduled work unit running ten times slower")
+    parser.add_argument("--chunk-seconds", type=float, default=None,
+                        help="How long the scheduler should aim for work units to run, see Scheduler.CHUNK_SECONDS")
+    parser.add_argument("--run-job", action="append", default=[], metavar="UNITS[:CPU[:RAM[:PRIORITY[:DELAY]]]][@TAG]",
+                        help="Start a job with UNITS work units on the simulated slaves after DELAY seconds, "
+                             "can be given more than once")
+    parser.add_argument("--distinct-images", action="store_true", default=False,
+                        help="Give every --run-job job its own image")
+    parser.add_argument("--status-encoding", choices=SlaveSimulator.STATUS_ENCODINGS, default="full",
+                        help="Send full status messages, deltas, or deltas encoded as BSON")
+    parser.add_argument("--job-rate", type=float, default=10.0, help="Job updates per second")
+    parser.add_argument("--result-rate", type=float, default=10.0, help="Result inserts per second")
+    parser.add_argument("--image-rate", type=float, default=1.0, help="Image updates per second")
+    parser.add_argument("--null-watchers", action="store_true", default=False,
+                        help="Replace the real watchers with ones that only sleep for --delay seconds")
+    parser.add_argument("--delay", type=float, default=0.0, help="Seconds the null watchers spend on every event")
+    parser.add_argument("--verbose", action="store_true", default=False)
+    args = parser.parse_args(argv)
+
+    run_jobs = []
+    for spec in args.run_job:
+        spec, _, tag = spec.partition("@")
+        # units, cpu, ram, priority, delay
+        values = [1, 1, 1024, 50, 0]
+        for idx, part in enumerate(spec.split(":")[:5]):
+            if part != "":
+                values[idx] = int(part)
+        run_jobs.append(tuple(values) + ([tag] if tag else [],))
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARN)
+    log = logging.getLogger("BENCH")
+    log.setLevel(logging.INFO)
+
+    mongoengine.connect("talus", host=args.db)
+    if not has_bulk_ops():
+        log.error("{} can't do bulk writes, every status batch would fail".format(args.db))
+        return 2
+    rss_start = _max_rss_mb()
+
+    # only used by the master to connect its own oplog watcher, which the
+    # benchmark replaces
+    os.environ.setdefault("TALUS_DB_PORT_27017_TCP", "tcp://127.0.0.1:27017")
+
+    amqp = FakeAmqpManager()
+    with mock.patch.object(master.AmqpManager, "instance", return_value=amqp):
+        master_ = master.Master(args.intf)
+    # the watchers get to the master through Master.instance()
+    master.Master._instance = master_
+    if args.chunk_seconds is not None:
+        master_._scheduler.CHUNK_SECONDS = args.chunk_seconds
+    master_._slaves.load()
+    master_._slaves.start()
+    master_._scheduler.start()
+    master_._amqp_listen_for_slaves()
+    amqp.do_start()
+
+    db_watcher = master.TalusDBWatcher(parent_log=log, connection=get_connection())
+    if args.null_watchers:
+        watchers = [NullWatcher(log, ns, delay=args.delay) for ns in ["talus.job", "talus.result", "talus.image"]]
+    else:
+        watchers = master.load_watchers(log)
+    for watcher in watchers:
+        db_watcher.add_watcher(watcher.collection, watcher)
+    db_watcher.start_dispatching()
+
+    slaves = SlaveSimulator(
+        amqp,
+        args.slaves,
+        status_interval    = args.status_interval,
+        heartbeat_interval = args.heartbeat_interval,
+        vms_per_slave      = args.vms_per_slave,
+        vm_churn           = args.vm_churn,
+        encoding           = args.status_encoding,
+        max_vms            = args.max_vms,
+        vm_duration        = args.vm_duration,
+        vm_startup         = args.vm_startup,
+        stragglers         = args.stragglers,
+    )
+    injector = EventInjector(
+        db_watcher,
+        job_rate    = args.job_rate,
+        result_rate = args.result_rate,
+        image_rate  = args.image_rate,
+        fake_docs   = args.null_watchers,
+        run_jobs    = run_jobs,
+        distinct_images = args.distinct_images,
+    )
+
+    log.info("running for {}s with {} slaves".format(args.duration, args.slaves))
+    start = time.time()
+    slaves.start()
+    injector.start()
+    time.sleep(args.duration)
+
+    slaves.stop()
+    injector.stop()
+    amqp.stop()
+    master_._scheduler.stop()
+    master_._slaves.stop()
+    db_watcher.stop_dispatching()
+    elapsed = time.time() - start
+
+    latency = amqp.channel.latency.stats()
+    print(tabulate.tabulate([[
+        slaves.sent,
+        amqp.delivered,
+        round(amqp.delivered / elapsed, 1),
+        latency["p50"],
+        latency["p99"],
+        latency["max"],
+        amqp.errors,
+        amqp.channel.acked,
+        amqp.channel.nacked,
+        amqp.channel.ack_calls,
+    ]], headers=["slave msgs sent", "handled", "msgs/s", "latency p50", "latency p99", "latency max", "errors", "acked", "nacked", "ack calls"]))
+    print("")
+
+    report(db_watcher.stats(), elapsed)
+    print("")
+
+    sched = master_._scheduler.stats()
+    print(tabulate.tabulate([[
+        sched["counts"].get("placed", 0),
+        sched["counts"].get("requeued", 0),
+        sched["counts"].get("finished", 0),
+        slaves.units_run,
+        slaves.idxs_run,
+        sched["pending"],
+        sched["utilisation"].get("cpu", 0),
+        sched["utilisation"].get("ram", 0),
+        sched["utilisation"].get("vms", 0),
+        sched["pass_time"]["p99"],
+        sched["counts"].get("preempted", 0),
+        slaves.cold_starts,
+        slaves.prewarms,
+        sched["counts"].get("duplicated", 0),
+    ]], headers=["placed", "requeued", "jobs finished", "units run", "idxs run", "pending", "cpu util", "ram util", "vm util",
+                 "pass p99", "preempted", "cold starts", "prewarms", "duplicated"]))
+    print("")
+
+    if len(sched["groups"]) > 0:
+        print(tabulate.tabulate(
+            [[group["group"], group["share"], group["usage"], group["running"], group["pending"]] for group in sched["groups"]],
+            headers=["group", "share", "usage (vm-s)", "running cpus", "pending jobs"]
+        ))
+        print("")
+
+    rss_end = _max_rss_mb()
+    print("slave status bytes sent: {} ({:.1f} per message), resyncs: {}".format(
+        slaves.bytes_sent, slaves.bytes_sent / float(max(1, slaves.sent)), slaves.resyncs))
+    print("db events injected: {}".format(injector.sent))
+    print("max rss: {:.1f}MB -> {:.1f}MB ({:+.1f}MB)".format(rss_start, rss_end, rss_end - rss_start))
+
+    # the numbers above mean nothing if the changes weren't written
+    unflushed = master_._status_stats["unflushed"]
+    if amqp.channel.nacked > 0 or unflushed > 0:
+        log.error("{} slave messages were nacked and {} weren't written to the db".format(amqp.channel.nacked, unflushed))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Check that restarting the master while work units of a job are running on
+the slaves doesn't place them again. The master is started the same way
+:any:`master.Master.run` starts it, over a database that has a running job
+and a slave that reports some of its work units.
+
+.. code-block:: bash
+
+    python -m master.bench.master_restart
+"""
+
+
+import argparse
+import json
+import logging
+import mock
+import os
+import sys
+import uuid
+
+import mongoengine
+from mongoengine.connection import get_connection
+
+import master
+import master.models as models
+from master.bench.fakes import FakeAmqpManager
+
+
+def make_fixtures(limit, running):
+    """Create a running job with ``limit`` indices, and a slave that is
+    running the first ``running`` of them
+
+    :returns: The job and the slave
+    """
+    os_ = models.OS(name="restart-os-{}".format(uuid.uuid4()), version="1", type="linux", arch="x64")
+    os_.save()
+    image = models.Image(name="restart-image-{}".format(uuid.uuid4()), os=os_, status={"name": "ready"}, md5=uuid.uuid4().hex)
+    image.save()
+    tool = models.Code(name="RestartTool{}".format(uuid.uuid4().hex), type="tool")
+    tool.save()
+    task = models.Task(name="restart-task-{}".format(uuid.uuid4()), tool=tool, image=image)
+    task.save()
+    job = models.Job(name="restart-job", task=task, image=image, status={"name": "running"}, limit=limit)
+    job.save()
+
+    vms = [dict(job=str(job.id), idx=idx, count=1, tool=tool.name, cpu=1, ram=1024) for idx in xrange(running)]
+    slave = models.Slave(
+        hostname    = "restart-slave",
+        uuid        = str(uuid.uuid4()),
+        max_vms     = limit,
+        max_cpus    = limit * 2,
+        max_ram     = limit * 2048,
+        running_vms = len(vms),
+        used_cpus   = len(vms),
+        used_ram    = len(vms) * 1024,
+        vms         = vms,
+        images      = [image.md5],
+    )
+    slave.save()
+    return job, slave
+
+
+def restart(intf):
+    """Start the master's services as it would after a restart, and run a
+    single scheduling pass
+
+    :returns: The master and its stand-in AMQP manager
+    """
+    amqp = FakeAmqpManager()
+    with mock.patch.object(master.AmqpManager, "instance", return_value=amqp):
+        master_ = master.Master(intf)
+    master.Master._instance = master_
+
+    # the oplog isn't tailed, the watchers are only started up
+    with mock.patch.object(master.pymongo, "MongoClient", side_effect=lambda *args, **kwargs: get_connection()):
+        with mock.patch.object(master.TalusDBWatcher, "start"):
+            master_._start_services()
+    master_._scheduler.schedule()
+    return master_, amqp
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--intf", default="lo", help="The network interface the master reports")
+    parser.add_argument("--db", default="mongomock://localhost",
+                        help="The mongodb host to use, mongomock://localhost (the default) uses an in-memory stand-in")
+    parser.add_argument("--limit", type=int, default=6, help="The number of indices of the job")
+    parser.add_argument("--running", type=int, default=3, help="The number of indices running on the slave")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARN)
+    mongoengine.connect("talus", host=args.db)
+    os.environ.setdefault("TALUS_DB_PORT_27017_TCP", "tcp://127.0.0.1:27017")
+
+    job, slave = make_fixtures(args.limit, args.running)
+    master_, amqp = restart(args.intf)
+    try:
+        placed = [
+            msg["idx"]
+            for msg in (json.loads(body) for body in amqp.sent["slaves_" + slave.uuid])
+            if msg.get("type", None) == "job" and msg.get("job", None) == str(job.id)
+        ]
+        in_flight = master_._scheduler.stats()["in_flight"]
+    finally:
+        with mock.patch.object(master.AmqpManager, "instance", return_value=amqp):
+            master_._shutdown_singletons()
+
+    failures = []
+    again = sorted(idx for idx in placed if idx < args.running)
+    if len(again) > 0:
+        failures.append("running indices {} were placed again".format(again))
+    if sorted(placed) != range(args.running, args.limit):
+        failures.append("placed indices {}, expected {}".format(sorted(placed), range(args.running, args.limit)))
+    if in_flight != args.limit:
+        failures.append("{} work units are tracked, expected {}".format(in_flight, args.limit))
+
+    for failure in failures:
+        print("FAIL {}".format(failure))
+    if len(failures) > 0:
+        return 1
+    print("ok")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Replay a capture of oplog events through the :any:`master.TalusDBWatcher`
+and report the throughput and latency of every watcher.
+
+Captures are recorded by a running master when ``TALUS_OPLOG_RECORD`` is set
+to the path of the capture file (see :any:`master.lib.oplog_capture`):
+
+.. code-block:: bash
+
+    TALUS_OPLOG_RECORD=/talus/data/master/oplog.capture python -m master eth0
+
+and can then be replayed against a local mongod, or an in-memory stand-in
+with ``--null-watchers``:
+
+.. code-block:: bash
+
+    python -m master.bench.replay /talus/data/master/oplog.capture --speed 10
+    python -m master.bench.replay oplog.capture --speed 0 --db db.example.com
+    python -m master.bench.replay oplog.capture --null-watchers --delay 0.01
+"""
+
+
+import argparse
+import logging
+import sys
+import tabulate
+import time
+
+import mongoengine
+from mongoengine.connection import get_connection
+
+import master
+import master.watchers
+from master.bench import has_bulk_ops
+from master.lib.oplog_capture import read_capture
+
+
+class NullWatcher(master.watchers.WatcherBase):
+    """Stands in for the real watchers of a collection, spending ``delay``
+    seconds on every event.
+    """
+
+    def __init__(self, parent_log, collection, delay=0.0):
+        master.watchers.WatcherBase.__init__(self, parent_log)
+        self.collection = collection
+        self._delay = delay
+
+    def insert(self, id_, obj):
+        time.sleep(self._delay)
+
+    def update(self, id_, mod):
+        time.sleep(self._delay)
+
+    def delete(self, id_):
+        time.sleep(self._delay)
+
+
+def replay(db_watcher, path, speed=1.0):
+    """Feed every event in the capture file at ``path`` to ``db_watcher``
+
+    :db_watcher: The :any:`master.TalusDBWatcher` to feed the events to
+    :path: The path to the capture file
+    :speed: How many times faster than recorded to replay the events.
+        ``0`` replays them as fast as possible.
+    :returns: The number of events replayed
+    """
+    count = 0
+    start = time.time()
+    first_t = None
+
+    for event in read_capture(path):
+        if first_t is None:
+            first_t = event["t"]
+
+        if speed > 0:
+            delay = (event["t"] - first_t) / speed - (time.time() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+        if event["op"] == "i":
+            db_watcher.insert(ns=event["ns"], ts=event["ts"], id=event["id"], obj=event["o"], raw=None)
+        elif event["op"] == "u":
+            db_watcher.update(ns=event["ns"], ts=event["ts"], id=event["id"], mod=event["o"], raw=None)
+        elif event["op"] == "d":
+            db_watcher.delete(ns=event["ns"], ts=event["ts"], id=event["id"], raw=None)
+        count += 1
+
+    return count
+
+
+def report(lanes, elapsed):
+    """Print the throughput and latencies of each watcher's lane
+    """
+    headers = ["watcher", "ns", "events", "events/s", "latency p50", "latency p99",
+               "handling p50", "handling p99", "filtered", "coalesced", "high water"]
+    rows = []
+    for lane in lanes:
+        rows.append([
+            lane["watcher"],
+            lane["ns"],
+            lane["latency"]["count"],
+            round(lane["latency"]["count"] / elapsed, 1) if elapsed > 0 else 0,
+            lane["latency"]["p50"],
+            lane["latency"]["p99"],
+            lane["handling"]["p50"],
+            lane["handling"]["p99"],
+            lane["filtered"],
+            lane["coalesced"],
+            lane["high_water"],
+        ])
+    print(tabulate.tabulate(rows, headers=headers))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("capture", help="The capture file to replay")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="Replay speed multiplier, 0 replays as fast as possible")
+    parser.add_argument("--db", default="localhost",
+                        help="The mongodb host to use, mongomock://localhost uses an in-memory stand-in if it can do bulk writes")
+    parser.add_argument("--null-watchers", action="store_true", default=False,
+                        help="Replace the real watchers with ones that only sleep for --delay seconds")
+    parser.add_argument("--delay", type=float, default=0.0,
+                        help="Seconds the null watchers spend on every event")
+    args = parser.parse_args(argv)
+
+    log = logging.getLogger("REPLAY")
+
+    mongoengine.connect("talus", host=args.db)
+    if not args.null_watchers and not has_bulk_ops():
+        log.error("{} can't do bulk writes, the watchers' batched writes would fail".format(args.db))
+        return 2
+    db_watcher = master.TalusDBWatcher(parent_log=log, connection=get_connection())
+
+    if args.null_watchers:
+        namespaces = set(event["ns"] for event in read_capture(args.capture))
+        watchers = [NullWatcher(log, ns, delay=args.delay) for ns in sorted(namespaces)]
+    else:
+        watchers = master.load_watchers(log)
+
+    for watcher in watchers:
+        db_watcher.add_watcher(watcher.collection, watcher)
+
+    db_watcher.start_dispatching()
+
+    start = time.time()
+    count = replay(db_watcher, args.capture, speed=args.speed)
+    fed = time.time() - start
+
+    db_watcher.stop_dispatching()
+    elapsed = time.time() - start
+
+    log.info("replayed {} events in {:.2f}s, drained after {:.2f}s".format(count, fed, elapsed))
+    report(db_watcher.stats(), elapsed)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
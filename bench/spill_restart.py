@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Check that events spilled to a lane's journal before a restart are handled
+(or discarded, when resuming from an oplog checkpoint) by the next
+:any:`master.lib.dispatch.Dispatcher`, and that stopping it doesn't hang.
+
+.. code-block:: bash
+
+    python -m master.bench.spill_restart
+"""
+
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+import bson
+
+import master.watchers
+from master.lib.dispatch import Dispatcher, SpillJournal
+
+
+NS = "talus.result"
+
+
+class RecordingWatcher(master.watchers.WatcherBase):
+    """Records the ids of the documents it was called for
+    """
+
+    collection = NS
+    overflow = "spill"
+    queue_size = 10
+
+    def __init__(self, parent_log):
+        master.watchers.WatcherBase.__init__(self, parent_log)
+        self.seen = []
+        self._lock = threading.Lock()
+
+    def insert(self, id_, obj):
+        with self._lock:
+            self.seen.append(id_)
+
+
+def spill(spill_dir, count):
+    """Leave ``count`` events in the watcher's journal, as if the master had
+    stopped before handling them
+    """
+    journal = SpillJournal(os.path.join(spill_dir, "{}.{}.journal".format(NS, RecordingWatcher.__name__)))
+    ids = []
+    for x in xrange(count):
+        id_ = bson.ObjectId()
+        ids.append(id_)
+        journal.append(dict(
+            op        = "insert",
+            id        = id_,
+            data      = {"_id": id_},
+            tss       = [bson.timestamp.Timestamp(1000, x + 1)],
+            queued_at = 0.0,
+        ))
+    journal.close()
+    return ids
+
+
+def restart(spill_dir, resume_spilled, timeout):
+    """Start and stop a dispatcher over the leftover journal
+
+    :returns: The ids the watcher was called for, or None if stopping hung
+    """
+    log = logging.getLogger("spill_restart")
+    watcher = RecordingWatcher(log)
+    dispatcher = Dispatcher(parent_log=log, spill_dir=spill_dir, resume_spilled=resume_spilled)
+    dispatcher.add_watcher(NS, watcher)
+    dispatcher.start()
+
+    stopper = threading.Thread(target=dispatcher.stop)
+    stopper.daemon = True
+    stopper.start()
+    stopper.join(timeout)
+    if stopper.is_alive():
+        return None
+
+    if dispatcher.watermark.in_flight() != 0:
+        return None
+    return watcher.seen
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--events", type=int, default=50, help="the number of leftover spilled events")
+    parser.add_argument("--timeout", type=float, default=10.0, help="seconds to wait for the dispatcher to stop")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARN)
+
+    failures = []
+    for resume_spilled in [True, False]:
+        spill_dir = tempfile.mkdtemp()
+        try:
+            ids = spill(spill_dir, args.events)
+            seen = restart(spill_dir, resume_spilled, args.timeout)
+            expected = ids if resume_spilled else []
+            if seen is None:
+                failures.append("resume_spilled={}: stopping the dispatcher hung".format(resume_spilled))
+            elif sorted(seen) != sorted(expected):
+                failures.append("resume_spilled={}: handled {} of {} events".format(
+                    resume_spilled,
+                    len(seen),
+                    len(expected),
+                ))
+            # nothing should be left over for the next restart
+            elif len(SpillJournal(os.path.join(spill_dir, "{}.{}.journal".format(NS, RecordingWatcher.__name__)))) != 0:
+                failures.append("resume_spilled={}: events were left in the journal".format(resume_spilled))
+        finally:
+            shutil.rmtree(spill_dir)
+
+    for failure in failures:
+        print("FAIL {}".format(failure))
+    if len(failures) > 0:
+        return 1
+    print("ok")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
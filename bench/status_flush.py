@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Check that the slave status batches are acknowledged while the db can't be
+written to. The changes have to stay in the slave registry for its next
+flush instead of being requeued, which would hand the same batch straight
+back to the master and make new slaves again.
+
+.. code-block:: bash
+
+    python -m master.bench.status_flush
+"""
+
+
+import argparse
+import json
+import logging
+import mock
+import os
+import sys
+import time
+import uuid
+
+import mongoengine
+import pymongo.errors
+
+import master
+import master.models as models
+from master.bench.fakes import FakeAmqpManager, FakeMethod, FakeProperties
+
+
+def make_master(intf):
+    """Create a master whose AMQP manager is a stand-in
+
+    :returns: The master and its stand-in AMQP manager
+    """
+    amqp = FakeAmqpManager()
+    with mock.patch.object(master.AmqpManager, "instance", return_value=amqp):
+        master_ = master.Master(intf)
+    master.Master._instance = master_
+    return master_, amqp
+
+
+def deliver(master_, channel, bodies):
+    """Deliver the message bodies to the slave status consumer, and flush
+    whatever is left of the batch
+    """
+    for delivery_tag, body in enumerate(bodies, 1):
+        channel.delivered(delivery_tag, time.time())
+        method = FakeMethod(master_.AMQP_SLAVE_STATUS_QUEUE, delivery_tag)
+        master_._on_slave_status(channel, method, FakeProperties(), body)
+    master_._flush_status_batch(channel)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--intf", default="lo", help="The network interface the master reports")
+    parser.add_argument("--db", default="mongomock://localhost",
+                        help="The mongodb host to use, mongomock://localhost (the default) uses an in-memory stand-in")
+    parser.add_argument("--statuses", type=int, default=5, help="The number of status messages the slave sends")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARN)
+    mongoengine.connect("talus", host=args.db)
+    os.environ.setdefault("TALUS_DB_PORT_27017_TCP", "tcp://127.0.0.1:27017")
+
+    master_, amqp = make_master(args.intf)
+    channel = amqp.channel
+    slave_uuid = str(uuid.uuid4())
+    hostname = "status-flush-{}".format(slave_uuid)
+
+    bodies = [json.dumps(dict(type="new", uuid=slave_uuid, hostname=hostname, max_vms=2, max_cpus=2, max_ram=2048))]
+    for seq in xrange(args.statuses):
+        bodies.append(json.dumps(dict(
+            type        = "status",
+            uuid        = slave_uuid,
+            hostname    = hostname,
+            seq         = seq,
+            full        = True,
+            running_vms = 0,
+            used_cpus   = seq,
+            used_ram    = 0,
+            vms         = [],
+        )))
+
+    collection = type(models.Slave._get_collection())
+    with mock.patch.object(collection, "initialize_unordered_bulk_op", create=True,
+                           side_effect=pymongo.errors.AutoReconnect("db is down")):
+        try:
+            deliver(master_, channel, bodies)
+            registry = master_._slaves.stats()
+            fields = master_._slaves.get(slave_uuid)
+            unflushed = master_._status_stats.get("unflushed", 0)
+        finally:
+            with mock.patch.object(master.AmqpManager, "instance", return_value=amqp):
+                master_._shutdown_singletons()
+
+    failures = []
+    if channel.nacked != 0:
+        failures.append("{} messages were requeued".format(channel.nacked))
+    if channel.acked != len(bodies):
+        failures.append("{} of {} messages were acknowledged".format(channel.acked, len(bodies)))
+    created = models.Slave.objects(uuid=slave_uuid).count()
+    if created != 1:
+        failures.append("the slave was made {} times".format(created))
+    configs = len(amqp.sent[master_.AMQP_SLAVE_QUEUE + "_" + slave_uuid])
+    if configs != 1:
+        failures.append("the slave was sent {} configs".format(configs))
+    if registry["dirty"] != 1 or fields is None or fields.get("used_cpus", None) != args.statuses - 1:
+        failures.append("the unwritten status isn't kept in the registry: {}".format(fields))
+    if unflushed != len(bodies):
+        failures.append("{} messages counted as unflushed, expected {}".format(unflushed, len(bodies)))
+
+    for failure in failures:
+        print("FAIL {}".format(failure))
+    if len(failures) > 0:
+        return 1
+    print("ok")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Benchmark webhook delivery against local HTTP stand-ins.
+
+Job status changes are triggered through the
+:any:`master.lib.webhook_delivery.WebhookDelivery` as fast as possible (or at
+``--rate`` per second), with every event going to ``--hooks`` webhooks that
+are served by a local stand-in endpoint. ``--dead-hooks`` more webhooks point
+at a port nothing listens on:
+
+.. code-block:: bash
+
+    python -m master.bench.webhooks --events 1000 --hooks 4
+    python -m master.bench.webhooks --events 200 --delay 0.05 --failure-rate 0.2 --dead-hooks 1
+"""
+
+
+import argparse
+import logging
+import socket
+import sys
+import tabulate
+import time
+
+import mongoengine
+
+import master.models as models
+from master.bench.fakes import WebhookStandIn
+from master.lib.webhook_delivery import WebhookDelivery
+
+
+def _unused_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--db", default="mongomock://localhost",
+                        help="The mongodb host to use, mongomock://localhost (the default) uses an in-memory stand-in")
+    parser.add_argument("--events", type=int, default=500, help="The number of job status changes to trigger")
+    parser.add_argument("--rate", type=float, default=0.0, help="Events per second, 0 triggers them as fast as possible")
+    parser.add_argument("--hooks", type=int, default=2, help="Webhooks served by the stand-in")
+    parser.add_argument("--dead-hooks", type=int, default=0, help="Webhooks pointing at a port nothing listens on")
+    parser.add_argument("--workers", type=int, default=WebhookDelivery.WORKERS)
+    parser.add_argument("--delay", type=float, default=0.0, help="Seconds the stand-in takes to answer")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="The chance of the stand-in answering with a 503")
+    parser.add_argument("--backoff", type=float, default=0.1, help="Seconds before the first retry")
+    parser.add_argument("--max-attempts", type=int, default=WebhookDelivery.MAX_ATTEMPTS)
+    parser.add_argument("--timeout", type=float, default=30.0, help="Seconds to wait for the deliveries to settle")
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.ERROR)
+    mongoengine.connect("talus", host=args.db)
+    models.Webhook.objects(type="job").delete()
+
+    server = WebhookStandIn(delay=args.delay, failure_rate=args.failure_rate)
+    server.start()
+    for x in range(args.hooks):
+        models.Webhook(type="job", url=server.url, auth_string="bench-{}".format(x)).save()
+    dead_url = "http://127.0.0.1:{}/hook".format(_unused_port())
+    for _ in range(args.dead_hooks):
+        models.Webhook(type="job", url=dead_url).save()
+
+    delivery = WebhookDelivery(workers=args.workers)
+    delivery.BACKOFF = args.backoff
+    delivery.MAX_ATTEMPTS = args.max_attempts
+    delivery.start()
+
+    job = models.Job(name="bench-webhooks", params={"padding": "x" * 1024}, status={"name": "running"})
+
+    start = time.time()
+    trigger_time = 0.0
+    for x in range(args.events):
+        if args.rate > 0:
+            delay = start + x / args.rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        trigger_start = time.time()
+        delivery.trigger("job", "running", job)
+        trigger_time += time.time() - trigger_start
+
+    expected = args.events * (args.hooks + args.dead_hooks)
+    deadline = time.time() + args.timeout
+    while time.time() < deadline:
+        counts = delivery.stats()["counts"]
+        if counts.get("delivered", 0) + counts.get("dead", 0) + counts.get("dropped", 0) >= expected:
+            break
+        time.sleep(0.05)
+    elapsed = time.time() - start
+
+    stats = delivery.stats()
+    delivery.stop()
+    server.stop()
+
+    counts = stats["counts"]
+    print(tabulate.tabulate([[
+        expected,
+        counts.get("delivered", 0),
+        round(counts.get("delivered", 0) / elapsed, 1),
+        counts.get("retries", 0),
+        counts.get("dead", 0),
+        counts.get("dropped", 0),
+        counts.get("connections", 0),
+        server.connections,
+        round(trigger_time / max(1, args.events) * 1000, 3),
+        stats["latency"]["p50"],
+        stats["latency"]["p99"],
+        stats["attempt_time"]["p99"],
+    ]], headers=["deliveries", "delivered", "delivered/s", "retries", "dead", "dropped", "connections",
+                 "server conns", "trigger ms", "latency p50", "latency p99", "attempt p99"]))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
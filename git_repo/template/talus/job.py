@@ -175,17 +175,19 @@ class PyClass(object):
 class Job(object):
     """This is the class that will run a task."""
 
-    def __init__(self, id, idx, params, tool, fileset_id, progress_callback, results_callback):
+    def __init__(self, id, idx, params, tool, fileset_id, progress_callback, results_callback, count=1):
         """TODO: to be defined1.
 
-        :idx: TODO
+        :idx: The first index into the job to run the tool for
         :params: TODO
         :tool: TODO
         :fileset_id: The id of the default fileset that files should be added to
+        :count: The number of consecutive indices (starting at ``idx``) to run the tool for
 
         """
         self._id = id
         self._idx = idx
+        self._count = max(1, count or 1)
         self._params = params
         self._tool = tool
         self._fileset_id = fileset_id
@@ -210,17 +212,21 @@ class Job(object):
         try:
             tool_cls = self._get_tool_cls()
             real_params = self._convert_params(self._params, tool_cls)
-            tool = tool_cls(
-                idx=self._idx,
-                progress_cb=self._progress_callback,
-                results_cb=self._results_callback,
-                parent_log=self._log,
-                job=self
-            )
 
-            self._log.debug("RUNNING TOOL")
+            # the master may hand out a range of indices, which are run one
+            # after the other in this VM
+            for idx in xrange(self._idx, self._idx + self._count):
+                tool = tool_cls(
+                    idx=idx,
+                    progress_cb=self._progress_callback,
+                    results_cb=self._results_callback,
+                    parent_log=self._log,
+                    job=self
+                )
+
+                self._log.debug("RUNNING TOOL (idx {})".format(idx))
 
-            tool.run(**real_params)
+                tool.run(**real_params)
         except TalusError as e:
             self._log.error(e.message)
 
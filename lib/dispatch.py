@@ -0,0 +1,843 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Dispatching of database events to the watchers.
+
+Every watcher gets its own lane of worker threads. Events are partitioned
+within a lane by ``(namespace, document id)``, so that all events for a
+single document are handled in order by the same worker, while events for
+unrelated documents (and unrelated collections) are handled in parallel.
+
+Each lane is bounded (``WatcherBase.queue_size``). What happens when a lane is
+full is decided by the watcher's ``overflow`` policy:
+
+* ``block``    - the oplog reader waits until the lane has room again
+* ``coalesce`` - updates are merged into an update that is still queued for
+                 the same document, otherwise the reader waits
+* ``spill``    - events are appended to a journal on local disk and are
+                 queued again (in order) once the lane has room
+
+Watchers may also opt in to having their updates coalesced by setting
+``WatcherBase.coalesce_window``. Updates for a document are then held for
+that many seconds, and consecutive ``$set``/``$unset`` modifications that
+arrive in that window are merged into a single update.
+
+Watchers declare which operations (and for updates, which fields) they care
+about with ``WatcherBase.subscriptions``. Events no watcher is subscribed to
+are dropped before any watcher code is called, and the subscriptions of all
+watchers are turned into the filter used when querying the oplog.
+"""
+
+
+import bson
+import collections
+import heapq
+import logging
+import os
+import struct
+import threading
+import time
+
+from master.lib.metrics import Timings
+
+
+OVERFLOW_POLICIES = ["block", "coalesce", "spill"]
+
+# subscription operation names -> oplog operation codes
+OPLOG_OPS = {
+    "insert": "i",
+    "update": "u",
+    "delete": "d",
+}
+
+
+def mod_touches(mod, path):
+    """Return True if the modification ``mod`` changes the field ``path``
+    (e.g. ``status.name``) or any of its parents or children.
+    """
+    if not any(k.startswith("$") for k in mod.keys()):
+        # the entire document was replaced
+        return True
+
+    for op_name, fields in mod.iteritems():
+        if not op_name.startswith("$") or not isinstance(fields, dict):
+            continue
+        for key in fields.keys():
+            if key == path or key.startswith(path + ".") or path.startswith(key + "."):
+                return True
+
+    return False
+
+
+def merge_modifications(first, second, distinct=None):
+    """Merge two consecutive modifications of the same document into a
+    single modification. Only ``$set`` and ``$unset`` modifications can
+    be merged.
+
+    :first: The earlier modification
+    :second: The later modification
+    :distinct: Field paths whose every change must be seen. Modifications
+        that both change one of these fields will not be merged.
+    :returns: The merged modification, or None if they can't be merged
+    """
+    for mod in [first, second]:
+        for op_name in mod.keys():
+            if op_name not in ["$set", "$unset", "$v"]:
+                return None
+
+    for path in (distinct or []):
+        if mod_touches(first, path) and mod_touches(second, path):
+            return None
+
+    merged = {
+        "$set": dict(first.get("$set", {})),
+        "$unset": dict(first.get("$unset", {})),
+    }
+
+    for op_name in ["$set", "$unset"]:
+        for path, val in second.get(op_name, {}).iteritems():
+            for existing in list(merged["$set"]) + list(merged["$unset"]):
+                # e.g. status.name was set first, now status is being set
+                if existing == path or existing.startswith(path + "."):
+                    merged["$set"].pop(existing, None)
+                    merged["$unset"].pop(existing, None)
+
+                # e.g. status was set first, now status.name is being set.
+                # Let the watcher see both.
+                elif path.startswith(existing + "."):
+                    return None
+
+            merged[op_name][path] = val
+
+    for op_name in ["$set", "$unset"]:
+        if len(merged[op_name]) == 0:
+            del merged[op_name]
+    if "$v" in second:
+        merged["$v"] = second["$v"]
+
+    return merged
+
+
+class SpillJournal(object):
+    """An append-only FIFO of BSON documents on local disk. Records that
+    were not read before the master stopped will be read again the next
+    time the journal is opened.
+    """
+
+    def __init__(self, path):
+        """Open (or create) the journal at ``path``
+        """
+        self.path = path
+
+        dirname = os.path.dirname(path)
+        if dirname != "" and not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        self._file = open(path, "a+b")
+        self._read_pos = 0
+        self._count = 0
+
+        # count any records left over from the last run
+        self._file.seek(0)
+        while True:
+            header = self._file.read(4)
+            if len(header) < 4:
+                break
+            size = struct.unpack("<i", header)[0]
+            self._file.seek(size - 4, os.SEEK_CUR)
+            self._count += 1
+
+    def __len__(self):
+        return self._count
+
+    def append(self, record):
+        """Append the dict ``record`` to the journal
+        """
+        self._file.seek(0, os.SEEK_END)
+        self._file.write(bson.BSON.encode(record))
+        self._file.flush()
+        self._count += 1
+
+    def pop(self):
+        """Remove and return the oldest record in the journal
+        """
+        if self._count == 0:
+            return None
+
+        self._file.seek(self._read_pos)
+        size = struct.unpack("<i", self._file.read(4))[0]
+        self._file.seek(self._read_pos)
+        data = self._file.read(size)
+        self._read_pos += size
+        self._count -= 1
+
+        # everything has been read, start over
+        if self._count == 0:
+            self._file.truncate(0)
+            self._read_pos = 0
+
+        return bson.BSON(data).decode()
+
+    def clear(self):
+        """Remove every record from the journal
+        """
+        self._file.truncate(0)
+        self._read_pos = 0
+        self._count = 0
+
+    def close(self):
+        self._file.close()
+
+
+class Partition(threading.Thread):
+    """A single worker thread with its own FIFO of pending work.
+    """
+
+    def __init__(self, name, log):
+        """Create a new partition
+
+        :name: The name of the worker thread
+        :log: The logger to log exceptions to
+        """
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+
+        self._log = log
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._running = True
+
+        # the time the work item currently being handled was queued at
+        self._current = None
+        self._processed = 0
+        self._errors = 0
+
+    def put(self, fn, *args):
+        """Queue ``fn(*args)`` to be called on this partition's thread
+        """
+        with self._cond:
+            self._queue.append((time.time(), fn, args))
+            self._cond.notify()
+
+    def stop(self):
+        """Stop the partition once all queued work has been handled
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+
+    def stats(self):
+        """Return the queue depth and lag (in seconds) of this partition
+        """
+        with self._cond:
+            oldest = self._current
+            if oldest is None and len(self._queue) > 0:
+                oldest = self._queue[0][0]
+
+            return dict(
+                name      = self.name,
+                depth     = len(self._queue) + (0 if self._current is None else 1),
+                lag       = 0.0 if oldest is None else round(time.time() - oldest, 3),
+                processed = self._processed,
+                errors    = self._errors,
+            )
+
+    def run(self):
+        while True:
+            with self._cond:
+                while self._running and len(self._queue) == 0:
+                    self._cond.wait()
+
+                # only empty here if we've been stopped
+                if len(self._queue) == 0:
+                    return
+
+                queued_at, fn, args = self._queue.popleft()
+                self._current = queued_at
+
+            try:
+                fn(*args)
+            except Exception:
+                self._errors += 1
+                self._log.exception("unhandled error in {}".format(self.name))
+
+            with self._cond:
+                self._current = None
+                self._processed += 1
+
+
+class KeyedExecutor(object):
+    """A fixed pool of :any:`Partition` workers. Work submitted with the same
+    key is always handled by the same worker, in the order it was submitted.
+    """
+
+    def __init__(self, name, workers, parent_log):
+        """Create a new keyed executor
+
+        :name: The name of the executor, used to name the worker threads
+        :workers: The number of worker threads
+        :parent_log: The parent logger
+        """
+        self._log = parent_log.getChild(name)
+        self._partitions = [
+            Partition("{}-{}".format(name, x), self._log)
+            for x in range(max(1, workers))
+        ]
+
+    def start(self):
+        for partition in self._partitions:
+            partition.start()
+
+    def stop(self):
+        """Stop all workers, waiting for the queued work to be handled
+        """
+        for partition in self._partitions:
+            partition.stop()
+        for partition in self._partitions:
+            if partition.is_alive():
+                partition.join()
+
+    def submit(self, key, fn, *args):
+        """Queue ``fn(*args)`` on the worker responsible for ``key``
+        """
+        self._partitions[hash(key) % len(self._partitions)].put(fn, *args)
+
+    def stats(self):
+        return [partition.stats() for partition in self._partitions]
+
+
+class Watermark(object):
+    """Tracks the oplog timestamps of the events that are still being
+    handled, to know which point in the oplog it is safe to resume from.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # { (<time>, <inc>): <count>, ... }
+        self._in_flight = {}
+        self._heap = []
+        self._last_seen = None
+
+    def add(self, ts):
+        """Mark the event with oplog timestamp ``ts`` as being handled
+        """
+        if ts is None:
+            return
+        key = (ts.time, ts.inc)
+        with self._lock:
+            if key not in self._in_flight:
+                self._in_flight[key] = 0
+                heapq.heappush(self._heap, key)
+            self._in_flight[key] += 1
+
+    def done(self, ts):
+        """Mark (one of) the events with oplog timestamp ``ts`` as handled
+        """
+        if ts is None:
+            return
+        key = (ts.time, ts.inc)
+        with self._lock:
+            # e.g. a spilled event from before a restart that wasn't added
+            if key not in self._in_flight:
+                return
+            self._in_flight[key] -= 1
+            if self._in_flight[key] == 0:
+                del self._in_flight[key]
+
+    def seen(self, ts):
+        """Record that every oplog entry up to and including ``ts`` has been
+        read (and dispatched, if needed)
+        """
+        with self._lock:
+            self._last_seen = (ts.time, ts.inc)
+
+    def safe_ts(self):
+        """Return the newest oplog timestamp for which it and every entry
+        before it have been handled, or None if nothing has been read yet.
+        """
+        with self._lock:
+            while len(self._heap) > 0 and self._heap[0] not in self._in_flight:
+                heapq.heappop(self._heap)
+
+            if len(self._heap) == 0:
+                if self._last_seen is None:
+                    return None
+                return bson.timestamp.Timestamp(*self._last_seen)
+
+            # the timestamp just before the oldest one still in flight
+            time_, inc = self._heap[0]
+            if inc > 0:
+                return bson.timestamp.Timestamp(time_, inc - 1)
+            return bson.timestamp.Timestamp(time_ - 1, 0xffffffff)
+
+    def in_flight(self):
+        with self._lock:
+            return sum(self._in_flight.values())
+
+
+class Event(object):
+    """A single queued database event
+    """
+
+    def __init__(self, op, id_, data, tss=None, queued_at=None):
+        self.op = op
+        self.id = id_
+        self.data = data
+        # the oplog timestamps of every event merged into this one
+        self.tss = list(tss or [])
+        self.queued_at = queued_at or time.time()
+        self.started = False
+
+
+class Lane(object):
+    """The bounded queue of events for a single watcher.
+    """
+
+    def __init__(self, ns, watcher, parent_log, spill_dir=None, watermark=None, resume_spilled=True):
+        """Create a new lane for the watcher
+
+        :ns: The namespace (e.g. ``talus.job``) the watcher is watching
+        :watcher: The :any:`master.watchers.WatcherBase` instance
+        :parent_log: The parent logger
+        :spill_dir: The directory to create the spill journal in
+        :watermark: The :any:`Watermark` to report handled events to
+        :resume_spilled: If events spilled before the last shutdown are handled, else they are discarded
+        """
+        self.ns = ns
+        self.watcher = watcher
+        self._watermark = watermark or Watermark()
+        self._log = parent_log.getChild(watcher.__class__.__name__)
+        self._executor = KeyedExecutor(
+            watcher.__class__.__name__,
+            watcher.dispatch_workers,
+            parent_log
+        )
+
+        self.max_size = watcher.queue_size
+        self.overflow = watcher.overflow
+        if self.overflow not in OVERFLOW_POLICIES:
+            self._log.warn("unknown overflow policy {!r}, using 'block'".format(self.overflow))
+            self.overflow = "block"
+
+        self._journal = None
+        if self.overflow == "spill":
+            self._journal = SpillJournal(os.path.join(
+                spill_dir,
+                "{}.{}.journal".format(ns, watcher.__class__.__name__)
+            ))
+
+        # the number of events spilled before the last shutdown that haven't
+        # been queued yet, they are added to the watermark when they are
+        self._leftover = 0
+        if self._journal is not None and len(self._journal) > 0:
+            if resume_spilled:
+                self._leftover = len(self._journal)
+            else:
+                self._log.info("discarding {} events spilled before the last shutdown".format(len(self._journal)))
+                self._journal.clear()
+
+        self.coalesce_window = watcher.coalesce_window
+        self.coalesce_distinct = watcher.coalesce_distinct
+
+        # { <op>: None or [<field path>, ...], ... }
+        if watcher.subscriptions is None:
+            self.subscriptions = dict((op, None) for op in OPLOG_OPS.keys())
+        else:
+            self.subscriptions = dict(watcher.subscriptions)
+        self._filtered = 0
+
+        self._cond = threading.Condition()
+        self._running = False
+        self._pending = 0
+        # { <id>: <last queued update event>, ... }
+        self._queued_updates = {}
+
+        # updates being held for the coalesce window
+        # { <id>: <event>, ... }
+        self._held = {}
+        # [(<release time>, <seq>, <id>, <event>), ... ]
+        self._deadlines = []
+        self._seq = 0
+        self._flusher = None
+
+        # time from being queued until the watcher is done with the event,
+        # and the time the watcher takes to handle it
+        self._latency = Timings()
+        self._handle_time = Timings()
+
+        self._high_water = 0
+        self._blocked = 0
+        self._coalesced = 0
+        self._spilled = 0
+
+    def start(self):
+        self._running = True
+        self._executor.start()
+
+        if self.coalesce_window > 0:
+            self._flusher = threading.Thread(
+                target = self._release_held,
+                name   = "{}-coalesce".format(self.watcher.__class__.__name__)
+            )
+            self._flusher.daemon = True
+            self._flusher.start()
+
+        # queue events spilled before the last shutdown
+        with self._cond:
+            self._drain_journal()
+
+    def stop(self):
+        """Stop the lane once all queued, held, and spilled events have been
+        handled
+        """
+        with self._cond:
+            self._running = False
+            for id_ in list(self._held.keys()):
+                self._release(id_)
+            self._cond.notify_all()
+
+            while self._pending > 0:
+                self._cond.wait(1.0)
+
+        if self._flusher is not None:
+            self._flusher.join()
+        self._executor.stop()
+
+        if self._journal is not None:
+            self._journal.close()
+
+    def wants(self, op, data):
+        """Return True if the watcher is subscribed to the event
+        """
+        if op not in self.subscriptions:
+            return False
+
+        paths = self.subscriptions[op]
+        if op != "update" or paths is None:
+            return True
+
+        for path in paths:
+            if mod_touches(data, path):
+                return True
+
+        with self._cond:
+            self._filtered += 1
+        return False
+
+    def submit(self, op, id_, data=None, ts=None):
+        """Queue the event to be handled by the watcher. Depending on the
+        lane's overflow policy, this will block while the lane is full.
+
+        :op: One of ``insert``, ``update``, or ``delete``
+        :id_: The id of the affected document
+        :data: The inserted document or the modification
+        :ts: The oplog timestamp of the event
+        """
+        self._watermark.add(ts)
+        self._observe(op, id_, data, ts)
+
+        with self._cond:
+            # keep events in order once we've started spilling
+            if self._journal is not None and len(self._journal) > 0:
+                self._spill(op, id_, data, [ts])
+                return
+
+            blocked = False
+            while self._pending >= self.max_size:
+                if self.overflow == "coalesce" and op == "update" and self._coalesce(id_, data, ts):
+                    return
+                if self.overflow == "spill":
+                    self._spill(op, id_, data, [ts])
+                    return
+
+                if not blocked:
+                    blocked = True
+                    self._blocked += 1
+                self._cond.wait(1.0)
+
+            self._enqueue(op, id_, data, [ts])
+
+    def stats(self):
+        # the watcher takes its own locks
+        watcher_stats = self.watcher.stats()
+        with self._cond:
+            return dict(
+                ns         = self.ns,
+                watcher    = self.watcher.__class__.__name__,
+                overflow   = self.overflow,
+                max_size   = self.max_size,
+                pending    = self._pending,
+                high_water = self._high_water,
+                blocked    = self._blocked,
+                coalesced  = self._coalesced,
+                held       = len(self._held),
+                filtered   = self._filtered,
+                latency    = self._latency.stats(),
+                handling   = self._handle_time.stats(),
+                spilled    = self._spilled,
+                journal    = 0 if self._journal is None else len(self._journal),
+                partitions = self._executor.stats(),
+                handler    = watcher_stats,
+            )
+
+    # -----------------------
+
+    def _enqueue(self, op, id_, data, tss, queued_at=None):
+        """Queue the event on the executor, or hold it if it's an update and
+        the lane coalesces updates. Must be called with the lane's lock held.
+        """
+        if op == "update" and self.coalesce_window > 0 and id_ in self._held:
+            held = self._held[id_]
+            merged = merge_modifications(held.data, data, self.coalesce_distinct)
+            if merged is not None:
+                held.data = merged
+                held.tss.extend(tss)
+                self._coalesced += 1
+                return
+
+        # everything held for the document must be handled before this event
+        if id_ in self._held:
+            self._release(id_)
+
+        event = Event(op, id_, data, tss, queued_at)
+        self._pending += 1
+        self._high_water = max(self._high_water, self._pending)
+
+        if op == "update":
+            self._queued_updates[id_] = event
+        else:
+            # later updates must not be merged into updates queued before
+            # this event
+            self._queued_updates.pop(id_, None)
+
+        if op == "update" and self.coalesce_window > 0 and self._running:
+            self._held[id_] = event
+            self._seq += 1
+            heapq.heappush(self._deadlines, (time.time() + self.coalesce_window, self._seq, id_, event))
+            self._cond.notify_all()
+        else:
+            self._submit(event)
+
+    def _release(self, id_):
+        """Stop holding the update for ``id_`` and queue it on the executor.
+        Must be called with the lane's lock held.
+        """
+        event = self._held.pop(id_)
+        self._submit(event)
+
+    def _submit(self, event):
+        """Queue the event on the worker for its dispatch key
+        """
+        try:
+            key = self.watcher.dispatch_key(event.op, event.id, event.data)
+        except Exception:
+            self._log.exception("error getting the dispatch key of {} {}".format(event.op, event.id))
+            key = event.id
+        self._executor.submit((self.ns, key), self._handle, event)
+
+    def _release_held(self):
+        """Release held updates once their coalesce window has passed
+        """
+        with self._cond:
+            while self._running:
+                now = time.time()
+                while len(self._deadlines) > 0 and self._deadlines[0][0] <= now:
+                    _, _, id_, event = heapq.heappop(self._deadlines)
+                    # it may have already been released early
+                    if self._held.get(id_, None) is event:
+                        self._release(id_)
+
+                if len(self._deadlines) > 0:
+                    self._cond.wait(self._deadlines[0][0] - now)
+                else:
+                    self._cond.wait(1.0)
+
+            # anything still held was released when the lane was stopped
+            self._deadlines = []
+
+    def _coalesce(self, id_, mod, ts):
+        """Merge the modification into the update that's queued for ``id_``.
+        Must be called with the lane's lock held.
+
+        :returns: True if the modification was merged
+        """
+        event = self._queued_updates.get(id_, None)
+        if event is None or event.started:
+            return False
+
+        merged = merge_modifications(event.data, mod, self.coalesce_distinct)
+        if merged is None:
+            return False
+
+        event.data = merged
+        event.tss.append(ts)
+        self._coalesced += 1
+        return True
+
+    def _spill(self, op, id_, data, tss):
+        self._journal.append(dict(op=op, id=id_, data=data, tss=tss, queued_at=time.time()))
+        self._spilled += 1
+
+    def _drain_journal(self):
+        """Move spilled events back onto the executor while there's room.
+        Must be called with the lane's lock held.
+        """
+        if self._journal is None:
+            return
+
+        while len(self._journal) > 0 and self._pending < self.max_size:
+            record = self._journal.pop()
+            tss = record.get("tss", [None])
+            if self._leftover > 0:
+                # spilled before the last shutdown, and not read from the
+                # oplog again
+                self._leftover -= 1
+                for ts in tss:
+                    self._watermark.add(ts)
+                    self._observe(record["op"], record["id"], record["data"], ts)
+            self._enqueue(
+                record["op"],
+                record["id"],
+                record["data"],
+                tss,
+                record.get("queued_at", None)
+            )
+
+    def _observe(self, op, id_, data, ts):
+        try:
+            self.watcher.observe(op, id_, data, ts)
+        except Exception:
+            self._log.exception("error observing {} {}".format(op, id_))
+
+    def _handle(self, event):
+        with self._cond:
+            event.started = True
+            if self._queued_updates.get(event.id, None) is event:
+                del self._queued_updates[event.id]
+
+        start = time.time()
+        try:
+            if event.op == "delete":
+                self.watcher.delete(event.id)
+            else:
+                getattr(self.watcher, event.op)(event.id, event.data)
+        finally:
+            end = time.time()
+            self._handle_time.add(end - start)
+            self._latency.add(end - event.queued_at)
+
+            for ts in event.tss:
+                self._watermark.done(ts)
+
+            with self._cond:
+                self._pending -= 1
+                self._drain_journal()
+                self._cond.notify_all()
+
+
+class Dispatcher(object):
+    """Routes database events to the lanes of the watchers that are
+    watching the event's namespace.
+    """
+
+    def __init__(self, parent_log=None, spill_dir="/talus/data/master/spill", resume_spilled=True):
+        """Create a new dispatcher
+
+        :parent_log: The parent logger
+        :spill_dir: The directory lanes with the ``spill`` overflow policy
+            keep their journals in
+        :resume_spilled: If events spilled before the last shutdown are
+            handled. They should be discarded when the oplog is read again
+            from a checkpoint, which is from before them.
+        """
+        if parent_log is None:
+            self._log = logging.getLogger("DISPATCH")
+        else:
+            self._log = parent_log.getChild("DISPATCH")
+
+        self._spill_dir = spill_dir
+        self._resume_spilled = resume_spilled
+        self.watermark = Watermark()
+
+        # { <ns>: [lanes], ... }
+        self._lanes = {}
+        # { <ns>: { <op>: [lanes], ... }, ... }
+        self._index = {}
+        self._lanes_lock = threading.Lock()
+        self._started = False
+
+    def add_watcher(self, ns, watcher):
+        """Add a new watcher for the namespace ``ns``
+        """
+        lane = Lane(
+            ns,
+            watcher,
+            self._log,
+            spill_dir      = self._spill_dir,
+            watermark      = self.watermark,
+            resume_spilled = self._resume_spilled,
+        )
+        with self._lanes_lock:
+            self._lanes.setdefault(ns, []).append(lane)
+
+            # the index is replaced instead of modified so that dispatch()
+            # doesn't need to take the lock
+            index = dict((k, dict(v)) for k, v in self._index.iteritems())
+            ops = index.setdefault(ns, {})
+            for op in lane.subscriptions.keys():
+                ops[op] = ops.get(op, []) + [lane]
+            self._index = index
+
+            if self._started:
+                lane.start()
+
+    def start(self):
+        with self._lanes_lock:
+            self._started = True
+            for lane in self._all_lanes():
+                lane.start()
+
+    def stop(self):
+        """Stop all lanes, waiting for queued events to be handled
+        """
+        with self._lanes_lock:
+            for lane in self._all_lanes():
+                lane.stop()
+
+    def dispatch(self, ns, op, id_, data=None, ts=None):
+        """Dispatch a single event to all watchers of ``ns``. This may block
+        if a watcher's lane is full.
+
+        :ts: The oplog timestamp of the event, tracked by :any:`watermark`
+        """
+        for lane in self._index.get(ns, {}).get(op, []):
+            if lane.wants(op, data):
+                lane.submit(op, id_, data, ts)
+
+    def oplog_filter(self):
+        """Return a query that matches only the oplog entries at least one
+        watcher is subscribed to
+        """
+        clauses = []
+        for ns, ops in sorted(self._index.items()):
+            op_codes = sorted(OPLOG_OPS[op] for op in ops.keys() if op in OPLOG_OPS)
+            if len(op_codes) > 0:
+                clauses.append({"ns": ns, "op": {"$in": op_codes}})
+
+        if len(clauses) == 0:
+            # nothing is being watched
+            return {"ns": {"$in": []}}
+        return {"$or": clauses}
+
+    def stats(self):
+        """Return queue depth, high-water mark, and lag information for
+        every lane
+        """
+        with self._lanes_lock:
+            return [lane.stats() for lane in self._all_lanes()]
+
+    def _all_lanes(self):
+        for ns, lanes in self._lanes.iteritems():
+            for lane in lanes:
+                yield lane
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Suppression of the master's own writes as they come back through the oplog.
+
+Before the master modifies a document, the modification it is about to
+make is registered here. When the matching update is seen in the oplog it
+is recognized as an echo of the master's own write and is dropped before it
+is dispatched to any watcher.
+"""
+
+
+import datetime
+import threading
+import time
+
+
+EXPIRE_SECONDS = 60
+"""How long an expected echo is remembered. Writes that never show up in the
+oplog (e.g. they didn't change anything) are forgotten after this long.
+"""
+
+
+_lock = threading.Lock()
+# { (<ns>, <id>): [(<expire time>, <mod>), ...], ... }
+_expected = {}
+_stats = dict(expected=0, suppressed=0, expired=0)
+
+
+def expect(ns, id_, mod):
+    """Register a modification the master is about to make
+
+    :ns: The namespace of the document (e.g. ``talus.job``)
+    :id_: The id of the document
+    :mod: The modification (e.g. ``{"$set": {...}}``) that will be made
+    """
+    now = time.time()
+    with _lock:
+        _expected.setdefault((ns, id_), []).append((now + EXPIRE_SECONDS, mod))
+        _stats["expected"] += 1
+
+        # cleanup every now and then
+        if _stats["expected"] % 1000 == 0:
+            _expire(now)
+
+
+def is_echo(ns, id_, mod):
+    """Return True if the update is an echo of a write the master made. The
+    expected echo is forgotten once it's been seen.
+
+    :ns: The namespace of the update
+    :id_: The id of the updated document
+    :mod: The modification as seen in the oplog
+    """
+    key = (ns, id_)
+    with _lock:
+        if key not in _expected:
+            return False
+
+        now = time.time()
+        expected = _expected[key]
+        for idx, (expires, expected_mod) in enumerate(expected):
+            if expires < now:
+                continue
+            if _matches(expected_mod, mod):
+                del expected[idx]
+                if len(expected) == 0:
+                    del _expected[key]
+                _stats["suppressed"] += 1
+                return True
+
+        return False
+
+
+def forget(ns, id_, mod):
+    """Forget about a modification registered with :any:`expect` that was
+    not made after all (e.g. a conditional update that matched nothing)
+    """
+    key = (ns, id_)
+    with _lock:
+        expected = _expected.get(key, None)
+        if expected is None:
+            return
+        for idx, (_, expected_mod) in enumerate(expected):
+            if expected_mod is mod:
+                del expected[idx]
+                break
+        if len(expected) == 0:
+            del _expected[key]
+
+
+def save(doc):
+    """Save the mongoengine document ``doc``, registering the resulting
+    update as a write made by the master.
+    """
+    if doc.pk is not None:
+        updates, removals = doc._delta()
+        mod = {}
+        if updates:
+            mod["$set"] = updates
+        if removals:
+            mod["$unset"] = removals
+        if len(mod) > 0:
+            expect(namespace(doc), doc.pk, mod)
+
+    doc.save()
+
+
+def namespace(doc):
+    """Return the namespace (``<db>.<collection>``) of a mongoengine
+    document
+    """
+    return "{}.{}".format(doc._get_db().name, doc._get_collection_name())
+
+
+def stats():
+    with _lock:
+        res = dict(_stats)
+        res["pending"] = sum(len(v) for v in _expected.values())
+        return res
+
+
+# -----------------------
+
+
+def _expire(now):
+    for key in list(_expected.keys()):
+        remaining = [item for item in _expected[key] if item[0] >= now]
+        _stats["expired"] += len(_expected[key]) - len(remaining)
+        if len(remaining) == 0:
+            del _expected[key]
+        else:
+            _expected[key] = remaining
+
+
+def _matches(expected_mod, mod):
+    """Return True if every change in ``mod`` is one of the changes in the
+    expected modification
+    """
+    for op_name, fields in mod.items():
+        if op_name == "$v":
+            continue
+        if op_name not in expected_mod:
+            return False
+        for key, val in fields.items():
+            if key not in expected_mod[op_name]:
+                return False
+            if op_name == "$set" and not _same(expected_mod[op_name][key], val):
+                return False
+    return True
+
+
+def _same(expected, actual):
+    """Compare a value that was written with the value read back from the
+    oplog. BSON datetimes only have millisecond precision.
+    """
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        if set(expected.keys()) != set(actual.keys()):
+            return False
+        return all(_same(expected[k], actual[k]) for k in expected.keys())
+
+    if isinstance(expected, (list, tuple)) and isinstance(actual, (list, tuple)):
+        if len(expected) != len(actual):
+            return False
+        return all(_same(e, a) for e, a in zip(expected, actual))
+
+    if isinstance(expected, datetime.datetime) and isinstance(actual, datetime.datetime):
+        expected = expected.replace(microsecond=expected.microsecond // 1000 * 1000, tzinfo=None)
+        actual = actual.replace(microsecond=actual.microsecond // 1000 * 1000, tzinfo=None)
+
+    return expected == actual
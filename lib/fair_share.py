@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Weighted fair sharing of the slaves between groups of jobs. The group of a
+job comes from its tags (which identify the user or team). Every group has
+a configured share, and the usage of each group is the exponentially
+decayed VM-seconds (weighted by vm_cpu) its work units have run for.
+
+The configuration is read from ``/talus/data/master/fair_share.json`` (or
+``TALUS_FAIR_SHARE``), and is re-read when it changes:
+
+.. code-block:: json
+
+    {
+        "shares": {"fuzzing": 1, "triage": 3},
+        "default_share": 1,
+        "half_life": 3600
+    }
+
+The next job to place a work unit for is taken from the group with the
+lowest ``usage / share``, and within that group from the job with the
+highest priority. Both are indexed heaps, so picking a job and charging its
+group are O(log n).
+
+Usage is accrued lazily: a group is only charged for the time its work
+units ran since it last changed when it changes again, so placing or
+stopping a work unit only touches the heap entry of its own group. The keys
+of the groups that are both running and waiting to place work units are
+refreshed by :any:`FairShare.account` once per scheduling pass.
+"""
+
+
+import json
+import logging
+import math
+import os
+import time
+
+from master.lib.indexed_heap import IndexedHeap
+
+
+DEFAULT_GROUP = "default"
+
+
+class Group(object):
+    """The usage and pending jobs of a single group
+    """
+
+    def __init__(self, name, share):
+        self.name = name
+        self.share = share
+        # decayed VM-seconds, scaled by FairShare._scale(), up to accounted
+        self.usage = 0.0
+        self.accounted = time.time()
+        # the cpus of the work units currently placed for the group
+        self.running = 0
+        # the ids of the group's jobs with work units to place
+        self.jobs = IndexedHeap()
+
+
+class FairShare(object):
+    """Keeps track of the usage of every group, and which job should have a
+    work unit placed next
+    """
+
+    CONFIG_PATH = "/talus/data/master/fair_share.json"
+
+    def __init__(self, path=None, parent_log=None):
+        if parent_log is None:
+            self._log = logging.getLogger("FAIRSHARE")
+        else:
+            self._log = parent_log.getChild("FAIRSHARE")
+
+        if path is None:
+            path = os.environ.get("TALUS_FAIR_SHARE", self.CONFIG_PATH)
+        self._path = path
+        self._mtime = None
+
+        self._shares = {}
+        self._default_share = 1.0
+        self._half_life = 3600.0
+
+        # { <name>: <Group>, ... }
+        self._groups = {}
+        # the names of the groups with jobs to place, by usage / share
+        self._pending = IndexedHeap()
+        # { <job id>: <group name>, ... } of the jobs in the group heaps
+        self._job_groups = {}
+        # the names of the groups with work units placed
+        self._running = set()
+
+        # usage is kept multiplied by 2 ** ((t - _epoch) / half_life) so that
+        # decaying it doesn't require touching every group
+        self._epoch = time.time()
+
+        self.reload()
+
+    def reload(self):
+        """Re-read the configuration if it changed
+        """
+        try:
+            mtime = os.path.getmtime(self._path)
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        self._mtime = mtime
+
+        try:
+            with open(self._path, "r") as f:
+                config = json.loads(f.read())
+        except (IOError, ValueError) as e:
+            self._log.warn("could not read the fair share config {}: {}".format(self._path, e))
+            return
+
+        self._shares = dict((name, float(share)) for name, share in config.get("shares", {}).iteritems())
+        self._default_share = float(config.get("default_share", 1))
+        self._half_life = float(config.get("half_life", self._half_life))
+
+        now = time.time()
+        for group in self._groups.itervalues():
+            group.share = self._share_of(group.name)
+            self._update_key(group, now)
+        self._log.info("loaded fair shares: {}".format(self._shares))
+
+    def group_of(self, tags):
+        """Return the name of the group of a job with ``tags``. The first tag
+        that has a configured share is used, then the first tag.
+        """
+        tags = tags or []
+        for tag in tags:
+            if tag in self._shares:
+                return tag
+        if len(tags) > 0:
+            return tags[0]
+        return DEFAULT_GROUP
+
+    def push(self, group_name, job_id, priority):
+        """Add a job with work units to place
+        """
+        group = self._group(group_name)
+        group.jobs.push(job_id, priority)
+        self._job_groups[job_id] = group_name
+        self._update_key(group)
+
+    def remove(self, job_id):
+        """Remove a job from the jobs with work units to place
+        """
+        group_name = self._job_groups.pop(job_id, None)
+        if group_name is None:
+            return
+        group = self._groups[group_name]
+        group.jobs.remove(job_id)
+        self._update_key(group)
+
+    def update(self, job_id, priority):
+        """Change the priority of a job
+        """
+        group_name = self._job_groups.get(job_id, None)
+        if group_name is not None:
+            self._groups[group_name].jobs.update(job_id, priority)
+
+    def peek(self):
+        """Return the id of the job to place a work unit for next, or None
+        """
+        if len(self._pending) == 0:
+            return None
+        group_name, _ = self._pending.peek()
+        job_id, _ = self._groups[group_name].jobs.peek()
+        return job_id
+
+    def started(self, group_name, cpu):
+        """Charge the group for a newly placed work unit
+        """
+        group = self._group(group_name)
+        self._set_running(group, group.running + cpu)
+
+    def stopped(self, group_name, cpu):
+        group = self._groups.get(group_name, None)
+        if group is None:
+            return
+        self._set_running(group, max(0, group.running - cpu))
+
+    def account(self, now=None):
+        """Charge the groups that are running work units and have jobs to
+        place for the VM-seconds since they were last charged, so that
+        their order in the heap of groups is current
+        """
+        if now is None:
+            now = time.time()
+
+        # keep the scaled usages from growing without bound
+        if now - self._epoch > 32 * self._half_life:
+            self._rebase(now)
+
+        for name in self._running:
+            group = self._groups[name]
+            if len(group.jobs) > 0:
+                self._update_key(group, now)
+
+    def __contains__(self, job_id):
+        return job_id in self._job_groups
+
+    def __len__(self):
+        return len(self._job_groups)
+
+    def stats(self):
+        now = time.time()
+        scale = self._scale(now)
+        return [
+            dict(
+                group   = group.name,
+                share   = group.share,
+                usage   = round(self._usage(group, now) / scale, 1),
+                running = group.running,
+                pending = len(group.jobs),
+            )
+            for group in self._groups.itervalues()
+        ]
+
+    # -----------------------
+
+    def _share_of(self, name):
+        return max(self._shares.get(name, self._default_share), 0.001)
+
+    def _group(self, name):
+        group = self._groups.get(name, None)
+        if group is None:
+            group = self._groups[name] = Group(name, self._share_of(name))
+        return group
+
+    def _scale(self, now):
+        return 2.0 ** ((now - self._epoch) / self._half_life)
+
+    def _horizon(self):
+        """The mean lifetime of the decay
+        """
+        return self._half_life / math.log(2)
+
+    def _usage(self, group, now):
+        """Return the scaled usage of the group up to ``now``. Its work units
+        have been running since it was last charged, which adds the
+        integral of the scale over that time.
+        """
+        if group.running == 0 or now <= group.accounted:
+            return group.usage
+        return group.usage + group.running * self._horizon() * (self._scale(now) - self._scale(group.accounted))
+
+    def _charge(self, group, now):
+        group.usage = self._usage(group, now)
+        group.accounted = now
+
+    def _set_running(self, group, running):
+        now = time.time()
+        self._charge(group, now)
+        group.running = running
+        if running > 0:
+            self._running.add(group.name)
+        else:
+            self._running.discard(group.name)
+        self._update_key(group, now)
+
+    def _key(self, group):
+        # the running work units count as the usage they will add over the
+        # mean lifetime of the decay
+        usage = group.usage + group.running * self._horizon() * self._scale(group.accounted)
+        return usage / group.share
+
+    def _update_key(self, group, now=None):
+        if len(group.jobs) == 0:
+            self._pending.remove(group.name)
+        else:
+            self._charge(group, time.time() if now is None else now)
+            self._pending.push(group.name, self._key(group))
+
+    def _rebase(self, now):
+        scale = self._scale(now)
+        for group in self._groups.itervalues():
+            self._charge(group, now)
+        self._epoch = now
+        for group in self._groups.values():
+            group.usage /= scale
+            # forget groups that have nothing left
+            if group.running == 0 and len(group.jobs) == 0 and group.usage < 1.0:
+                del self._groups[group.name]
+                continue
+            self._update_key(group, now)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+A binary min-heap that also indexes its items by key, so that any item can
+be removed or have its priority changed in O(log n).
+"""
+
+
+class IndexedHeap(object):
+    """A min-heap of keys ordered by their priorities. Priorities can be
+    anything comparable (e.g. tuples).
+    """
+
+    def __init__(self):
+        # [(<priority>, <key>), ...]
+        self._heap = []
+        # { <key>: <position in the heap>, ... }
+        self._positions = {}
+
+    def push(self, key, priority):
+        """Add ``key`` with ``priority``, or change its priority if it is
+        already in the heap
+        """
+        if key in self._positions:
+            self.update(key, priority)
+            return
+
+        self._heap.append((priority, key))
+        self._positions[key] = len(self._heap) - 1
+        self._sift_up(len(self._heap) - 1)
+
+    def pop(self):
+        """Remove and return the ``(key, priority)`` with the lowest priority
+        """
+        if len(self._heap) == 0:
+            raise IndexError("pop from an empty heap")
+        priority, key = self._heap[0]
+        self._remove_at(0)
+        return key, priority
+
+    def peek(self):
+        """Return the ``(key, priority)`` with the lowest priority
+        """
+        if len(self._heap) == 0:
+            raise IndexError("peek at an empty heap")
+        priority, key = self._heap[0]
+        return key, priority
+
+    def remove(self, key):
+        """Remove ``key`` if it is in the heap
+        """
+        pos = self._positions.get(key, None)
+        if pos is not None:
+            self._remove_at(pos)
+
+    def update(self, key, priority):
+        """Change the priority of ``key``
+        """
+        pos = self._positions[key]
+        old, _ = self._heap[pos]
+        self._heap[pos] = (priority, key)
+        if priority < old:
+            self._sift_up(pos)
+        else:
+            self._sift_down(pos)
+
+    def priority(self, key):
+        return self._heap[self._positions[key]][0]
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def __len__(self):
+        return len(self._heap)
+
+    # -----------------------
+
+    def _remove_at(self, pos):
+        last = len(self._heap) - 1
+        _, key = self._heap[pos]
+        self._swap(pos, last)
+        self._heap.pop()
+        del self._positions[key]
+
+        if pos < len(self._heap):
+            self._sift_up(pos)
+            self._sift_down(pos)
+
+    def _swap(self, a, b):
+        self._heap[a], self._heap[b] = self._heap[b], self._heap[a]
+        self._positions[self._heap[a][1]] = a
+        self._positions[self._heap[b][1]] = b
+
+    def _sift_up(self, pos):
+        while pos > 0:
+            parent = (pos - 1) // 2
+            if self._heap[pos][0] < self._heap[parent][0]:
+                self._swap(pos, parent)
+                pos = parent
+            else:
+                break
+
+    def _sift_down(self, pos):
+        size = len(self._heap)
+        while True:
+            smallest = pos
+            for child in (2 * pos + 1, 2 * pos + 2):
+                if child < size and self._heap[child][0] < self._heap[smallest][0]:
+                    smallest = child
+            if smallest == pos:
+                break
+            self._swap(pos, smallest)
+            pos = smallest
@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Per-job aggregates kept up to date as results and progress arrive, so that
+the number of results of each type a job produced, and how fast it is
+progressing, can be read from a single small
+:any:`master.models.JobAggregate` document (whose id is the job's id)
+instead of counting ``talus.result``.
+
+Changes are buffered and written in one bulk upsert per flush. Counts are
+only ever changed with ``$inc``, so they add up no matter how the writes of
+several flushes interleave.
+
+Events may be handled more than once, e.g. when the oplog is read again from
+a checkpoint after a restart. Every result is claimed with a conditional
+update of its ``counted`` flag before it is counted, and the progress of a
+job is read from the job itself when it changes instead of adding up the
+increments, so that neither is counted twice.
+"""
+
+
+import bson
+import collections
+import datetime
+import logging
+import pymongo.errors
+import threading
+import time
+
+import master.models
+from master.lib.metrics import Timings
+
+
+def _type_key(type_):
+    """Return the key of a result type in the ``results`` counts, which may
+    not contain dots or start with a ``$``
+    """
+    return (type_ or "unknown").replace(".", "_").lstrip("$") or "unknown"
+
+
+class _Pending(object):
+    """The changes of a job's aggregate not written yet
+    """
+
+    def __init__(self):
+        # { <type key>: <count>, ... }
+        self.results = collections.Counter()
+        self.first_result = None
+        self.last_result = None
+        # the job's progress is read again by the next flush
+        self.progress_changed = False
+        # other fields to $set
+        self.fields = {}
+
+
+class _Rate(object):
+    """The progress rate of a job
+    """
+
+    def __init__(self, now):
+        self.since = now
+        self.progress = 0
+        # progress per second
+        self.rate = None
+        self.value = None
+
+
+class JobAggregates(object):
+    """Maintains the aggregates of every job
+    """
+
+    FLUSH_INTERVAL = 1.0
+    """Seconds between writes of the changed aggregates
+    """
+
+    RATE_INTERVAL = 5.0
+    """The least seconds the progress rate is measured over
+    """
+
+    RATE_ALPHA = 0.3
+    """The weight of the latest measurement in the progress rate
+    """
+
+    DONE_STATUSES = ["finished", "cancelled", "stopped"]
+    """Statuses after which the progress of a job isn't tracked anymore
+    """
+
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        """Return the singleton instance of the job aggregates
+        """
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, parent_log=None):
+        if parent_log is None:
+            self._log = logging.getLogger("JOB-AGGREGATES")
+        else:
+            self._log = parent_log.getChild("JOB-AGGREGATES")
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._running = threading.Event()
+        self._flusher = None
+
+        # { <job id>: _Pending, ... }
+        self._pending = {}
+        # { <job id>: _Rate, ... }
+        self._rates = {}
+
+        self._counts = collections.Counter()
+        self._flush_time = Timings()
+
+    def start(self):
+        """Start writing the changed aggregates in the background
+        """
+        self._running.set()
+        self._flusher = threading.Thread(target=self._run, name="JobAggregatesFlusher")
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def stop(self):
+        """Stop the background writer after writing any remaining changes
+        """
+        self._running.clear()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+
+    def add_result(self, job_id, result_id, type_, created=None):
+        """Count a new result of the job, unless it was already counted
+
+        :job_id: The id of the job
+        :result_id: The id of the result
+        :type_: The ``type`` of the result
+        :created: When the result was created, now by default
+        :returns: True if the result was counted
+        """
+        claimed = master.models.Result._get_collection().update(
+            {"_id": result_id, "counted": {"$ne": True}},
+            {"$set": {"counted": True}},
+        )
+        if claimed.get("n", 0) == 0:
+            with self._lock:
+                self._counts["already_counted"] += 1
+            return False
+
+        if created is None:
+            created = datetime.datetime.utcnow()
+        with self._lock:
+            pending = self._get_pending(job_id)
+            pending.results[_type_key(type_)] += 1
+            if pending.first_result is None or created < pending.first_result:
+                pending.first_result = created
+            if pending.last_result is None or created > pending.last_result:
+                pending.last_result = created
+            self._counts["results"] += 1
+        return True
+
+    def remove_result(self, job_id, type_):
+        """Stop counting a result of the job, e.g. one that was deleted by a
+        result processor
+        """
+        with self._lock:
+            self._get_pending(job_id).results[_type_key(type_)] -= 1
+            self._counts["removed_results"] += 1
+
+    def progress_changed(self, job_id):
+        """Record that the job's progress changed, the new progress is read
+        from the job by the next flush
+        """
+        with self._lock:
+            self._get_pending(job_id).progress_changed = True
+
+    def set_status(self, job_id, name):
+        """Record the job's new status
+        """
+        with self._lock:
+            pending = self._get_pending(job_id)
+            pending.fields["status"] = name
+            if name in self.DONE_STATUSES:
+                self._rates.pop(bson.ObjectId(str(job_id)), None)
+                pending.fields["progress_rate"] = 0.0
+
+    def remove(self, job_id):
+        """Delete the aggregate of a job that was deleted
+        """
+        job_id = bson.ObjectId(str(job_id))
+        with self._flush_lock:
+            with self._lock:
+                self._pending.pop(job_id, None)
+                self._rates.pop(job_id, None)
+            master.models.JobAggregate._get_collection().remove({"_id": job_id})
+
+    def flush(self):
+        """Write the changed aggregates in a single bulk upsert. Changes that
+        could not be written are kept and written by the next flush.
+
+        :returns: False if the write failed
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending = self._pending
+                self._pending = {}
+            if len(pending) == 0:
+                return True
+
+            start = time.time()
+            now = datetime.datetime.utcnow()
+            try:
+                self._read_progress(pending)
+                collection = master.models.JobAggregate._get_collection()
+                bulk = collection.initialize_unordered_bulk_op()
+                for job_id, changes in pending.iteritems():
+                    bulk.find({"_id": job_id}).upsert().update_one(self._to_update(changes, now))
+                bulk.execute()
+                self._counts["flushed"] += len(pending)
+                success = True
+            except pymongo.errors.PyMongoError as e:
+                self._counts["flush_errors"] += 1
+                self._log.warn("could not write job aggregates: {}".format(e))
+                self._requeue(pending)
+                success = False
+            except Exception:
+                self._counts["flush_errors"] += 1
+                self._log.exception("error writing job aggregates")
+                self._requeue(pending)
+                success = False
+
+            self._flush_time.add(time.time() - start)
+            return success
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                pending    = len(self._pending),
+                rates      = len(self._rates),
+                counts     = dict(self._counts),
+                flush_time = self._flush_time.stats(),
+            )
+
+    # -----------------------
+
+    def _get_pending(self, job_id):
+        job_id = bson.ObjectId(str(job_id))
+        pending = self._pending.get(job_id, None)
+        if pending is None:
+            pending = self._pending[job_id] = _Pending()
+        return pending
+
+    def _read_progress(self, pending):
+        """Read the progress of the jobs whose progress changed, and measure
+        their progress rates
+        """
+        job_ids = [job_id for job_id, changes in pending.iteritems() if changes.progress_changed]
+        if len(job_ids) == 0:
+            return
+
+        jobs = master.models.Job._get_collection().find(
+            {"_id": {"$in": job_ids}},
+            {"progress": 1},
+        )
+        now = time.time()
+        with self._lock:
+            for job in jobs:
+                changes = pending[job["_id"]]
+                value = job.get("progress", 0) or 0
+                changes.fields["progress"] = value
+                changes.progress_changed = False
+                rate = self._update_rate(job["_id"], value, now)
+                if rate is not None:
+                    changes.fields["progress_rate"] = rate
+
+    def _update_rate(self, job_id, value, now):
+        """Measure the job's progress rate, must be called with the lock held
+
+        :value: The job's current progress
+        :returns: The new rate, or None if it wasn't measured again
+        """
+        rate = self._rates.get(job_id, None)
+        if rate is None:
+            rate = self._rates[job_id] = _Rate(now)
+        if rate.value is not None:
+            rate.progress += value - rate.value
+        rate.value = value
+
+        elapsed = now - rate.since
+        if elapsed < self.RATE_INTERVAL:
+            return None
+        measured = rate.progress / elapsed
+        if rate.rate is None:
+            rate.rate = measured
+        else:
+            rate.rate = self.RATE_ALPHA * measured + (1 - self.RATE_ALPHA) * rate.rate
+        rate.since = now
+        rate.progress = 0
+        return rate.rate
+
+    def _to_update(self, changes, now):
+        inc = {}
+        set_ = dict(changes.fields)
+        set_["timestamps.modified"] = now
+        for key, count in changes.results.iteritems():
+            if count != 0:
+                inc["results." + key] = count
+                inc["result_count"] = inc.get("result_count", 0) + count
+        update = {"$set": set_}
+        if len(inc) > 0:
+            update["$inc"] = inc
+        if changes.first_result is not None:
+            update["$min"] = {"first_result": changes.first_result}
+        if changes.last_result is not None:
+            update["$max"] = {"last_result": changes.last_result}
+        return update
+
+    def _requeue(self, pending):
+        """Merge changes that could not be written into the ones made since
+        """
+        with self._lock:
+            for job_id, old in pending.iteritems():
+                new = self._pending.get(job_id, None)
+                if new is None:
+                    self._pending[job_id] = old
+                    continue
+                old.results.update(new.results)
+                for name in ["first_result", "last_result"]:
+                    values = [v for v in [getattr(old, name), getattr(new, name)] if v is not None]
+                    if len(values) > 0:
+                        setattr(old, name, (min if name == "first_result" else max)(values))
+                old.progress_changed = old.progress_changed or new.progress_changed
+                old.fields.update(new.fields)
+                self._pending[job_id] = old
+
+    def _run(self):
+        while self._running.is_set():
+            time.sleep(self.FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception:
+                self._log.exception("error writing job aggregates")
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+A bounded LRU cache of jobs, along with the Image and Task (and the Task's
+tool) they reference, so that handling a job's status doesn't cost a query
+for the job and another for every reference that is dereferenced.
+
+The cache is kept coherent from the oplog. Updates to ``talus.job`` are
+applied to the cached document (or drop it, if they can't be applied), and
+updates to ``talus.image`` and ``talus.task`` drop the cached image or task.
+The master's own writes never come back through the oplog, so jobs the
+master saves are written through with :any:`JobCache.put`.
+
+Every :any:`JobCache.get` returns a new :any:`master.models.Job`, so that
+threads never share a job document. The referenced Image and Task documents
+are shared and must not be modified.
+"""
+
+
+import collections
+import copy
+import logging
+import os
+import threading
+
+import bson
+
+import master.models
+
+
+def _ref_id(value):
+    """Return the id of a reference as stored in a raw document
+    """
+    if isinstance(value, bson.DBRef):
+        return value.id
+    if isinstance(value, dict):
+        return value.get("_id", None)
+    return value
+
+
+def apply_modification(doc, mod):
+    """Apply the update ``mod`` from the oplog to the raw document ``doc`` in
+    place. Only ``$set``, ``$unset`` and ``$inc`` can be applied.
+
+    :returns: False if ``mod`` could not be applied, ``doc`` may have been
+        partly modified
+    """
+    if not any(k.startswith("$") for k in mod.keys()):
+        # the entire document was replaced
+        doc.clear()
+        doc.update(copy.deepcopy(mod))
+        return True
+
+    for op_name, fields in mod.iteritems():
+        if op_name not in ["$set", "$unset", "$inc"] or not isinstance(fields, dict):
+            return False
+        for path, value in fields.iteritems():
+            parts = path.split(".")
+            parent = doc
+            for part in parts[:-1]:
+                parent = parent.setdefault(part, {})
+                if not isinstance(parent, dict):
+                    # e.g. an index into a list
+                    return False
+            name = parts[-1]
+            if op_name == "$set":
+                parent[name] = copy.deepcopy(value)
+            elif op_name == "$unset":
+                parent.pop(name, None)
+            else:
+                parent[name] = parent.get(name, 0) + value
+    return True
+
+
+class JobCache(object):
+    """Caches the jobs whose status is being handled
+    """
+
+    MAX_SIZE = 2000
+    """The most jobs kept, ``TALUS_JOB_CACHE_SIZE`` overrides it
+    """
+
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        """Return the singleton instance of the job cache
+        """
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, max_size=None, parent_log=None):
+        if parent_log is None:
+            self._log = logging.getLogger("JOB-CACHE")
+        else:
+            self._log = parent_log.getChild("JOB-CACHE")
+
+        if max_size is None:
+            max_size = int(os.environ.get("TALUS_JOB_CACHE_SIZE", self.MAX_SIZE))
+        self._max_size = max(1, max_size)
+
+        self._lock = threading.Lock()
+        # least recently used first
+        # { <job id>: <raw job document>, ... }
+        self._jobs = collections.OrderedDict()
+        # { <image id>: <Image>, ... }
+        self._images = {}
+        # { <task id>: <Task with its tool dereferenced>, ... }
+        self._tasks = {}
+        # the cached jobs that reference every image and task
+        # { <image id>: set([<job id>, ...]), ... }
+        self._image_jobs = collections.defaultdict(set)
+        # { <task id>: set([<job id>, ...]), ... }
+        self._task_jobs = collections.defaultdict(set)
+
+        # bumped whenever an image or task is dropped, so that ones loaded
+        # before that aren't cached
+        self._generation = 0
+
+        self._counts = collections.Counter()
+
+    def get(self, job_id):
+        """Return the job with its image and task dereferenced, or None if
+        it doesn't exist
+        """
+        job_id = bson.ObjectId(str(job_id))
+        with self._lock:
+            doc = self._jobs.pop(job_id, None)
+            if doc is not None:
+                self._jobs[job_id] = doc
+                doc = copy.deepcopy(doc)
+                image = self._images.get(_ref_id(doc.get("image", None)), None)
+                task = self._tasks.get(_ref_id(doc.get("task", None)), None)
+                self._counts["hits"] += 1
+            else:
+                self._counts["misses"] += 1
+            generation = self._generation
+
+        if doc is None:
+            job = master.models.Job.objects(id=job_id).first()
+            if job is None:
+                return None
+            self.put(job)
+            return job
+
+        job = master.models.Job._from_son(doc)
+        if image is not None:
+            job._data["image"] = image
+        if task is not None:
+            job._data["task"] = task
+        if image is None or task is None:
+            # dropped since the job was cached, only the missing one is
+            # loaded again
+            image, task = self._hydrate(job)
+            with self._lock:
+                self._counts["reference_misses"] += 1
+                self._put_refs(job_id, image, task, generation)
+        return job
+
+    def put(self, job):
+        """Add or replace a job, e.g. after the master saved it. Its image
+        and task are dereferenced if they aren't cached yet.
+
+        :job: The :any:`master.models.Job`
+        """
+        doc = job.to_mongo().to_dict()
+        with self._lock:
+            generation = self._generation
+        image, task = self._hydrate(job)
+        with self._lock:
+            self._store(job.id, doc)
+            self._put_refs(job.id, image, task, generation)
+
+    def apply(self, job_id, mod):
+        """Apply an update of the job from the oplog
+        """
+        job_id = bson.ObjectId(str(job_id))
+        with self._lock:
+            doc = self._jobs.get(job_id, None)
+            if doc is None:
+                return
+            image_id = _ref_id(doc.get("image", None))
+            task_id = _ref_id(doc.get("task", None))
+
+            if not apply_modification(doc, mod):
+                self._remove(job_id)
+                self._counts["invalidated"] += 1
+                return
+            self._counts["applied"] += 1
+
+            if _ref_id(doc.get("image", None)) != image_id or _ref_id(doc.get("task", None)) != task_id:
+                # references are looked up again on the next get
+                self._drop_refs(job_id, image_id, task_id)
+
+    def remove(self, job_id):
+        with self._lock:
+            self._remove(bson.ObjectId(str(job_id)))
+
+    def invalidate_image(self, image_id):
+        """Drop a cached image, it is loaded again when a job that references
+        it is next used
+        """
+        with self._lock:
+            self._generation += 1
+            if self._images.pop(bson.ObjectId(str(image_id)), None) is not None:
+                self._counts["image_invalidations"] += 1
+
+    def invalidate_task(self, task_id):
+        with self._lock:
+            self._generation += 1
+            if self._tasks.pop(bson.ObjectId(str(task_id)), None) is not None:
+                self._counts["task_invalidations"] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                jobs   = len(self._jobs),
+                images = len(self._images),
+                tasks  = len(self._tasks),
+                counts = dict(self._counts),
+            )
+
+    # -----------------------
+
+    def _hydrate(self, job):
+        """Return the job's image and task (with its tool) dereferenced
+        """
+        image = job.image
+        task = job.task
+        if task is not None:
+            # dereferenced into the task's own data
+            task.tool
+        return image, task
+
+    def _store(self, job_id, doc):
+        self._jobs.pop(job_id, None)
+        self._jobs[job_id] = doc
+        while len(self._jobs) > self._max_size:
+            old_id, _ = self._jobs.popitem(last=False)
+            self._remove(old_id)
+            self._counts["evicted"] += 1
+
+    def _put_refs(self, job_id, image, task, generation):
+        if job_id not in self._jobs:
+            return
+        # the references were loaded before an image or task was dropped,
+        # and may be stale
+        fresh = generation == self._generation
+        if image is not None:
+            if fresh or image.id in self._images:
+                self._images.setdefault(image.id, image)
+            self._image_jobs[image.id].add(job_id)
+        if task is not None:
+            if fresh or task.id in self._tasks:
+                self._tasks.setdefault(task.id, task)
+            self._task_jobs[task.id].add(job_id)
+
+    def _remove(self, job_id):
+        doc = self._jobs.pop(job_id, None)
+        if doc is not None:
+            self._drop_refs(job_id, _ref_id(doc.get("image", None)), _ref_id(doc.get("task", None)))
+
+    def _drop_refs(self, job_id, image_id, task_id):
+        """Forget that the job references the image and task, dropping them
+        once no cached job does
+        """
+        for refs, docs, ref_id in [(self._image_jobs, self._images, image_id), (self._task_jobs, self._tasks, task_id)]:
+            jobs = refs.get(ref_id, None)
+            if jobs is None:
+                continue
+            jobs.discard(job_id)
+            if len(jobs) == 0:
+                del refs[ref_id]
+                docs.pop(ref_id, None)
@@ -0,0 +1,457 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+An append-only store of the errors and logs of jobs.
+
+Slaves and the API push errors and logs onto ``Job.errors`` and
+``Job.logs``, which would otherwise grow without bound and be rewritten along
+with every other change to the job. The :any:`master.watchers.job.JobWatcher`
+hands every pushed entry to the :any:`JobLogStore`, which keeps it as a
+document of its own in the ``job_log_entry`` collection, indexed by
+``(job, ts, _id)``, and trims the job down to the number of errors and logs
+and the most recent ``TAIL`` of each. :any:`JobLogStore.read` pages through
+the entries of a job.
+
+Entries are buffered and written in batches, one bulk upsert for all of the
+entries and one update for every job they belong to. The id of an entry is
+made from the oplog timestamp of the update that pushed it (see
+:any:`entry_id`), so entries that are seen again when the oplog is read
+from a checkpoint are only stored and counted once.
+
+Entries older than ``TALUS_JOB_LOG_ROLLUP_AGE`` seconds (if set) are rolled
+up into compressed :any:`master.models.JobLogSegment` documents, which
+:any:`JobLogStore.read` reads through transparently. The rollup age should
+be well beyond how far back the oplog is read after a restart, since an
+entry that was rolled up is no longer recognized as already stored.
+"""
+
+
+import bson
+import collections
+import datetime
+import logging
+import os
+import pymongo
+import pymongo.errors
+import struct
+import threading
+import time
+import zlib
+
+import master.models
+from master.lib.metrics import Timings
+
+
+KINDS = {
+    "error" : ("errors", "error_count"),
+    "log"   : ("logs", "log_count"),
+}
+"""The kinds of entries, with the job fields that keep the most recent ones
+and their count
+"""
+
+
+def entry_id(ts, kind, index):
+    """Return the id of the ``index`` th entry of ``kind`` pushed by the
+    update at the oplog timestamp ``ts``. The ids sort like the timestamps.
+    """
+    kind_idx = sorted(KINDS.keys()).index(kind)
+    return bson.ObjectId(struct.pack(">IIB", ts.time, ts.inc, kind_idx) + struct.pack(">I", index)[1:])
+
+
+def _page_key(entry):
+    return (entry["ts"], entry["_id"])
+
+
+def pushed_entries(mod, field):
+    """Return the entries the update ``mod`` pushed onto the list ``field``
+    of a job. Pushes show up in the oplog as ``$set`` s of list indexes
+    (``{"$set": {"errors.3": {...}}}``), or as the ``$push`` itself.
+    """
+    entries = []
+    for path, value in mod.get("$set", {}).iteritems():
+        parts = path.split(".")
+        if len(parts) == 2 and parts[0] == field and parts[1].isdigit():
+            entries.append((int(parts[1]), value))
+    entries = [value for _, value in sorted(entries)]
+
+    pushed = mod.get("$push", {}).get(field, None)
+    if isinstance(pushed, dict) and "$each" in pushed:
+        entries.extend(pushed["$each"])
+    elif pushed is not None:
+        entries.append(pushed)
+    return [entry for entry in entries if isinstance(entry, dict)]
+
+
+class JobLogStore(object):
+    """Buffers and stores the errors and logs of jobs
+    """
+
+    TAIL = 20
+    """The number of most recent errors and logs kept on the job
+    """
+
+    FLUSH_INTERVAL = 1.0
+    """Seconds between writes of the buffered entries
+    """
+
+    BATCH_SIZE = 500
+    """Buffered entries that are written right away
+    """
+
+    MAX_PENDING = 100000
+    """The most buffered entries, the oldest are dropped if the database
+    can't keep up
+    """
+
+    ROLLUP_INTERVAL = 60
+    """Seconds between rollups of old entries
+    """
+
+    SEGMENT_SIZE = 1000
+    """The most entries in a segment
+    """
+
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        """Return the singleton instance of the job log store
+        """
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, rollup_age=None, parent_log=None):
+        """Create a new job log store
+
+        :rollup_age: Seconds after which entries are rolled up into segments, ``TALUS_JOB_LOG_ROLLUP_AGE`` by default. Entries are never rolled up if it is None.
+        """
+        if parent_log is None:
+            self._log = logging.getLogger("JOB-LOG")
+        else:
+            self._log = parent_log.getChild("JOB-LOG")
+
+        if rollup_age is None and os.environ.get("TALUS_JOB_LOG_ROLLUP_AGE", "") != "":
+            rollup_age = float(os.environ["TALUS_JOB_LOG_ROLLUP_AGE"])
+        self._rollup_age = rollup_age
+
+        self._lock = threading.Lock()
+        # only one write at a time, so that the entries of a job are written
+        # in order
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._running = threading.Event()
+        self._flusher = None
+
+        # [<raw JobLogEntry document>, ...]
+        self._pending = []
+        self._counts = collections.Counter()
+        self._flush_time = Timings()
+        self._rollup_time = Timings()
+        self._last_rollup = 0
+
+    def start(self):
+        """Start writing buffered entries and rolling up old ones in the
+        background
+        """
+        self._running.set()
+        self._flusher = threading.Thread(target=self._run, name="JobLogFlusher")
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def stop(self):
+        """Stop the background writer after writing any buffered entries
+        """
+        self._running.clear()
+        self._wake.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+
+    def append(self, job_id, kind, entry, ts=None, index=0):
+        """Buffer an error or log that was pushed onto the job, it is written
+        by the next :any:`flush`
+
+        :job_id: The id of the job
+        :kind: ``"error"`` or ``"log"``
+        :entry: The :any:`master.models.JobError` as a dict
+        :ts: The oplog timestamp of the update that pushed it. Entries
+            without one get a new id and the current time.
+        :index: The position of the entry among the entries of ``kind`` the update pushed
+        """
+        if kind not in KINDS:
+            raise ValueError("unknown job log kind {!r}".format(kind))
+
+        if ts is None:
+            id_ = bson.ObjectId()
+            when = datetime.datetime.utcnow()
+        else:
+            id_ = entry_id(ts, kind, index)
+            when = datetime.datetime.utcfromtimestamp(ts.time)
+
+        doc = {
+            "_id"       : id_,
+            "job"       : bson.ObjectId(str(job_id)),
+            "ts"        : when,
+            "kind"      : kind,
+            "message"   : entry.get("message", None),
+            "backtrace" : entry.get("backtrace", None),
+            "logs"      : list(entry.get("logs", None) or []),
+        }
+        with self._lock:
+            self._pending.append(doc)
+            self._counts["appended"] += 1
+            dropped = len(self._pending) - self.MAX_PENDING
+            if dropped > 0:
+                del self._pending[:dropped]
+                self._counts["dropped"] += dropped
+            full = len(self._pending) >= self.BATCH_SIZE
+        if full:
+            self._wake.set()
+
+    def flush(self):
+        """Write the buffered entries, and the counts of their jobs. Entries
+        that could not be written are kept and written by the next flush.
+
+        :returns: False if the entries could not be written
+        """
+        with self._flush_lock:
+            with self._lock:
+                entries = self._pending
+                self._pending = []
+            if len(entries) == 0:
+                return True
+
+            start = time.time()
+            try:
+                failed = self._write(entries)
+                self._counts["written"] += len(entries) - len(failed)
+                if len(failed) > 0:
+                    self._counts["flush_errors"] += 1
+                    self._requeue(failed)
+                success = len(failed) == 0
+            except pymongo.errors.PyMongoError as e:
+                self._counts["flush_errors"] += 1
+                self._log.warn("could not write job logs: {}".format(e))
+                self._requeue(entries)
+                success = False
+            except Exception:
+                self._counts["flush_errors"] += 1
+                self._log.exception("error writing job logs")
+                self._requeue(entries)
+                success = False
+
+            self._flush_time.add(time.time() - start)
+            return success
+
+    def read(self, job_id, kind=None, after=None, limit=100):
+        """Return a page of a job's entries, oldest first, including the ones
+        that were rolled up into segments
+
+        :job_id: The id of the job
+        :kind: Only return entries of this kind, all kinds by default
+        :after: The cursor returned with the previous page
+        :limit: The most entries returned
+        :returns: ``(<entries>, <cursor of the next page>)``, the cursor is None if there are no more entries
+        """
+        job_id = bson.ObjectId(str(job_id))
+        entries = []
+
+        segment_query = {"job": job_id}
+        if after is not None:
+            segment_query["last_ts"] = {"$gte": after[0]}
+        segments = master.models.JobLogSegment._get_collection().find(
+            segment_query,
+            sort=[("job", pymongo.ASCENDING), ("last_ts", pymongo.ASCENDING)],
+        )
+        for segment in segments:
+            for entry in self._decode(segment):
+                if kind is not None and entry["kind"] != kind:
+                    continue
+                if after is not None and _page_key(entry) <= after:
+                    continue
+                entries.append(entry)
+            if len(entries) > limit:
+                break
+
+        if len(entries) <= limit:
+            query = {"job": job_id}
+            if kind is not None:
+                query["kind"] = kind
+            if after is not None:
+                query["$or"] = [
+                    {"ts": {"$gt": after[0]}},
+                    {"ts": after[0], "_id": {"$gt": after[1]}},
+                ]
+            found = master.models.JobLogEntry._get_collection().find(
+                query,
+                sort=[("job", pymongo.ASCENDING), ("ts", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)],
+                limit=limit + 1 - len(entries),
+            )
+            entries += list(found)
+
+        # an entry may be in both while it is being rolled up
+        unique = dict((entry["_id"], entry) for entry in entries)
+        entries = sorted(unique.itervalues(), key=_page_key)
+
+        cursor = None
+        if len(entries) > limit:
+            entries = entries[:limit]
+            cursor = _page_key(entries[-1])
+        with self._lock:
+            self._counts["reads"] += 1
+        return entries, cursor
+
+    def rollup(self, now=None):
+        """Compress the entries older than the rollup age into segments
+
+        :returns: The number of entries rolled up
+        """
+        if self._rollup_age is None:
+            return 0
+        if now is None:
+            now = datetime.datetime.utcnow()
+        cutoff = now - datetime.timedelta(seconds=self._rollup_age)
+
+        start = time.time()
+        collection = master.models.JobLogEntry._get_collection()
+        total = 0
+        while True:
+            entries = list(collection.find(
+                {"ts": {"$lt": cutoff}},
+                sort=[("ts", pymongo.ASCENDING)],
+                limit=self.SEGMENT_SIZE * 10,
+            ))
+            if len(entries) == 0:
+                break
+
+            by_job = collections.OrderedDict()
+            for entry in sorted(entries, key=_page_key):
+                by_job.setdefault(entry["job"], []).append(entry)
+
+            segments = []
+            for job_id, job_entries in by_job.iteritems():
+                for i in xrange(0, len(job_entries), self.SEGMENT_SIZE):
+                    segments.append(self._encode(job_id, job_entries[i:i + self.SEGMENT_SIZE]))
+
+            # inserted before the entries are removed, read() drops the
+            # duplicates in between
+            master.models.JobLogSegment._get_collection().insert(segments)
+            collection.remove({"_id": {"$in": [entry["_id"] for entry in entries]}})
+
+            total += len(entries)
+            with self._lock:
+                self._counts["segments"] += len(segments)
+                self._counts["rolled_up"] += len(entries)
+
+        if total > 0:
+            self._rollup_time.add(time.time() - start)
+            self._log.debug("rolled up {} job log entries".format(total))
+        return total
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+            counts = dict(self._counts)
+        return dict(
+            pending     = pending,
+            counts      = counts,
+            flush_time  = self._flush_time.stats(),
+            rollup_time = self._rollup_time.stats(),
+        )
+
+    # -----------------------
+
+    def _write(self, entries):
+        """Upsert the entries, and count the ones that weren't stored yet on
+        their jobs
+
+        :returns: The entries that could not be written
+        """
+        bulk = master.models.JobLogEntry._get_collection().initialize_unordered_bulk_op()
+        for entry in entries:
+            fields = dict(entry)
+            id_ = fields.pop("_id")
+            bulk.find({"_id": id_}).upsert().update_one({"$setOnInsert": fields})
+
+        try:
+            result = bulk.execute()
+        except pymongo.errors.BulkWriteError as e:
+            result = e.details
+            self._log.warn("could not write {} job log entries".format(len(result.get("writeErrors", []))))
+        failed = [entries[error["index"]] for error in result.get("writeErrors", [])]
+        # entries that were already stored, e.g. seen again after a restart
+        new = [entries[upserted["index"]] for upserted in result.get("upserted", [])]
+        self._counts["duplicates"] += len(entries) - len(new) - len(failed)
+        if len(new) == 0:
+            return failed
+
+        # the entries are stored, so they aren't written again if only the
+        # jobs' counts can't be
+        try:
+            self._update_jobs(new)
+        except pymongo.errors.PyMongoError as e:
+            self._counts["job_update_errors"] += 1
+            self._log.warn("could not update the job log counts: {}".format(e))
+        return failed
+
+    def _update_jobs(self, entries):
+        """Count the entries on their jobs, and trim the jobs' lists of them
+        down to the most recent ``TAIL``
+        """
+        # { <job id>: Counter({<kind>: <count>, ...}), ... }
+        by_job = collections.OrderedDict()
+        for entry in entries:
+            by_job.setdefault(entry["job"], collections.Counter())[entry["kind"]] += 1
+
+        bulk = master.models.Job._get_collection().initialize_unordered_bulk_op()
+        for job_id, kinds in by_job.iteritems():
+            inc = {}
+            push = {}
+            for kind, count in kinds.iteritems():
+                list_field, count_field = KINDS[kind]
+                inc[count_field] = count
+                push[list_field] = {"$each": [], "$slice": -self.TAIL}
+            bulk.find({"_id": job_id}).update_one({"$inc": inc, "$push": push})
+        bulk.execute()
+
+    def _requeue(self, entries):
+        """Put entries that could not be written back in front of the ones
+        buffered since
+        """
+        with self._lock:
+            self._pending[0:0] = entries
+            dropped = len(self._pending) - self.MAX_PENDING
+            if dropped > 0:
+                del self._pending[:dropped]
+                self._counts["dropped"] += dropped
+
+    def _encode(self, job_id, entries):
+        return {
+            "job"      : job_id,
+            "first_ts" : entries[0]["ts"],
+            "last_ts"  : entries[-1]["ts"],
+            "count"    : len(entries),
+            "data"     : bson.Binary(zlib.compress(bson.BSON.encode({"entries": entries}))),
+        }
+
+    def _decode(self, segment):
+        return bson.BSON(zlib.decompress(segment["data"])).decode()["entries"]
+
+    def _run(self):
+        while self._running.is_set():
+            self._wake.wait(self.FLUSH_INTERVAL)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                self._log.exception("error writing job logs")
+
+            if self._rollup_age is not None and time.time() - self._last_rollup >= self.ROLLUP_INTERVAL:
+                self._last_rollup = time.time()
+                try:
+                    self.rollup()
+                except Exception:
+                    self._log.exception("error rolling up job logs")
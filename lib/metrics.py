@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Small helpers for keeping runtime metrics that end up in the stats of the
+master document.
+"""
+
+
+import collections
+import threading
+
+
+def percentile(values, pct):
+    """Return the ``pct`` (0-100) percentile of the already sorted ``values``
+    """
+    if len(values) == 0:
+        return 0.0
+    idx = int(round((len(values) - 1) * pct / 100.0))
+    return values[idx]
+
+
+class Timings(object):
+    """Keeps a count and total of durations, as well as the most recent
+    durations to calculate percentiles from.
+    """
+
+    def __init__(self, samples=1000):
+        """Create a new timings object
+
+        :samples: The number of recent durations to keep
+        """
+        self._lock = threading.Lock()
+        self._recent = collections.deque(maxlen=samples)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, duration):
+        """Record a duration (in seconds)
+        """
+        with self._lock:
+            self._recent.append(duration)
+            self.count += 1
+            self.total += duration
+
+    def stats(self):
+        """Return the count, mean, p50, p99, and max (over the recent
+        durations) in seconds
+        """
+        with self._lock:
+            recent = sorted(self._recent)
+            count = self.count
+            total = self.total
+
+        return dict(
+            count = count,
+            mean  = 0.0 if count == 0 else round(total / count, 6),
+            p50   = round(percentile(recent, 50), 6),
+            p99   = round(percentile(recent, 99), 6),
+            max   = round(recent[-1], 6) if len(recent) > 0 else 0.0,
+        )
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Capturing of the oplog events seen by the master, so that they can be
+replayed later (see ``master.bench.replay``).
+
+A capture file is a gzip-compressed stream of BSON documents, one per event:
+
+.. code-block:: text
+
+    {
+        "ns": "talus.job",
+        "ts": Timestamp(...),    # the oplog timestamp
+        "t":  1445379000.123,    # wall-clock time the event was seen at
+        "op": "u",               # i, u, or d
+        "id": ObjectId(...),
+        "o":  {...},             # the inserted document or the modification
+    }
+"""
+
+
+import bson
+import gzip
+import struct
+import threading
+import time
+
+
+class OplogRecorder(object):
+    """Writes oplog events to a capture file
+    """
+
+    def __init__(self, path):
+        """Create a new capture file at ``path``
+        """
+        self.path = path
+        self.count = 0
+        self._file = gzip.open(path, "wb")
+        self._lock = threading.Lock()
+
+    def record(self, ns, ts, op, id_, data=None):
+        """Record a single event
+
+        :ns: The namespace of the event
+        :ts: The oplog timestamp of the event
+        :op: The oplog operation (``i``, ``u``, or ``d``)
+        :id_: The id of the affected document
+        :data: The inserted document or the modification
+        """
+        doc = dict(ns=ns, ts=ts, t=time.time(), op=op, id=id_)
+        if data is not None:
+            doc["o"] = data
+
+        encoded = bson.BSON.encode(doc)
+        with self._lock:
+            self._file.write(encoded)
+            self.count += 1
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read_capture(path):
+    """Yield every event (as a dict) in the capture file at ``path``
+    """
+    f = gzip.open(path, "rb")
+    try:
+        while True:
+            header = f.read(4)
+            if len(header) < 4:
+                break
+            size = struct.unpack("<i", header)[0]
+            yield bson.BSON(header + f.read(size - 4)).decode()
+    finally:
+        f.close()
@@ -0,0 +1,1042 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+The master-side job scheduler. Every job is split into work units (ranges of
+``count`` consecutive indices starting at ``idx``, up to the job's
+``limit``) that are placed on slaves with a best-fit bin-packing heuristic
+and sent to the slave's own ``slaves_<uuid>`` queue as
+``{"type": "job", ...}`` messages.
+
+The number of indices in a work unit adapts to how long the job's indices
+take to run (a decayed average over its finished work units), so that short
+indices don't each pay the startup cost of a VM. Once a job has nothing left
+to place, work units that are running much longer than expected are
+duplicated onto another slave; whichever copy finishes first wins and the
+other one is preempted.
+
+The capacity of every slave comes from the :any:`master.lib.slaves.SlaveRegistry`,
+minus the work units that have been placed on it but that it has not
+reported as running yet.
+
+Slaves are shared between groups of jobs (by their tags) with weighted fair
+sharing, see :any:`master.lib.fair_share`. Within a group, jobs with work
+units left to place are ordered by ``Job.priority`` (highest first), then by
+the size of their work units (largest first), then by when they were
+submitted.
+
+Work units are preferably placed on slaves that have the job's image (by
+md5) cached. Images that are in demand are pre-warmed onto idle slaves with
+``{"type": "prewarm", ...}`` messages before they are needed. If preemption is
+enabled (``TALUS_PREEMPT_GAP``), a job that does not fit anywhere may stop
+the work units of jobs at least that many priority points below it. Those
+are sent a ``{"type": "preempt", ...}`` message and their work units are
+placed again later.
+
+Slaves may report how many of a work unit's indices (from its ``idx`` on)
+have finished as the ``done`` of its vm. Work units that are placed again
+only get the indices that haven't finished. The ranges of indices of a job
+that have finished are handed to the progress handlers whenever they change,
+and are skipped when the job is submitted again, e.g. after the master
+restarted.
+"""
+
+
+import collections
+import json
+import itertools
+import logging
+import os
+import threading
+import time
+
+from master.lib.amqp_man import AmqpManager
+from master.lib.fair_share import FairShare
+from master.lib.metrics import Timings
+
+
+def unit_key(job_id, idx):
+    return (str(job_id), idx)
+
+
+def add_range(ranges, start, end):
+    """Add the indices ``[start, end)`` to the sorted, non-overlapping list
+    of ``[<start>, <end>]`` ranges in place, merging the ranges they touch
+    """
+    if end <= start:
+        return
+    merged = []
+    for range_ in ranges:
+        if range_[1] < start or range_[0] > end:
+            merged.append(range_)
+        else:
+            start = min(start, range_[0])
+            end = max(end, range_[1])
+    merged.append([start, end])
+    merged.sort()
+    ranges[:] = merged
+
+
+class Placement(object):
+    """A work unit that was sent to a slave
+    """
+
+    def __init__(self, job_id, idx, slave, cpu, ram, started=False, count=1):
+        self.job_id = job_id
+        self.idx = idx
+        self.count = count
+        self.slave = slave
+        self.cpu = cpu
+        self.ram = ram
+        self.group = None
+        self.placed_at = time.time()
+        # set once the slave reports the unit in its running vms
+        self.started = started
+        self.started_at = self.placed_at if started else None
+        # the number of indices from idx on that the slave reported as done
+        self.done = 0
+
+    def start(self):
+        if not self.started:
+            self.started = True
+            self.started_at = time.time()
+
+    def report(self, vm):
+        """Update the work unit from the slave's ``vm`` running it
+        """
+        self.start()
+        done = vm.get("done", None) or 0
+        self.done = max(self.done, min(int(done), self.count))
+
+
+class JobState(object):
+    """The work units of a job that still need to be placed
+    """
+
+    _seq = itertools.count()
+
+    def __init__(self, job, skip=None):
+        """Create a new job state
+
+        :job: The :any:`master.models.Job`
+        :skip: ``[<start>, <end>]`` ranges of indices not to place, e.g.
+            because they have finished or are running already
+        """
+        self.id = str(job.id)
+        self.name = job.name
+        self.priority = job.priority
+        # the fair share group, see master.lib.fair_share
+        self.group = None
+        self.cpu = job.vm_cpu or 1
+        self.ram = job.vm_ram or 1024
+        self.image = str(job.image.id)
+        self.image_md5 = job.image.md5
+        self.limit = job.limit
+        self.next_idx = 0
+        # sorted [<start>, <end>] ranges of indices past next_idx not to place
+        self.skip = [list(range_) for range_ in skip or []]
+        self._skip_ahead()
+        # sorted [<start>, <end>] ranges of indices that have finished
+        self.done_ranges = []
+        # (<idx>, <count>) work units that have to be placed again
+        self.retry = collections.deque()
+        self.in_flight = 0
+        # decayed average of the seconds a single idx takes to run, None
+        # until a work unit of the job has finished
+        self.idx_time = None
+        self.submitted_at = time.time()
+        self.seq = next(JobState._seq)
+
+        self.msg = dict(
+            type    = "job",
+            job     = self.id,
+            tool    = job.task.tool.name,
+            params  = job.params,
+            image   = self.image,
+            image_md5 = self.image_md5,
+            network = job.network,
+            debug   = job.debug,
+            vm_max  = job.vm_max,
+            vm_cpu  = self.cpu,
+            vm_ram  = self.ram,
+        )
+
+    def has_work(self):
+        return len(self.retry) > 0 or self.next_idx < self.limit
+
+    def remaining(self):
+        """The number of indices that still have to be placed
+        """
+        skipped = sum(
+            max(0, min(end, self.limit) - max(start, self.next_idx))
+            for start, end in self.skip
+        )
+        return max(0, self.limit - self.next_idx - skipped) + sum(count for _, count in self.retry)
+
+    def take(self, count=1):
+        """Return the next work unit to place as ``(<idx>, <count>)``, with
+        at most ``count`` indices
+        """
+        if len(self.retry) > 0:
+            return self.retry.popleft()
+        idx = self.next_idx
+        count = min(count, self.limit - idx)
+        if len(self.skip) > 0:
+            count = min(count, self.skip[0][0] - idx)
+        count = max(1, count)
+        self.next_idx += count
+        self._skip_ahead()
+        return idx, count
+
+    def put_back(self, idx, count=1):
+        self.retry.append((idx, count))
+
+    def finish(self, idx, count):
+        """Record that ``count`` indices from ``idx`` on have finished
+        """
+        add_range(self.done_ranges, idx, idx + count)
+
+    def _skip_ahead(self):
+        """Move next_idx past the ranges of indices not to place
+        """
+        while len(self.skip) > 0 and self.skip[0][0] <= self.next_idx:
+            self.next_idx = max(self.next_idx, self.skip.pop(0)[1])
+
+    def finished(self, count, seconds, alpha):
+        """Account for a work unit of ``count`` indices that ran for
+        ``seconds``
+        """
+        per_idx = seconds / float(max(1, count))
+        if self.idx_time is None:
+            self.idx_time = per_idx
+        else:
+            self.idx_time += alpha * (per_idx - self.idx_time)
+
+    def heap_priority(self):
+        """The priority of the job in the heap of pending jobs, lowest first
+        """
+        return (-self.priority, -self.ram, -self.cpu, self.seq)
+
+
+class SlaveCapacity(object):
+    """The free resources of a slave during a scheduling pass
+    """
+
+    def __init__(self, slave, reserved_cpu=0, reserved_ram=0, reserved_vms=0, warming=()):
+        self.uuid = slave["uuid"]
+        self.hostname = slave["hostname"]
+        self.max_cpus = max(1, slave.get("max_cpus", None) or 1)
+        self.max_ram = max(1, slave.get("max_ram", None) or 1)
+        self.max_vms = slave.get("max_vms", None) or 1
+
+        self.cpu = self.max_cpus - (slave.get("used_cpus", None) or 0) - reserved_cpu
+        self.ram = self.max_ram - (slave.get("used_ram", None) or 0) - reserved_ram
+        self.vms = self.max_vms - (slave.get("running_vms", None) or 0) - reserved_vms
+
+        # the md5s of the images that are cached, or are being downloaded
+        self.images = set(slave.get("images", None) or [])
+        self.images.update(warming)
+
+    def fits(self, cpu, ram):
+        return self.vms >= 1 and self.cpu >= cpu and self.ram >= ram
+
+    def take(self, cpu, ram):
+        self.cpu -= cpu
+        self.ram -= ram
+        self.vms -= 1
+
+
+class Scheduler(object):
+    """Places the work units of running jobs on slaves
+    """
+
+    SCHEDULE_INTERVAL = 1.0
+    """Seconds between scheduling passes when nothing else wakes the
+    scheduler up
+    """
+
+    PLACEMENT_TIMEOUT = 60.0
+    """Seconds a slave has to report a placed work unit as running before it
+    is placed again
+    """
+
+    LOCALITY_BONUS = 1.0
+    """How much better a slave that has the image cached scores. The best-fit
+    score is the fraction of cpu plus the fraction of ram left over (0-2).
+    """
+
+    WARMING_TIMEOUT = 600.0
+    """Seconds a slave is expected to have an image after being sent work or
+    a pre-warm message for it, until it reports the image itself
+    """
+
+    PREWARM_COPIES = 2
+    """How many slaves should have each image that is in demand cached
+    """
+
+    PREWARM_PER_PASS = 2
+    """The most pre-warm messages sent in a single scheduling pass
+    """
+
+    IMAGE_DEMAND_HALF_LIFE = 600.0
+    """Seconds for the recent demand of an image to halve
+    """
+
+    CHUNK_SECONDS = 300.0
+    """How long a work unit should take to run, which decides how many
+    indices it gets once the time of the job's indices is known
+    """
+
+    MAX_CHUNK = 1000
+    """The most indices in a single work unit
+    """
+
+    CHUNK_ALPHA = 0.3
+    """The weight of the latest finished work unit in the average time of a
+    job's indices
+    """
+
+    STRAGGLER_FACTOR = 2.0
+    """How many times longer than expected a work unit has to be running
+    before it is duplicated on another slave
+    """
+
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        """Return the singleton instance of the scheduler
+        """
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, parent_log=None):
+        if parent_log is None:
+            self._log = logging.getLogger("SCHED")
+        else:
+            self._log = parent_log.getChild("SCHED")
+
+        self._amqp_man = AmqpManager.instance()
+        self._registry = None
+        self._done_handlers = []
+        self._progress_handlers = []
+
+        # preemption is disabled unless a priority gap is configured
+        gap = os.environ.get("TALUS_PREEMPT_GAP", None)
+        self.preempt_gap = None if gap is None else max(1, int(gap))
+
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+
+        # { <job id>: <JobState>, ... }
+        self._jobs = {}
+        # the jobs that have work units left to place
+        self._fair_share = FairShare(parent_log=self._log)
+        # { (<job id>, <idx>): <Placement>, ... }
+        self._placements = {}
+        # the duplicates of straggling work units, always on another slave
+        # than the placement with the same key
+        # { (<job id>, <idx>): <Placement>, ... }
+        self._duplicates = {}
+        # the keys of the placements and duplicates on every slave
+        # { <slave uuid>: set([(<job id>, <idx>), ...]), ... }
+        self._by_slave = collections.defaultdict(set)
+
+        # { <slave uuid>: { <image md5>: <time sent>, ... }, ... }
+        self._warming = collections.defaultdict(dict)
+        # { <image md5>: <decayed number of placed work units>, ... }
+        self._image_demand = collections.Counter()
+        # { <image md5>: <image id>, ... }
+        self._image_ids = {}
+        self._demand_decayed = time.time()
+        # the vms of all of the slaves in the last scheduling pass
+        self._total_vms = 0
+
+        # the jobs whose finished indices changed since the progress handlers
+        # were last called
+        # { <job id>: <JobState>, ... }
+        self._progressed = {}
+
+        self._pass_time = Timings()
+        self._decisions = collections.deque(maxlen=20)
+        self._utilisation = {}
+        self._counts = collections.Counter()
+
+    def attach(self, registry):
+        """Use the slaves in the ``registry`` to place work units on
+
+        :registry: The :any:`master.lib.slaves.SlaveRegistry`
+        """
+        self._registry = registry
+        registry.add_status_handler(self._on_slave_status)
+        registry.add_lost_work_handler(self._on_slave_lost)
+
+    def add_done_handler(self, handler):
+        """Add a function to be called with the id of every job whose work
+        units have all been placed and have finished running
+
+        :handler: A function that takes ``(job_id)``
+        """
+        self._done_handlers.append(handler)
+
+    def add_progress_handler(self, handler):
+        """Add a function to be called with the ranges of the indices of a
+        job that have finished whenever they change. The ranges are passed
+        back to :any:`submit` through the job's ``finished_idxs``.
+
+        :handler: A function that takes ``(job_id, [[<start>, <end>], ...])``
+        """
+        self._progress_handlers.append(handler)
+
+    def start(self):
+        with self._cond:
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name="Scheduler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+    def submit(self, job):
+        """Start placing the work units of the job. Indices in the job's
+        ``finished_idxs`` and work units the slaves already report as
+        running (e.g. after the master restarted) are not placed again.
+
+        :job: The :any:`master.models.Job`
+        """
+        job_id = str(job.id)
+        running = []
+        if self._registry is not None:
+            for slave in self._registry.snapshot():
+                for vm in slave.get("vms", None) or []:
+                    if str(vm.get("job", None)) == job_id and vm.get("idx", None) is not None:
+                        running.append((slave["uuid"], vm))
+
+        skip = []
+        for start, end in job.finished_idxs or []:
+            add_range(skip, start, end)
+        for _, vm in running:
+            add_range(skip, vm["idx"], vm["idx"] + (vm.get("count", None) or 1))
+        state = JobState(job, skip=skip)
+        for start, end in job.finished_idxs or []:
+            state.finish(start, end - start)
+
+        done = []
+        with self._cond:
+            if job_id in self._jobs:
+                return
+            state.group = self._fair_share.group_of(job.tags)
+            self._jobs[job_id] = state
+            for uuid, vm in running:
+                if unit_key(job_id, vm["idx"]) in self._placements:
+                    # a duplicate of a straggling work unit
+                    continue
+                placement = Placement(job_id, vm["idx"], uuid, state.cpu, state.ram, started=True, count=vm.get("count", None) or 1)
+                placement.report(vm)
+                self._add_placement(placement, state)
+            self._counts["submitted"] += 1
+            self._mark_pending(state)
+            self._check_done(state, done)
+            self._cond.notify()
+
+        self._log.info("scheduling job {} ({}) in group {}, {} of {} indices left to place".format(
+            job_id,
+            job.name,
+            state.group,
+            state.remaining(),
+            state.limit,
+        ))
+        self._call_done_handlers(done)
+
+    def remove(self, job_id):
+        """Stop placing the work units of the job
+        """
+        job_id = str(job_id)
+        with self._cond:
+            self._jobs.pop(job_id, None)
+            self._fair_share.remove(job_id)
+            for key in [key for key in self._placements if key[0] == job_id]:
+                self._remove_placement(key)
+
+    def set_priority(self, job_id, priority):
+        """Change the priority of a job that is being scheduled
+        """
+        with self._cond:
+            state = self._jobs.get(str(job_id), None)
+            if state is None:
+                return
+            state.priority = priority
+            if state.id in self._fair_share:
+                self._fair_share.update(state.id, state.heap_priority())
+
+    def schedule(self):
+        """Run a single scheduling pass, placing as many pending work units
+        as will fit
+
+        :returns: The number of work units that were placed
+        """
+        if self._registry is None:
+            return 0
+
+        start = time.time()
+        slaves = self._registry.snapshot()
+
+        sends = []
+        done = []
+        with self._cond:
+            self._fair_share.reload()
+            self._fair_share.account()
+            self._expire_placements(done)
+
+            self._expire_warming(slaves)
+
+            capacity = []
+            for slave in slaves:
+                reserved = [self._copy_on(key, slave["uuid"]) for key in self._by_slave.get(slave["uuid"], ())]
+                reserved = [p for p in reserved if not p.started]
+                capacity.append(SlaveCapacity(
+                    slave,
+                    reserved_cpu = sum(p.cpu for p in reserved),
+                    reserved_ram = sum(p.ram for p in reserved),
+                    reserved_vms = len(reserved),
+                    warming      = self._warming.get(slave["uuid"], {}).keys(),
+                ))
+
+            # work units are at most an even split of what's left of a job
+            # over all of the slaves' vms
+            self._total_vms = sum(slave.max_vms for slave in capacity)
+
+            # one work unit at a time, so that the groups are interleaved
+            placed = 0
+            deferred = []
+            while len(self._fair_share) > 0:
+                free_vms = sum(max(0, slave.vms) for slave in capacity)
+                if free_vms == 0 and self.preempt_gap is None:
+                    break
+
+                state = self._jobs[self._fair_share.peek()]
+                if free_vms > 0 and self._place_one(state, capacity, sends):
+                    placed += 1
+                elif self.preempt_gap is not None and self._preempt_one(state, capacity, sends, done):
+                    placed += 1
+                else:
+                    # try again in the next pass
+                    self._counts["unplaceable"] += 1
+                    deferred.append(state)
+                    self._fair_share.remove(state.id)
+                    continue
+
+                if not state.has_work():
+                    self._fair_share.remove(state.id)
+
+            for state in deferred:
+                self._mark_pending(state)
+
+            self._duplicate_stragglers(capacity, sends)
+            self._prewarm(capacity, sends)
+            self._update_utilisation(capacity)
+            progressed = self._take_progressed()
+
+        for uuid, msg in sends:
+            self._amqp_man.queue_msg(json.dumps(msg), "slaves_" + uuid)
+        self._call_progress_handlers(progressed)
+        self._call_done_handlers(done)
+
+        self._pass_time.add(time.time() - start)
+        return placed
+
+    def stats(self):
+        with self._cond:
+            pending = dict(
+                (state.id, state.remaining())
+                for state in self._jobs.itervalues()
+            )
+            return dict(
+                jobs        = len(self._jobs),
+                pending     = sum(pending.values()),
+                pending_jobs = len(self._fair_share),
+                groups      = self._fair_share.stats(),
+                preempt_gap = self.preempt_gap,
+                in_flight   = len(self._placements),
+                duplicates  = len(self._duplicates),
+                idx_time    = dict(
+                    (state.id, round(state.idx_time, 3))
+                    for state in self._jobs.itervalues() if state.idx_time is not None
+                ),
+                counts      = dict(self._counts),
+                utilisation = dict(self._utilisation),
+                pass_time   = self._pass_time.stats(),
+                decisions   = list(self._decisions),
+            )
+
+    # -----------------------
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._running:
+                    return
+                self._cond.wait(self.SCHEDULE_INTERVAL)
+                if not self._running:
+                    return
+            try:
+                self.schedule()
+            except Exception:
+                self._log.exception("error scheduling work units")
+
+    def _mark_pending(self, state):
+        """Put the job in the heap of pending jobs if it has work left to
+        place, must be called with the lock held
+        """
+        if state.has_work() and state.id not in self._fair_share:
+            self._fair_share.push(state.group, state.id, state.heap_priority())
+
+    def _place_one(self, state, capacity, sends):
+        """Place a work unit of the job on the slave it fits best on
+
+        :returns: False if it didn't fit anywhere
+        """
+        slave = self._best_fit(capacity, state.cpu, state.ram, state.image_md5)
+        if slave is None:
+            return False
+        self._place_unit(state, slave, sends)
+        return True
+
+    def _place_unit(self, state, slave, sends, preempted=0):
+        idx, count = state.take(self._chunk_size(state))
+        slave.take(state.cpu, state.ram)
+        self._add_placement(Placement(state.id, idx, slave.uuid, state.cpu, state.ram, count=count), state)
+        self._counts["placed"] += 1
+
+        sends.append((slave.uuid, dict(state.msg, idx=idx, count=count)))
+
+        cached = state.image_md5 is None or state.image_md5 in slave.images
+        self._counts["image_hits" if cached else "image_misses"] += 1
+        if state.image_md5 is not None:
+            self._image_demand[state.image_md5] += 1
+            self._image_ids[state.image_md5] = state.image
+            if not cached:
+                # the slave will download it for this work unit
+                slave.images.add(state.image_md5)
+                self._warming[slave.uuid][state.image_md5] = time.time()
+
+        self._decisions.append(dict(
+            job       = state.id,
+            idx       = idx,
+            count     = count,
+            group     = state.group,
+            priority  = state.priority,
+            slave     = slave.hostname,
+            free_cpu  = slave.cpu,
+            free_ram  = slave.ram,
+            preempted = preempted,
+            cached    = cached,
+            time      = time.time(),
+        ))
+
+    def _chunk_size(self, state):
+        """Return how many indices the next work unit of the job should
+        have. Until a work unit of the job has finished they have a single
+        index.
+        """
+        if state.idx_time is None:
+            return 1
+        size = int(self.CHUNK_SECONDS / max(state.idx_time, 0.001))
+        # leave enough work units for every vm near the end of the job
+        share = -(-state.remaining() // max(1, self._total_vms))
+        return max(1, min(size, share, self.MAX_CHUNK))
+
+    def _duplicate_stragglers(self, capacity, sends):
+        """Place a second copy of the work units of jobs that have nothing
+        left to place that are running ``STRAGGLER_FACTOR`` times longer
+        than their job's indices usually take
+        """
+        tail = set(
+            state.id for state in self._jobs.itervalues()
+            if not state.has_work() and state.in_flight > 0 and state.idx_time is not None
+        )
+        if len(tail) == 0:
+            return
+
+        now = time.time()
+        for key, placement in self._placements.items():
+            if key[0] not in tail or not placement.started or key in self._duplicates:
+                continue
+            state = self._jobs[placement.job_id]
+            expected = state.idx_time * placement.count
+            if now - placement.started_at < self.STRAGGLER_FACTOR * expected:
+                continue
+
+            slave = self._best_fit(capacity, state.cpu, state.ram, state.image_md5, exclude=placement.slave)
+            if slave is None:
+                return
+
+            self._log.info("job {} idx {} has been running for {:.1f}s on {} ({:.1f}s expected), duplicating it on {}".format(
+                placement.job_id,
+                placement.idx,
+                now - placement.started_at,
+                placement.slave,
+                expected,
+                slave.hostname,
+            ))
+            slave.take(state.cpu, state.ram)
+            duplicate = Placement(state.id, placement.idx, slave.uuid, state.cpu, state.ram, count=placement.count)
+            duplicate.group = state.group
+            self._duplicates[key] = duplicate
+            self._by_slave[slave.uuid].add(key)
+            self._fair_share.started(duplicate.group, duplicate.cpu)
+            self._counts["duplicated"] += 1
+            sends.append((slave.uuid, dict(state.msg, idx=placement.idx, count=placement.count)))
+
+    def _preempt_one(self, state, capacity, sends, done):
+        """Make room for a work unit of the job by preempting work units of
+        jobs at least ``preempt_gap`` priority points below it. The slave
+        that needs the fewest work units preempted is used.
+
+        :returns: False if no room could be made
+        """
+        max_victim_priority = state.priority - self.preempt_gap
+        best = None
+        best_victims = None
+        for slave in capacity:
+            victims = self._victims(slave, state.cpu, state.ram, max_victim_priority)
+            if victims is None:
+                continue
+            if best is None or len(victims) < len(best_victims):
+                best = slave
+                best_victims = victims
+        if best is None:
+            return False
+
+        for key in best_victims:
+            placement = self._placements[key]
+            self._log.info("preempting job {} idx {} on {} for job {}".format(
+                placement.job_id,
+                placement.idx,
+                best.hostname,
+                state.id,
+            ))
+            sends.append((best.uuid, dict(type="preempt", job=placement.job_id, idx=placement.idx)))
+            best.cpu += placement.cpu
+            best.ram += placement.ram
+            best.vms += 1
+            self._requeue(key, done)
+            self._counts["preempted"] += 1
+
+        self._place_unit(state, best, sends, preempted=len(best_victims))
+        return True
+
+    def _victims(self, slave, cpu, ram, max_priority):
+        """Return the keys of the work units on the slave that would have to
+        be preempted to fit a work unit, lowest priority and most recently
+        placed first, or None if it would not fit even then
+        """
+        candidates = []
+        for key in self._by_slave.get(slave.uuid, ()):
+            if key in self._duplicates:
+                # will be over soon either way
+                continue
+            placement = self._placements[key]
+            priority = self._jobs[placement.job_id].priority
+            if priority <= max_priority:
+                candidates.append((priority, -placement.placed_at, key))
+        candidates.sort()
+
+        free_cpu, free_ram, free_vms = slave.cpu, slave.ram, slave.vms
+        victims = []
+        for _, _, key in candidates:
+            if free_vms >= 1 and free_cpu >= cpu and free_ram >= ram:
+                break
+            placement = self._placements[key]
+            free_cpu += placement.cpu
+            free_ram += placement.ram
+            free_vms += 1
+            victims.append(key)
+
+        if free_vms >= 1 and free_cpu >= cpu and free_ram >= ram:
+            return victims
+        return None
+
+    def _best_fit(self, capacity, cpu, ram, image_md5=None, exclude=None):
+        """Return the slave the work unit fits on most tightly, preferring
+        slaves that have the image cached, or None
+        """
+        best = None
+        best_score = None
+        for slave in capacity:
+            if slave.uuid == exclude or not slave.fits(cpu, ram):
+                continue
+            # the fraction of the slave's resources that would be left over
+            score = float(slave.cpu - cpu) / slave.max_cpus + float(slave.ram - ram) / slave.max_ram
+            if image_md5 is not None and image_md5 in slave.images:
+                score -= self.LOCALITY_BONUS
+            if best is None or score < best_score:
+                best = slave
+                best_score = score
+        return best
+
+    def _image_popularity(self):
+        """Return the images in demand as ``[(<md5>, <demand>), ...]``, most
+        in demand first. Demand is the recently placed work units of the
+        image plus the work units still waiting to be placed.
+        """
+        now = time.time()
+        decay = 0.5 ** ((now - self._demand_decayed) / self.IMAGE_DEMAND_HALF_LIFE)
+        self._demand_decayed = now
+        for md5 in self._image_demand.keys():
+            self._image_demand[md5] *= decay
+            if self._image_demand[md5] < 0.01:
+                del self._image_demand[md5]
+
+        demand = collections.Counter(self._image_demand)
+        for state in self._jobs.itervalues():
+            if state.image_md5 is not None and state.has_work():
+                demand[state.image_md5] += state.remaining()
+                self._image_ids[state.image_md5] = state.image
+
+        return demand.most_common()
+
+    def _prewarm(self, capacity, sends):
+        """Have idle slaves download the images that are in demand ahead of
+        time, until ``PREWARM_COPIES`` slaves have each one
+        """
+        idle = [slave for slave in capacity if slave.vms >= slave.max_vms]
+        budget = self.PREWARM_PER_PASS
+        if len(idle) == 0 or budget <= 0:
+            return
+
+        for md5, demand in self._image_popularity():
+            copies = sum(1 for slave in capacity if md5 in slave.images)
+            for slave in [slave for slave in idle if md5 not in slave.images]:
+                if copies >= self.PREWARM_COPIES or budget == 0:
+                    break
+                sends.append((slave.uuid, dict(type="prewarm", image=self._image_ids[md5], image_md5=md5)))
+                slave.images.add(md5)
+                self._warming[slave.uuid][md5] = time.time()
+                self._counts["prewarmed"] += 1
+                copies += 1
+                budget -= 1
+            if budget == 0:
+                break
+
+    def _expire_warming(self, slaves):
+        """Forget about images slaves now report having, or that they should
+        have reported by now
+        """
+        cutoff = time.time() - self.WARMING_TIMEOUT
+        known = set()
+        for slave in slaves:
+            known.add(slave["uuid"])
+            warming = self._warming.get(slave["uuid"], None)
+            if warming is None:
+                continue
+            cached = set(slave.get("images", None) or [])
+            for md5, sent in warming.items():
+                if md5 in cached or sent < cutoff:
+                    del warming[md5]
+            if len(warming) == 0:
+                del self._warming[slave["uuid"]]
+
+        for uuid in self._warming.keys():
+            if uuid not in known:
+                del self._warming[uuid]
+
+    def _update_utilisation(self, capacity):
+        totals = collections.Counter()
+        for slave in capacity:
+            totals["max_cpus"] += slave.max_cpus
+            totals["max_ram"] += slave.max_ram
+            totals["max_vms"] += slave.max_vms
+            totals["used_cpus"] += slave.max_cpus - slave.cpu
+            totals["used_ram"] += slave.max_ram - slave.ram
+            totals["used_vms"] += slave.max_vms - slave.vms
+
+        self._utilisation = dict(
+            slaves = len(capacity),
+            cpu    = round(totals["used_cpus"] / float(max(1, totals["max_cpus"])), 3),
+            ram    = round(totals["used_ram"] / float(max(1, totals["max_ram"])), 3),
+            vms    = round(totals["used_vms"] / float(max(1, totals["max_vms"])), 3),
+        )
+
+    def _copy_on(self, key, uuid):
+        """Return the placement or duplicate of the work unit on the slave
+        """
+        placement = self._placements[key]
+        if placement.slave == uuid:
+            return placement
+        return self._duplicates[key]
+
+    def _add_placement(self, placement, state):
+        key = unit_key(placement.job_id, placement.idx)
+        placement.group = state.group
+        self._placements[key] = placement
+        self._by_slave[placement.slave].add(key)
+        self._fair_share.started(placement.group, placement.cpu)
+        state.in_flight += 1
+
+    def _remove_placement(self, key):
+        """Remove a work unit and its duplicate, if it has one
+        """
+        placement = self._placements.pop(key)
+        self._remove_copy(key, placement)
+        duplicate = self._duplicates.pop(key, None)
+        if duplicate is not None:
+            self._remove_copy(key, duplicate)
+
+        state = self._jobs.get(placement.job_id, None)
+        if state is not None:
+            state.in_flight -= 1
+        return placement, state
+
+    def _remove_copy(self, key, copy):
+        self._fair_share.stopped(copy.group, copy.cpu)
+        slave_keys = self._by_slave[copy.slave]
+        slave_keys.discard(key)
+        if len(slave_keys) == 0:
+            del self._by_slave[copy.slave]
+
+    def _drop_copy(self, key, uuid):
+        """Forget about the copy of a work unit on the slave
+
+        :returns: True if another copy of it is still placed on another slave
+        """
+        duplicate = self._duplicates.get(key, None)
+        if duplicate is None:
+            return False
+        if duplicate.slave != uuid:
+            # the duplicate takes the place of the original
+            self._placements[key], self._duplicates[key] = duplicate, self._placements[key]
+        self._remove_copy(key, self._duplicates.pop(key))
+        return True
+
+    def _finish(self, key, uuid, sends):
+        """The copy of the work unit on the slave finished. Its duplicate
+        on the other slave, if any, is preempted.
+        """
+        copy = self._copy_on(key, uuid)
+        duplicate = self._duplicates.get(key, None)
+        if duplicate is not None:
+            other = self._placements[key] if duplicate is copy else duplicate
+            sends.append((other.slave, dict(type="preempt", job=other.job_id, idx=other.idx)))
+            self._counts["duplicate_wins" if duplicate is copy else "original_wins"] += 1
+
+        _, state = self._remove_placement(key)
+        if state is not None:
+            if copy.started_at is not None:
+                state.finished(copy.count, time.time() - copy.started_at, self.CHUNK_ALPHA)
+            state.finish(copy.idx, copy.count)
+            self._progressed[state.id] = state
+        return state
+
+    def _requeue(self, key, done):
+        """Place the indices of the work unit that haven't finished again
+        later
+
+        :done: The list the ids of jobs that have finished are added to
+        """
+        duplicate = self._duplicates.get(key, None)
+        placement, state = self._remove_placement(key)
+        if state is None:
+            return
+        finished = max(placement.done, duplicate.done if duplicate is not None else 0)
+        if finished > 0:
+            state.finish(placement.idx, finished)
+            self._progressed[state.id] = state
+        if finished < placement.count:
+            state.put_back(placement.idx + finished, placement.count - finished)
+            self._mark_pending(state)
+            self._counts["requeued"] += 1
+        else:
+            self._check_done(state, done)
+
+    def _take_progressed(self):
+        """Return the finished ranges of the jobs that made progress as
+        ``[(<job id>, <ranges>), ...]``, must be called with the lock held
+        """
+        progressed = [(job_id, [list(r) for r in state.done_ranges]) for job_id, state in self._progressed.iteritems()]
+        self._progressed = {}
+        return progressed
+
+    def _call_progress_handlers(self, progressed):
+        for job_id, ranges in progressed:
+            for handler in self._progress_handlers:
+                try:
+                    handler(job_id, ranges)
+                except Exception:
+                    self._log.exception("error handling the progress of job {}".format(job_id))
+
+    def _expire_placements(self, done):
+        """Place work units again that a slave never started
+        """
+        cutoff = time.time() - self.PLACEMENT_TIMEOUT
+        for key, duplicate in self._duplicates.items():
+            if not duplicate.started and duplicate.placed_at < cutoff:
+                self._drop_copy(key, duplicate.slave)
+        for key, placement in self._placements.items():
+            if not placement.started and placement.placed_at < cutoff:
+                self._log.warn("slave {} never started job {} idx {}, placing it again".format(
+                    placement.slave,
+                    placement.job_id,
+                    placement.idx,
+                ))
+                self._requeue(key, done)
+
+    def _check_done(self, state, done):
+        if state is not None and not state.has_work() and state.in_flight == 0:
+            del self._jobs[state.id]
+            self._fair_share.remove(state.id)
+            self._counts["finished"] += 1
+            done.append(state.id)
+
+    def _call_done_handlers(self, done):
+        for job_id in done:
+            for handler in self._done_handlers:
+                try:
+                    handler(job_id)
+                except Exception:
+                    self._log.exception("error handling finished job {}".format(job_id))
+
+    def _on_slave_status(self, uuid, vms):
+        """Mark the work units the slave reports as started, and the ones it
+        no longer reports as finished
+        """
+        reported = dict((unit_key(vm.get("job", None), vm.get("idx", None)), vm) for vm in vms)
+
+        done = []
+        sends = []
+        with self._cond:
+            for key in list(self._by_slave.get(uuid, ())):
+                copy = self._copy_on(key, uuid)
+                if key in reported:
+                    copy.report(reported[key])
+                elif copy.started:
+                    state = self._finish(key, uuid, sends)
+                    self._check_done(state, done)
+            progressed = self._take_progressed()
+            self._cond.notify()
+
+        for slave_uuid, msg in sends:
+            self._amqp_man.queue_msg(json.dumps(msg), "slaves_" + slave_uuid)
+        self._call_progress_handlers(progressed)
+        self._call_done_handlers(done)
+
+    def _on_slave_lost(self, uuid, vms):
+        """Place the work units of a dead slave again
+        """
+        done = []
+        with self._cond:
+            for key in list(self._by_slave.get(uuid, ())):
+                # straggling work units live on if their other copy does
+                if not self._drop_copy(key, uuid):
+                    self._requeue(key, done)
+            progressed = self._take_progressed()
+            self._cond.notify()
+        self._call_progress_handlers(progressed)
+        self._call_done_handlers(done)
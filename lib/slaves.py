@@ -0,0 +1,462 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+The master's in-memory registry of slaves. Slave status messages only update
+the registry; the changed fields are written to the ``talus.slave``
+collection in the background, in batches.
+
+Slaves that have not sent a heartbeat or status for ``LIVENESS_TIMEOUT``
+seconds are considered dead. They are removed from the registry and the
+database, and the VMs they were last running are handed to the registered
+lost work handlers.
+
+Status messages that have a ``seq`` number are either a full snapshot
+(``"full": true``) or only contain the fields that changed since the
+previous message. Instead of the whole ``vms`` list, a delta may contain
+``vms_add`` and ``vms_remove`` lists; VMs are identified by their ``job``
+and ``idx``.
+"""
+
+
+import collections
+import datetime
+import logging
+import pymongo.errors
+import threading
+import time
+
+import master.models
+from master.lib.metrics import Timings
+from master.lib.timer_wheel import TimerWheel
+
+
+UPDATED = "updated"
+"""The status was applied
+"""
+UNKNOWN = "unknown"
+"""The slave is not in the registry
+"""
+STALE = "stale"
+"""The status delta was already applied, or is older than the last one
+"""
+GAP = "gap"
+"""Status deltas are missing, a full status is needed
+"""
+
+
+def vm_key(vm):
+    return (vm.get("job", None), vm.get("idx", None))
+
+
+def merge_vms(vms, added, removed):
+    """Return the ``vms`` list with the VMs in ``removed`` taken out and
+    those in ``added`` appended
+
+    :vms: The current list of VMs
+    :added: The list of new VMs
+    :removed: The list of VMs (at least their ``job`` and ``idx``) that are gone
+    """
+    removed = set(vm_key(vm) for vm in removed)
+    merged = [vm for vm in vms if vm_key(vm) not in removed]
+    merged.extend(added)
+    return merged
+
+
+class SlaveState(object):
+    """The in-memory state of a single slave
+    """
+
+    def __init__(self, id_, uuid, hostname, fields=None):
+        """Create a new slave state
+
+        :id_: The id of the slave's document in the database
+        :uuid: The uuid of the slave
+        :hostname: The hostname of the slave
+        :fields: The current values of the slave's fields
+        """
+        self.id = id_
+        self.uuid = uuid
+        self.hostname = hostname
+        self.fields = dict(fields or {})
+        # field names that changed since the last flush
+        self.dirty = set()
+        # the sequence number of the last status, None until a full status
+        # has been seen
+        self.seq = None
+        self.resync_requested = None
+        # when timestamps.modified was last set
+        self.touched = None
+
+    def set(self, name, value):
+        """Set the field ``name``, marking it as dirty if it changed
+        """
+        if self.fields.get(name, None) != value:
+            self.fields[name] = value
+            self.dirty.add(name)
+
+
+class SlaveRegistry(object):
+    """The authoritative, in-memory registry of slaves, keyed by uuid
+    """
+
+    FLUSH_INTERVAL = 2.0
+    """Seconds between writing changed fields to the database
+    """
+
+    RESYNC_INTERVAL = 10.0
+    """Seconds to wait for a full status before asking a slave again
+    """
+
+    LIVENESS_TIMEOUT = 30.0
+    """Seconds without a heartbeat or status after which a slave is dead
+    """
+
+    TOUCH_INTERVAL = 20.0
+    """Seconds between updating ``timestamps.modified`` of a live slave. The
+    TTL index on it removes slaves from the database if the master itself
+    goes away.
+    """
+
+    STATUS_FIELDS = [
+        "running_vms",
+        "total_jobs_run",
+        "vms",
+        "used_cpus",
+        "used_ram",
+        "max_cpus",
+        "max_ram",
+        "max_vms",
+        "images",
+    ]
+    """The fields of a slave status message that are stored
+    """
+
+    def __init__(self, parent_log=None):
+        if parent_log is None:
+            self._log = logging.getLogger("SLAVES")
+        else:
+            self._log = parent_log.getChild("SLAVES")
+
+        self._lock = threading.Lock()
+        # { <uuid>: <SlaveState>, ... }
+        self._slaves = {}
+
+        self._running = threading.Event()
+        self._flusher = None
+        self._flush_lock = threading.Lock()
+        self._flush_time = Timings()
+        self._flushed = 0
+        self._flush_errors = 0
+        # { UPDATED: <count>, ... }
+        self._results = collections.Counter()
+        self._deltas = 0
+
+        self._liveness = TimerWheel(tick=1.0)
+        self._lost_work_handlers = []
+        self._status_handlers = []
+        self._evicted = 0
+
+    def load(self):
+        """Load all of the slaves currently in the database
+        """
+        with self._lock:
+            for slave in master.models.Slave.objects():
+                state = SlaveState(slave.id, slave.uuid, slave.hostname)
+                for name in self.STATUS_FIELDS:
+                    state.fields[name] = getattr(slave, name)
+                self._slaves[slave.uuid] = state
+                # give every slave a chance to check in with this master
+                self._liveness.schedule(slave.uuid, self.LIVENESS_TIMEOUT)
+            self._log.info("loaded {} slaves".format(len(self._slaves)))
+
+    def add_lost_work_handler(self, handler):
+        """Add a function to be called with the uuid of every dead slave
+        and the list of VMs it was last running
+
+        :handler: A function that takes ``(uuid, vms)``
+        """
+        self._lost_work_handlers.append(handler)
+
+    def add_status_handler(self, handler):
+        """Add a function to be called with the uuid and running VMs of a
+        slave every time a status of it is applied
+
+        :handler: A function that takes ``(uuid, vms)``
+        """
+        self._status_handlers.append(handler)
+
+    def start(self):
+        """Start writing changes to the database and checking the liveness of
+        slaves in the background
+        """
+        self._running.set()
+        self._flusher = threading.Thread(target=self._run, name="SlaveFlusher")
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def stop(self):
+        """Stop the background writer after writing any remaining changes
+        """
+        self._running.clear()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+
+    def add(self, slave):
+        """Add a newly created slave document to the registry. Any other
+        slaves with the same hostname are removed.
+
+        :slave: The :any:`master.models.Slave` document
+        """
+        state = SlaveState(slave.id, slave.uuid, slave.hostname)
+        for name in self.STATUS_FIELDS:
+            state.fields[name] = getattr(slave, name)
+
+        with self._lock:
+            for uuid, other in self._slaves.items():
+                if other.hostname == slave.hostname:
+                    del self._slaves[uuid]
+                    self._liveness.cancel(uuid)
+            self._slaves[slave.uuid] = state
+            self._touch(state)
+
+    def remove(self, uuid):
+        with self._lock:
+            self._liveness.cancel(uuid)
+            return self._slaves.pop(uuid, None)
+
+    def heartbeat(self, uuid):
+        """Note that the slave is still alive. This does not write to the
+        database (more than once every ``TOUCH_INTERVAL`` seconds).
+
+        :returns: False if the slave is unknown
+        """
+        with self._lock:
+            state = self._slaves.get(uuid, None)
+            if state is None:
+                return False
+            self._touch(state)
+        return True
+
+    def reap(self):
+        """Remove every slave that has not been heard from in
+        ``LIVENESS_TIMEOUT`` seconds, from both the registry and the
+        database, and hand the VMs they were running to the lost work
+        handlers
+
+        :returns: The uuids of the removed slaves
+        """
+        dead = self._liveness.expire()
+        if len(dead) == 0:
+            return []
+
+        with self._lock:
+            states = [self._slaves.pop(uuid) for uuid in dead if uuid in self._slaves]
+        if len(states) == 0:
+            return []
+
+        self._evicted += len(states)
+
+        # the work is handed off before the slaves are deleted, since
+        # nothing would hand it off again if deleting them failed
+        for state in states:
+            vms = state.fields.get("vms", None) or []
+            self._log.warn("slave {} ({}) is dead, it was running {} vms".format(
+                state.hostname,
+                state.uuid,
+                len(vms)
+            ))
+            for handler in self._lost_work_handlers:
+                try:
+                    handler(state.uuid, vms)
+                except Exception:
+                    self._log.exception("error handing off the work of slave {}".format(state.uuid))
+
+        try:
+            master.models.Slave.objects(id__in=[state.id for state in states]).delete()
+        except pymongo.errors.PyMongoError as e:
+            # the documents still expire through the TTL index
+            self._log.warn("could not delete {} dead slaves: {}".format(len(states), e))
+
+        return [state.uuid for state in states]
+
+    def update(self, uuid, hostname, data):
+        """Update the slave with the fields in a status message
+
+        :uuid: The uuid of the slave
+        :hostname: The hostname of the slave
+        :data: The status message, either a full status or a delta
+        :returns: One of ``UPDATED``, ``UNKNOWN``, ``STALE``, or ``GAP``
+        """
+        with self._lock:
+            result = self._update(uuid, hostname, data)
+            self._results[result] += 1
+            if result == UPDATED:
+                vms = self._slaves[uuid].fields.get("vms", None) or []
+
+        if result == UPDATED:
+            for handler in self._status_handlers:
+                try:
+                    handler(uuid, vms)
+                except Exception:
+                    self._log.exception("error handling the status of slave {}".format(uuid))
+
+        return result
+
+    def snapshot(self):
+        """Return a copy of the fields of every slave
+        """
+        with self._lock:
+            return [
+                dict(state.fields, uuid=state.uuid, hostname=state.hostname)
+                for state in self._slaves.itervalues()
+            ]
+
+    def resync_due(self, uuid):
+        """Return True if the slave should be asked for a full status. This
+        is limited to once every ``RESYNC_INTERVAL`` seconds.
+        """
+        with self._lock:
+            state = self._slaves.get(uuid, None)
+            if state is None:
+                return False
+
+            now = time.time()
+            if state.resync_requested is not None and now - state.resync_requested < self.RESYNC_INTERVAL:
+                return False
+            state.resync_requested = now
+            return True
+
+    def get(self, uuid):
+        """Return a copy of the fields of the slave, or None
+        """
+        with self._lock:
+            state = self._slaves.get(uuid, None)
+            if state is None:
+                return None
+            return dict(state.fields, uuid=state.uuid, hostname=state.hostname)
+
+    def flush(self):
+        """Write the changed fields of every slave to the database in a
+        single bulk operation. Fields that could not be written are kept
+        dirty and are written by the next flush.
+
+        :returns: False if the bulk write failed
+        """
+        with self._flush_lock:
+            with self._lock:
+                updates = []
+                for state in self._slaves.itervalues():
+                    if len(state.dirty) == 0:
+                        continue
+                    updates.append((state.id, dict((name, state.fields[name]) for name in state.dirty)))
+                    state.dirty = set()
+
+            if len(updates) == 0:
+                return True
+
+            start = time.time()
+            try:
+                collection = master.models.Slave._get_collection()
+                bulk = collection.initialize_unordered_bulk_op()
+                for id_, changes in updates:
+                    bulk.find({"_id": id_}).update_one({"$set": changes})
+                bulk.execute()
+                self._flushed += len(updates)
+                success = True
+            except pymongo.errors.PyMongoError as e:
+                self._flush_errors += 1
+                self._log.warn("could not write slave changes: {}".format(e))
+                self._redirty(updates)
+                success = False
+            except Exception:
+                self._flush_errors += 1
+                self._log.exception("error writing slave changes")
+                self._redirty(updates)
+                success = False
+
+            self._flush_time.add(time.time() - start)
+            return success
+
+    def stats(self):
+        with self._lock:
+            count = len(self._slaves)
+            dirty = sum(1 for state in self._slaves.itervalues() if len(state.dirty) > 0)
+
+        return dict(
+            slaves       = count,
+            dirty        = dirty,
+            flushed      = self._flushed,
+            flush_errors = self._flush_errors,
+            flush_time   = self._flush_time.stats(),
+            updates      = dict(self._results),
+            deltas       = self._deltas,
+            tracked      = len(self._liveness),
+            evicted      = self._evicted,
+        )
+
+    # -----------------------
+
+    def _update(self, uuid, hostname, data):
+        state = self._slaves.get(uuid, None)
+        if state is None or state.hostname != hostname:
+            return UNKNOWN
+
+        # a slave whose deltas are missing or stale is still alive
+        self._touch(state)
+
+        seq = data.get("seq", None)
+        if seq is not None:
+            if data.get("full", False):
+                state.resync_requested = None
+            elif state.seq is None or seq > state.seq + 1:
+                return GAP
+            elif seq <= state.seq:
+                return STALE
+            else:
+                self._deltas += 1
+            state.seq = seq
+
+        for name in self.STATUS_FIELDS:
+            if name in data:
+                state.set(name, data[name])
+        if "vms_add" in data or "vms_remove" in data:
+            state.set("vms", merge_vms(
+                state.fields.get("vms", None) or [],
+                data.get("vms_add", []),
+                data.get("vms_remove", [])
+            ))
+
+        return UPDATED
+
+    def _touch(self, state):
+        """Push back the liveness deadline of the slave, must be called with
+        the lock held
+        """
+        self._liveness.schedule(state.uuid, self.LIVENESS_TIMEOUT)
+
+        now = time.time()
+        if state.touched is None or now - state.touched >= self.TOUCH_INTERVAL:
+            # the TTL index only works on dates
+            state.set("timestamps.modified", datetime.datetime.utcnow())
+            state.touched = now
+
+    def _redirty(self, updates):
+        by_id = dict(updates)
+        with self._lock:
+            for state in self._slaves.itervalues():
+                if state.id in by_id:
+                    state.dirty.update(by_id[state.id].keys())
+
+    def _run(self):
+        while self._running.is_set():
+            time.sleep(self.FLUSH_INTERVAL)
+            try:
+                self.reap()
+            except Exception:
+                self._log.exception("error removing dead slaves")
+            try:
+                self.flush()
+            except Exception:
+                self._log.exception("error flushing slave changes")
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+A hashed timer wheel for tracking large numbers of timeouts that are
+constantly being pushed back, such as slave heartbeats.
+"""
+
+
+import math
+import threading
+import time
+
+
+class TimerWheel(object):
+    """A hashed timer wheel. Time is divided into ticks, and every key is
+    kept in the slot of the tick its deadline falls in. Scheduling and
+    cancelling a key is O(1); expiring only looks at the slots of the ticks
+    that have passed. Deadlines are rounded up to the next tick, so keys
+    expire at most ``tick`` seconds late (plus however long it takes for
+    :any:`expire` to be called).
+    """
+
+    def __init__(self, tick=1.0, slots=128):
+        """Create a new timer wheel
+
+        :tick: The length of a tick in seconds
+        :slots: The number of slots in the wheel
+        """
+        self._lock = threading.Lock()
+        self._tick = float(tick)
+        self._slots = [set() for _ in range(slots)]
+        # { <key>: <deadline tick>, ... }
+        self._deadlines = {}
+        self._current = self._tick_of(time.time())
+
+    def schedule(self, key, timeout, now=None):
+        """Expire ``key`` in ``timeout`` seconds, replacing any deadline it
+        already had
+        """
+        if now is None:
+            now = time.time()
+        deadline = max(int(math.ceil((now + timeout) / self._tick)), self._current + 1)
+
+        with self._lock:
+            old = self._deadlines.get(key, None)
+            if old is not None:
+                self._slots[old % len(self._slots)].discard(key)
+            self._deadlines[key] = deadline
+            self._slots[deadline % len(self._slots)].add(key)
+
+    def cancel(self, key):
+        with self._lock:
+            deadline = self._deadlines.pop(key, None)
+            if deadline is not None:
+                self._slots[deadline % len(self._slots)].discard(key)
+
+    def expire(self, now=None):
+        """Remove and return every key whose deadline has passed
+        """
+        if now is None:
+            now = time.time()
+        target = self._tick_of(now)
+
+        expired = []
+        with self._lock:
+            # every slot only needs to be looked at once, no matter how many
+            # times the wheel went around
+            start = max(self._current + 1, target - len(self._slots) + 1)
+            for tick in xrange(start, target + 1):
+                slot = self._slots[tick % len(self._slots)]
+                for key in [key for key in slot if self._deadlines[key] <= target]:
+                    slot.discard(key)
+                    del self._deadlines[key]
+                    expired.append(key)
+            self._current = max(self._current, target)
+
+        return expired
+
+    def __len__(self):
+        with self._lock:
+            return len(self._deadlines)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._deadlines
+
+    # -----------------------
+
+    def _tick_of(self, t):
+        return int(math.floor(t / self._tick))
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Atomic status transitions of jobs and images.
+
+Every transition is a single ``find_and_modify`` that only matches the
+document if its ``status.name`` is still the one the caller saw, and that
+only ``$set`` s the new status (plus any other fields given), so that nothing
+else in the document is rewritten and concurrent writers can't be
+overwritten. The allowed transitions are declared per model:
+
+.. code-block:: python
+
+    JOB_EDGES = {
+        "run": ["running", "cancelled"],
+        ...
+    }
+
+The count, conflicts, and latency of every edge are kept for the master's
+stats.
+"""
+
+
+import collections
+import logging
+import threading
+import time
+
+import master.models
+import master.lib.echo as echo
+from master.lib.metrics import Timings
+
+
+JOB_EDGES = {
+    "run"     : ["running", "cancelled"],
+    "running" : ["finished"],
+    "stop"    : ["stopping"],
+    "cancel"  : ["cancelling"],
+}
+
+IMAGE_EDGES = {
+    "iso-create"  : ["configuring", "iso-create error"],
+    "import"      : ["configuring", "import_error"],
+    # configure and create only go through configuring with user interaction
+    "configure"   : ["configuring", "ready"],
+    "create"      : ["configuring", "ready"],
+    "configuring" : ["ready"],
+    "delete"      : ["ready"],
+}
+
+
+class StatusMachine(object):
+    """The allowed changes of the ``status`` of a model's documents
+    """
+
+    def __init__(self, model, edges, parent_log=None):
+        """Create a new status machine
+
+        :model: The mongoengine document class, e.g. :any:`master.models.Job`
+        :edges: ``{ <status name>: [<status names it may change to>, ...], ... }``
+        """
+        self._model = model
+        if parent_log is None:
+            self._log = logging.getLogger("TRANSITIONS")
+        else:
+            self._log = parent_log.getChild("TRANSITIONS")
+
+        self._edges = edges
+        # { <status name>: [<status names it may be changed from>, ...], ... }
+        self._sources = collections.defaultdict(list)
+        for source, targets in edges.iteritems():
+            for target in targets:
+                self._sources[target].append(source)
+
+        self._handlers = []
+        self._lock = threading.Lock()
+        # { (<from>, <to>): Counter, ... }
+        self._counts = collections.defaultdict(collections.Counter)
+        # { (<from>, <to>): Timings, ... }
+        self._timings = collections.defaultdict(Timings)
+
+    def add_handler(self, handler):
+        """Add a function to be called after every transition the master
+        makes, since those aren't seen in the oplog
+
+        :handler: A function that takes ``(doc, from_name, to_name)``
+        """
+        self._handlers.append(handler)
+
+    def transition(self, doc, to, status=None, sources=None, fields=None):
+        """Change the status of ``doc`` to ``to``, if its status in the
+        database is still the one in ``doc``. ``doc`` is updated to match if
+        it was.
+
+        :doc: The document
+        :to: The name of the new status
+        :status: The whole new status, ``{"name": to}`` by default
+        :sources: The status names the change may be made from, only the status of ``doc`` by default
+        :fields: Other fields to set along with the status, as
+            ``{ <field or dotted path>: <value>, ... }``
+        :returns: True if the status was changed
+        """
+        allowed = self._sources.get(to, [])
+        if len(allowed) == 0:
+            raise ValueError("{} status can't change to {!r}".format(self._model.__name__, to))
+
+        current = (doc.status or {}).get("name", None)
+        if sources is None:
+            if current not in allowed:
+                # e.g. someone else already changed the status
+                self._conflict(doc, current, to, [current])
+                return False
+            allowed = [current]
+        else:
+            allowed = [source for source in allowed if source in sources]
+        if len(allowed) == 0:
+            raise ValueError("{} status can't change to {!r} from {!r}".format(
+                self._model.__name__,
+                to,
+                sources,
+            ))
+
+        if status is None:
+            status = {"name": to}
+        changes = dict(fields or {})
+        changes["status"] = status
+        mod = {"$set": self._to_mongo(changes)}
+
+        ns = echo.namespace(doc)
+        echo.expect(ns, doc.pk, mod)
+        start = time.time()
+        old = self._model._get_collection().find_and_modify(
+            query  = {"_id": doc.pk, "status.name": {"$in": allowed}},
+            update = mod,
+            fields = {"status.name": 1},
+        )
+        elapsed = time.time() - start
+
+        if old is None:
+            echo.forget(ns, doc.pk, mod)
+            self._conflict(doc, current, to, allowed)
+            return False
+
+        source = old.get("status", {}).get("name", None)
+        with self._lock:
+            self._counts[(source, to)]["count"] += 1
+            timings = self._timings[(source, to)]
+        timings.add(elapsed)
+
+        for path, value in changes.iteritems():
+            self._apply(doc, path, value)
+
+        for handler in self._handlers:
+            try:
+                handler(doc, source, to)
+            except Exception:
+                self._log.exception("error handling transition of {} {}".format(self._model.__name__, doc.pk))
+        return True
+
+    def stats(self):
+        """Return the counts and latencies of every edge that was used
+        """
+        with self._lock:
+            counts = dict((edge, dict(counter)) for edge, counter in self._counts.iteritems())
+            timings = dict(self._timings)
+        res = []
+        for (source, to), counter in sorted(counts.iteritems()):
+            res.append(dict(
+                source    = source,
+                to        = to,
+                count     = counter.get("count", 0),
+                conflicts = counter.get("conflicts", 0),
+                time      = timings[(source, to)].stats() if (source, to) in timings else None,
+            ))
+        return res
+
+    # -----------------------
+
+    def _conflict(self, doc, current, to, allowed):
+        with self._lock:
+            self._counts[(current, to)]["conflicts"] += 1
+        self._log.info("{} {} is no longer in status {}, not changing it to {!r}".format(
+            self._model.__name__,
+            doc.pk,
+            "/".join(str(source) for source in allowed),
+            to,
+        ))
+
+    def _to_mongo(self, changes):
+        res = {}
+        for path, value in changes.iteritems():
+            field = self._model._fields.get(path, None)
+            if field is not None:
+                value = field.to_mongo(value)
+            res[path] = value
+        return res
+
+    def _apply(self, doc, path, value):
+        """Set the field at the (dotted) ``path`` of the document, without
+        marking it as changed
+        """
+        parts = path.split(".")
+        if len(parts) == 1:
+            doc._data[path] = value
+            return
+        parent = doc._data.get(parts[0], None)
+        if parent is None:
+            parent = doc._data[parts[0]] = {}
+        # plain dict methods, the document's dicts mark themselves as changed
+        for part in parts[1:-1]:
+            parent = dict.setdefault(parent, part, {})
+        dict.__setitem__(parent, parts[-1], value)
+
+
+jobs = StatusMachine(master.models.Job, JOB_EDGES)
+images = StatusMachine(master.models.Image, IMAGE_EDGES)
+
+
+def stats():
+    return dict(
+        job   = jobs.stats(),
+        image = images.stats(),
+    )
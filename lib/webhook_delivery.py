@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Asynchronous delivery of webhooks (see :any:`master.models.Webhook`).
+
+Triggering a webhook looks up the webhooks for the event in the
+:any:`master.lib.webhook_registry.WebhookRegistry`, serializes the document
+once, and queues a delivery for every matching webhook, so that slow or dead
+endpoints never hold up the watchers. A pool of worker threads ``POST`` the queued deliveries, keeping a
+keep-alive connection open to every host they have delivered to.
+
+Failed deliveries (connection errors, timeouts, and ``5xx``/``408``/``429``
+responses) are retried with exponential backoff. Deliveries that still fail
+after ``MAX_ATTEMPTS``, or that are rejected outright by the endpoint, are
+dead-lettered: they are logged and the most recent ones are kept in the stats.
+"""
+
+
+import collections
+import heapq
+import httplib
+import logging
+import os
+import Queue
+import socket
+import ssl
+import threading
+import time
+import urllib
+import urlparse
+
+from master.lib.metrics import Timings
+from master.lib.webhook_registry import WebhookRegistry
+
+
+class Delivery(object):
+    """A single webhook ``POST`` that needs to be made
+    """
+
+    def __init__(self, url, body, headers, verify_ssl=True, auth_string=None):
+        """Create a new delivery
+
+        :url: The url to post to
+        :body: The serialized document, shared between all the deliveries of an event
+        :headers: The headers to send, also shared between deliveries
+        :verify_ssl: Whether the certificate of https urls should be verified
+        :auth_string: Sent as the ``auth`` url parameter, if not None
+        """
+        # without the auth string, for logging
+        self.url = url
+        self.body = body
+        self.headers = headers
+        self.verify_ssl = verify_ssl
+        self.attempts = 0
+        self.queued_at = time.time()
+        self.last_error = None
+
+        parsed = urlparse.urlparse(url)
+        self.scheme = parsed.scheme
+        self.host = parsed.hostname
+        self.port = parsed.port
+        query = parsed.query
+        if auth_string is not None:
+            query += ("&" if query else "") + urllib.urlencode(dict(auth=auth_string))
+        self.path = parsed.path or "/"
+        if query:
+            self.path += "?" + query
+
+    def conn_key(self):
+        return (self.scheme, self.host, self.port, self.verify_ssl)
+
+
+class WebhookDelivery(object):
+    """Queues webhook deliveries and posts them from a pool of workers
+    """
+
+    WORKERS = 4
+    """The number of worker threads, ``TALUS_WEBHOOK_WORKERS`` overrides it
+    """
+
+    QUEUE_SIZE = 10000
+    """The most deliveries that may be waiting. Deliveries triggered while
+    the queue is full are dropped.
+    """
+
+    TIMEOUT = 10.0
+    """Seconds to wait on an endpoint before the attempt fails
+    """
+
+    MAX_ATTEMPTS = 6
+    """Attempts made for a delivery before it is dead-lettered
+    """
+
+    BACKOFF = 1.0
+    """Seconds to wait before the first retry, doubled for every retry after
+    """
+
+    MAX_BACKOFF = 300.0
+
+    DEAD_LETTERS = 50
+    """The number of dead-lettered deliveries kept in the stats
+    """
+
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        """Return the singleton instance of the webhook delivery
+        """
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, parent_log=None, workers=None, registry=None):
+        if parent_log is None:
+            self._log = logging.getLogger("WEBHOOKS")
+        else:
+            self._log = parent_log.getChild("WEBHOOKS")
+
+        if workers is None:
+            workers = int(os.environ.get("TALUS_WEBHOOK_WORKERS", self.WORKERS))
+        self._num_workers = max(1, workers)
+        self._registry = registry or WebhookRegistry.instance()
+        self._workers = []
+
+        self._queue = Queue.Queue(maxsize=self.QUEUE_SIZE)
+        self._running = threading.Event()
+
+        # [(<retry time>, <seq>, <Delivery>), ...]
+        self._retries = []
+        self._retry_cond = threading.Condition()
+        self._retry_seq = 0
+        self._retry_thread = None
+
+        self._stats_lock = threading.Lock()
+        self._latency = Timings()
+        self._attempt_time = Timings()
+        self._counts = collections.Counter()
+        self._dead = collections.deque(maxlen=self.DEAD_LETTERS)
+
+    def start(self):
+        self._running.set()
+        for x in range(self._num_workers):
+            worker = threading.Thread(target=self._work, name="WebhookWorker-{}".format(x))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+        self._retry_thread = threading.Thread(target=self._run_retries, name="WebhookRetries")
+        self._retry_thread.daemon = True
+        self._retry_thread.start()
+
+    def stop(self):
+        """Stop the workers. Deliveries that are still queued or waiting to be
+        retried are dropped.
+        """
+        self._running.clear()
+        with self._retry_cond:
+            self._retry_cond.notify_all()
+        for _ in self._workers:
+            # wake up the workers, they check _running before handling anything
+            try:
+                self._queue.put_nowait(None)
+            except Queue.Full:
+                break
+        for worker in self._workers:
+            worker.join(self.TIMEOUT)
+        if self._retry_thread is not None:
+            self._retry_thread.join()
+        self._workers = []
+
+    def trigger(self, type_, status, obj):
+        """Queue a delivery of ``obj`` to every webhook of type ``type_``
+        that wants ``status``. Never blocks on the endpoints.
+
+        :type_: The type of the webhooks (e.g. ``job``)
+        :status: The new status of the document
+        :obj: The document (e.g. :any:`master.models.Job`) to send
+        :returns: The number of deliveries queued
+        """
+        hooks = self._registry.matching(type_, status)
+        if len(hooks) == 0:
+            return 0
+
+        # serialized once, and shared by every delivery of the event
+        body = obj.to_json()
+        headers = {
+            "Content-Type": "application/json",
+            "X-Talus-Event": type_,
+            "X-Talus-Status": str(status),
+        }
+
+        queued = 0
+        for hook in hooks:
+            delivery = Delivery(hook.url, body, headers, verify_ssl=hook.verify_ssl, auth_string=hook.auth_string)
+            if self.enqueue(delivery):
+                queued += 1
+        return queued
+
+    def enqueue(self, delivery):
+        """Queue a single delivery
+
+        :returns: False if the queue was full and the delivery was dropped
+        """
+        if delivery.scheme not in ["http", "https"] or not delivery.host:
+            self._dead_letter(delivery, "unsupported url")
+            return False
+
+        try:
+            self._queue.put_nowait(delivery)
+        except Queue.Full:
+            self._count("dropped")
+            self._log.warn("webhook queue is full, dropping delivery to {}".format(delivery.url))
+            return False
+        self._count("queued")
+        return True
+
+    def stats(self):
+        with self._stats_lock:
+            counts = dict(self._counts)
+            dead = list(self._dead)
+        with self._retry_cond:
+            retrying = len(self._retries)
+
+        return dict(
+            queued       = self._queue.qsize(),
+            retrying     = retrying,
+            counts       = counts,
+            latency      = self._latency.stats(),
+            attempt_time = self._attempt_time.stats(),
+            dead_letters = dead,
+        )
+
+    # -----------------------
+
+    def _count(self, name, amount=1):
+        with self._stats_lock:
+            self._counts[name] += amount
+
+    def _work(self):
+        # { (<scheme>, <host>, <port>, <verify>): <HTTPConnection>, ... },
+        # only ever used by this worker
+        conns = {}
+        try:
+            while self._running.is_set():
+                delivery = self._queue.get()
+                if delivery is None or not self._running.is_set():
+                    continue
+                self._attempt(delivery, conns)
+        finally:
+            for conn in conns.itervalues():
+                conn.close()
+
+    def _attempt(self, delivery, conns):
+        delivery.attempts += 1
+        start = time.time()
+        try:
+            status = self._post(delivery, conns)
+        except (httplib.HTTPException, socket.error, ssl.SSLError) as e:
+            status = None
+            delivery.last_error = "{}: {}".format(e.__class__.__name__, e)
+        self._attempt_time.add(time.time() - start)
+
+        if status is not None and 200 <= status < 300:
+            self._count("delivered")
+            self._latency.add(time.time() - delivery.queued_at)
+            return
+
+        self._count("failed_attempts")
+        if status is not None:
+            delivery.last_error = "HTTP {}".format(status)
+            if status < 500 and status not in [408, 429]:
+                # retrying won't change the endpoint's mind
+                self._dead_letter(delivery, delivery.last_error)
+                return
+
+        if delivery.attempts >= self.MAX_ATTEMPTS:
+            self._dead_letter(delivery, delivery.last_error)
+            return
+
+        self._retry(delivery)
+
+    def _post(self, delivery, conns):
+        """Post the delivery, reusing the worker's connection to the host
+
+        :returns: The status code of the response
+        """
+        key = delivery.conn_key()
+        conn = conns.get(key, None)
+        reused = conn is not None
+        if conn is None:
+            conn = conns[key] = self._connect(delivery)
+
+        try:
+            return self._request(conn, delivery)
+        except (httplib.HTTPException, socket.error, ssl.SSLError):
+            conn.close()
+            del conns[key]
+            if not reused:
+                raise
+
+        # the endpoint closed the kept-alive connection, which is not a
+        # failed attempt
+        self._count("reconnects")
+        conn = conns[key] = self._connect(delivery)
+        try:
+            return self._request(conn, delivery)
+        except (httplib.HTTPException, socket.error, ssl.SSLError):
+            conn.close()
+            del conns[key]
+            raise
+
+    def _connect(self, delivery):
+        self._count("connections")
+        if delivery.scheme == "https":
+            context = None
+            if not delivery.verify_ssl:
+                context = ssl._create_unverified_context()
+            return httplib.HTTPSConnection(delivery.host, delivery.port, timeout=self.TIMEOUT, context=context)
+        return httplib.HTTPConnection(delivery.host, delivery.port, timeout=self.TIMEOUT)
+
+    def _request(self, conn, delivery):
+        conn.request("POST", delivery.path, delivery.body, delivery.headers)
+        res = conn.getresponse()
+        # the response has to be read completely for the connection to be
+        # used again
+        res.read()
+        if res.getheader("connection", "").lower() == "close":
+            conn.close()
+        return res.status
+
+    def _retry(self, delivery):
+        delay = min(self.MAX_BACKOFF, self.BACKOFF * (2 ** (delivery.attempts - 1)))
+        self._count("retries")
+        with self._retry_cond:
+            self._retry_seq += 1
+            heapq.heappush(self._retries, (time.time() + delay, self._retry_seq, delivery))
+            self._retry_cond.notify()
+
+    def _run_retries(self):
+        """Put deliveries back in the queue once their backoff is over
+        """
+        while self._running.is_set():
+            due = []
+            with self._retry_cond:
+                now = time.time()
+                while len(self._retries) > 0 and self._retries[0][0] <= now:
+                    due.append(heapq.heappop(self._retries)[2])
+                if len(due) == 0:
+                    timeout = None
+                    if len(self._retries) > 0:
+                        timeout = self._retries[0][0] - now
+                    # wake up at least every second to notice being stopped
+                    self._retry_cond.wait(min(timeout or 1.0, 1.0))
+                    continue
+
+            for delivery in due:
+                try:
+                    self._queue.put_nowait(delivery)
+                except Queue.Full:
+                    self._dead_letter(delivery, "queue full")
+
+    def _dead_letter(self, delivery, error):
+        self._log.warn("giving up on webhook delivery to {} after {} attempt(s): {}".format(
+            delivery.url,
+            delivery.attempts,
+            error,
+        ))
+        with self._stats_lock:
+            self._counts["dead"] += 1
+            self._dead.append(dict(
+                url      = delivery.url,
+                attempts = delivery.attempts,
+                error    = error,
+                time     = time.time(),
+            ))
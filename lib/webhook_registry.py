@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+An in-memory copy of the :any:`master.models.Webhook` documents, indexed by
+event type, so that triggering a webhook never has to query the database.
+
+The registry is loaded once and then kept current by the
+:any:`master.watchers.webhook.WebhookWatcher`.
+"""
+
+
+import collections
+import logging
+import threading
+
+import master.models
+
+
+class Hook(object):
+    """The fields of a webhook that are needed to deliver to it
+    """
+
+    def __init__(self, id, type, url, auth_string=None, verify_ssl=True, statuses=None):
+        self.id = str(id)
+        self.type = type
+        self.url = url
+        self.auth_string = auth_string
+        self.verify_ssl = True if verify_ssl is None else verify_ssl
+        # empty for every status
+        self.statuses = frozenset(statuses or [])
+
+    @classmethod
+    def from_doc(cls, doc):
+        """Create a hook from a :any:`master.models.Webhook` or the raw
+        document from the oplog
+        """
+        if isinstance(doc, master.models.Webhook):
+            return cls(doc.id, doc.type, doc.url, doc.auth_string, doc.verify_ssl, doc.statuses)
+        return cls(
+            doc["_id"],
+            doc.get("type", None),
+            doc.get("url", None),
+            doc.get("auth_string", None),
+            doc.get("verify_ssl", True),
+            doc.get("statuses", None),
+        )
+
+    def wants(self, status):
+        return len(self.statuses) == 0 or status in self.statuses
+
+
+class WebhookRegistry(object):
+    """The webhooks of every event type
+    """
+
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        """Return the singleton instance of the webhook registry
+        """
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, parent_log=None):
+        if parent_log is None:
+            self._log = logging.getLogger("WEBHOOK-REG")
+        else:
+            self._log = parent_log.getChild("WEBHOOK-REG")
+
+        self._lock = threading.Lock()
+        self._loaded = False
+        # { <type>: { <webhook id>: <Hook>, ... }, ... }
+        self._by_type = collections.defaultdict(dict)
+        # { <webhook id>: <type>, ... }
+        self._types = {}
+
+    def load(self):
+        """(Re)load every webhook from the database
+        """
+        hooks = [Hook.from_doc(doc) for doc in master.models.Webhook.objects()]
+        with self._lock:
+            self._by_type.clear()
+            self._types.clear()
+            for hook in hooks:
+                self._add(hook)
+            self._loaded = True
+        self._log.info("loaded {} webhooks".format(len(hooks)))
+
+    def put(self, hook):
+        """Add or replace a webhook
+
+        :hook: A :any:`Hook`
+        """
+        with self._lock:
+            self._discard(hook.id)
+            self._add(hook)
+
+    def remove(self, id_):
+        with self._lock:
+            self._discard(str(id_))
+
+    def matching(self, type_, status):
+        """Return the webhooks of ``type_`` that want to be triggered for
+        ``status``
+        """
+        if not self._loaded:
+            self.load()
+        with self._lock:
+            hooks = self._by_type.get(type_, None)
+            if hooks is None:
+                return []
+            return [hook for hook in hooks.itervalues() if hook.wants(status)]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._types)
+
+    # -----------------------
+
+    def _add(self, hook):
+        if hook.type is None or hook.url is None:
+            return
+        self._by_type[hook.type][hook.id] = hook
+        self._types[hook.id] = hook.type
+
+    def _discard(self, id_):
+        type_ = self._types.pop(id_, None)
+        if type_ is None:
+            return
+        hooks = self._by_type[type_]
+        hooks.pop(id_, None)
+        if len(hooks) == 0:
+            del self._by_type[type_]
@@ -43,6 +43,10 @@ class Webhook(Document):
     verify_ssl = BooleanField(default=True)
     """Whether ssl certificates should be verified.
     """
+    statuses = ListField(StringField())
+    """The statuses to trigger on (e.g. ``["finished", "cancelled"]``). An
+    empty list triggers on every status change.
+    """
 
 
 class Result(Document):
@@ -53,6 +57,8 @@ class Result(Document):
     created = DateTimeField(default=datetime.datetime.now)
     tags    = ListField(StringField())
     slave   = StringField(required=False, default="unknown")
+    # counted in the job's aggregates, see master.lib.job_aggregates
+    counted = BooleanField(default=False)
 
 
 class Code(Document):
@@ -87,6 +93,44 @@ class JobError(EmbeddedDocument):
     logs      = ListField(StringField())
 
 
+class JobLogEntry(Document):
+    """A single error or log of a job, see :any:`master.lib.job_log`
+    """
+    meta = {
+        "indexes": [
+            # for paging through the entries of a job
+            ("job", "ts", "_id"),
+            # for rolling up old entries
+            "ts",
+        ]
+    }
+
+    job        = ReferenceField("Job", required=True)
+    ts         = DateTimeField()
+    # error or log
+    kind       = StringField()
+    message    = StringField()
+    backtrace  = StringField()
+    logs       = ListField(StringField())
+
+
+class JobLogSegment(Document):
+    """Older log entries of a job, compressed together
+    """
+    meta = {
+        "indexes": [
+            ("job", "last_ts"),
+        ]
+    }
+
+    job        = ReferenceField("Job", required=True)
+    first_ts   = DateTimeField()
+    last_ts    = DateTimeField()
+    count      = IntField(default=0)
+    # zlib compressed BSON of {"entries": [<JobLogEntry document>, ...]}
+    data       = BinaryField()
+
+
 class Job(Document):
     name       = StringField()
     task       = ReferenceField("Task", required=True)
@@ -97,6 +141,9 @@ class Job(Document):
     priority   = IntField(default=50) # 0-100
     limit      = IntField(default=1)
     progress   = IntField(default=0)
+    # [[<start>, <end>], ...] ranges of the indices that have finished, kept
+    # by the master's scheduler
+    finished_idxs = ListField(ListField(IntField()))
     image      = ReferenceField("Image", required=True)
     network    = StringField()
     debug      = BooleanField(default=False)
@@ -104,11 +151,34 @@ class Job(Document):
     # see #28 - specify amount of ram/cpu needed for the job
     vm_ram     = IntField(default=1024, required=False)
     vm_cpu     = IntField(default=1, required=False)
+    # trimmed down to the most recent ones by the master, every error and
+    # log is kept in the JobLogEntry collection
     errors     = ListField(EmbeddedDocumentField(JobError))
     logs       = ListField(EmbeddedDocumentField(JobError))
+    error_count = IntField(default=0)
+    log_count  = IntField(default=0)
     tags       = ListField(StringField())
 
 
+class JobAggregate(Document):
+    """Result counts and progress of a job, kept up to date as they change,
+    see :any:`master.lib.job_aggregates`
+    """
+    # the id of the job
+    id            = ObjectIdField(primary_key=True)
+    status        = StringField()
+    # { <result type>: <count>, ... }
+    results       = DictField()
+    result_count  = IntField(default=0)
+    first_result  = DateTimeField()
+    last_result   = DateTimeField()
+    progress      = IntField(default=0)
+    # progress per second
+    progress_rate = FloatField(default=0.0)
+    # modified
+    timestamps    = DictField()
+
+
 class FileSet(Document):
     name       = StringField()
     files      = ListField()
@@ -151,6 +221,7 @@ class Master(Document):
     ip       = StringField()
     vms      = ListField(DictField())
     queues   = DictField()
+    stats    = DictField()
 
 
 class Slave(Document):
@@ -174,4 +245,6 @@ class Slave(Document):
     running_vms    = IntField(default=0)
     total_jobs_run = IntField(default=0)
     vms            = ListField(DictField())
+    # md5s of the images the slave has cached
+    images         = ListField(StringField())
     timestamps     = DictField()
@@ -6,10 +6,95 @@ import glob
 import os
 import sys
 
+import master.lib.echo as echo
+
 
 class WatcherBase(object):
+    dispatch_workers = 4
+    """The number of worker threads events for this watcher are dispatched
+    on. Events for the same document are always handled in order by the same
+    worker.
+    """
+
+    queue_size = 10000
+    """The maximum number of events that may be queued for this watcher
+    """
+
+    overflow = "block"
+    """What to do with new events when :any:`queue_size` events are already
+    queued for this watcher. One of ``block``, ``coalesce``, or ``spill``. See
+    :any:`master.lib.dispatch` for details.
+    """
+
+    coalesce_window = 0
+    """The number of seconds updates to a document are held for before
+    being handled. Consecutive ``$set`` updates to the same document that
+    arrive within the window are merged into a single update. ``0`` disables
+    coalescing.
+    """
+
+    coalesce_distinct = []
+    """Field paths (e.g. ``status.name``) whose every change must be seen
+    by the watcher. Updates that both change one of these fields are never
+    merged.
+    """
+
+    subscriptions = None
+    """The events this watcher is interested in, e.g.
+    ``{"insert": None, "update": ["status.name"]}``. Keys are the operations
+    (``insert``, ``update``, ``delete``) the watcher wants to be called for.
+    Values are either ``None`` (every event) or a list of field paths - only
+    updates that change one of those fields will be dispatched. ``None``
+    subscribes to everything.
+    """
+
     def __init__(self, parent_log):
         self._log = parent_log.getChild(self.__class__.__name__)
 
+    def startup(self):
+        """Restore any in-memory state from the database. This is called
+        every time the master starts, before :any:`catch_up`.
+        """
+        pass
+
+    def catch_up(self):
+        """Handle any documents that changed while the master wasn't running.
+        This is only called when the master could not resume watching the
+        oplog from where it left off.
+        """
+        pass
+
     def stop(self):
         pass
+
+    def observe(self, op, id_, data, ts):
+        """Called with every event the watcher is subscribed to as it is read
+        from the oplog, before it is queued or merged with other updates,
+        along with its oplog timestamp. It is called from the thread
+        reading the oplog, and must be fast.
+        """
+        pass
+
+    def dispatch_key(self, op, id_, data):
+        """Return the key that decides which dispatch worker handles the
+        event. Events with the same key are handled in order, by the same
+        worker. Events are keyed by the id of their document by default.
+        """
+        return id_
+
+    def stats(self):
+        """Return stats of the watcher's own, kept with the stats of its
+        dispatch lane. None if it has none.
+        """
+        return None
+
+    def _save(self, doc):
+        """Save the mongoengine document. The update this causes will not
+        be dispatched back to the watchers.
+
+        Only for documents whose updates some watcher subscribes to. The
+        oplog is only read for subscribed operations, so the echo of any
+        other update never arrives and the expected echo lingers until it
+        expires.
+        """
+        echo.save(doc)
@@ -24,10 +24,18 @@ TALUS_GIT = "/talus/talus_code.git"
 
 class CodeWatcher(WatcherBase):
     collection = "talus.code"
+    # all new code is pushed to the same git repo
+    dispatch_workers = 1
+    subscriptions = {
+        "insert": None,
+    }
 
     def __init__(self, *args, **kwargs):
         WatcherBase.__init__(self, *args, **kwargs)
 
+    def catch_up(self):
+        """Create any new code that was requested while the master was down
+        """
         for code in master.models.Code.objects(type__in=["new_tool", "new_component"]):
             self._handle_new_code(code.id, code=code)
 
@@ -15,10 +15,17 @@ import uuid
 
 
 import master.models
-import master.lib.webhooks as webhooks
+import master.lib.echo as echo
+import master.lib.job_log as job_log
+import master.lib.transitions as transitions
+from master.lib.job_aggregates import JobAggregates
+from master.lib.job_cache import JobCache
 from master.lib.jobs import JobManager
+from master.lib.scheduler import Scheduler
+from master.lib.webhook_delivery import WebhookDelivery
 from master.watchers import WatcherBase
 from master.lib.amqp_man import AmqpManager
+from master.lib.dispatch import mod_touches
 
 
 class JobWatcher(WatcherBase):
@@ -26,6 +33,38 @@ class JobWatcher(WatcherBase):
     """
 
     collection = "talus.job"
+    # progress updates are constant while a job is running, but every
+    # status change fires a webhook
+    coalesce_window = 0.25
+    coalesce_distinct = ["status"]
+    # only the fields that are read from the cached jobs (by the scheduler,
+    # the job manager and the status handlers), the progress for the job
+    # aggregates, and the errors and logs for the job log store. Other fields
+    # (e.g. timestamps, or the error and log counts the master writes itself)
+    # may be out of date in the cached jobs.
+    subscriptions = {
+        "insert": None,
+        "update": [
+            "status",
+            "priority",
+            "progress",
+            "finished_idxs",
+            "image",
+            "task",
+            "name",
+            "params",
+            "limit",
+            "network",
+            "debug",
+            "vm_max",
+            "vm_cpu",
+            "vm_ram",
+            "tags",
+            "errors",
+            "logs",
+        ],
+        "delete": None,
+    }
 
     def __init__(self, *args, **kwargs):
         WatcherBase.__init__(self, *args, **kwargs)
@@ -34,6 +73,34 @@ class JobWatcher(WatcherBase):
         # this needs to be continuously running
         self._job_man.start()
 
+        self._scheduler = Scheduler.instance()
+        self._scheduler.add_done_handler(self._on_job_done)
+        self._scheduler.add_progress_handler(self._on_job_progress)
+
+        # the jobs with their image and task, kept current by the updates
+        # handled here and by the watchers in master.watchers.job_cache
+        self._jobs = JobCache.instance()
+
+        # webhooks are delivered from their own threads, triggering them only
+        # queues the deliveries
+        self._webhooks = WebhookDelivery.instance()
+
+        # the progress and status of every job, next to its result counts
+        self._aggregates = JobAggregates.instance()
+
+        # errors and logs pushed onto jobs are moved to their own collection
+        self._job_logs = job_log.JobLogStore.instance()
+
+    def startup(self):
+        """Keep scheduling the jobs that were running, the scheduler only
+        keeps them in memory
+        """
+        for job in master.models.Job.objects(status__name="running"):
+            self._scheduler.submit(job)
+
+    def catch_up(self):
+        """Handle jobs that were left waiting to be run, stopped, or cancelled
+        """
         for job in master.models.Job.objects(status__name__in=["run", "stop", "cancel"]):
             self._handle_status(job.id, job=job)
 
@@ -48,7 +115,22 @@ class JobWatcher(WatcherBase):
         if "status" in obj and "name" in obj["status"]:
             new_status = obj["status"]["name"]
 
-        self._handle_status(id_, obj, new_status=new_status)
+        job = master.models.Job._from_son(obj)
+        self._jobs.put(job)
+        if new_status is not None:
+            self._aggregates.set_status(id_, new_status)
+        self._handle_status(id_, obj, job=job, new_status=new_status)
+
+    def observe(self, op, id_, data, ts):
+        """Hand the errors and logs pushed onto the job to the job log store.
+        This is done before updates are coalesced, which could merge a push
+        with a later update of the whole list.
+        """
+        if op != "update":
+            return
+        for kind, (field, _) in job_log.KINDS.iteritems():
+            for index, entry in enumerate(job_log.pushed_entries(data, field)):
+                self._job_logs.append(id_, kind, entry, ts=ts, index=index)
 
     def update(self, id, mod):
         self._log.debug("handling update {} {}".format(id, mod))
@@ -58,19 +140,27 @@ class JobWatcher(WatcherBase):
         # {'$set': {'status': {'name': 'running'}}}
         #
         # NOTE that _handle_status is intended to fire
+        self._jobs.apply(id, mod)
+        if mod_touches(mod, "progress"):
+            self._aggregates.progress_changed(id)
         if "$set" not in mod:
             return
+        if "priority" in mod["$set"]:
+            self._scheduler.set_priority(id, mod["$set"]["priority"])
         if "status" not in mod["$set"]:
             return
         if "name" not in mod["$set"]["status"]:
             return
 
         new_status = mod["$set"]["status"]["name"]
+        self._aggregates.set_status(id, new_status)
         self._handle_status(id, mod, new_status=new_status)
     
     def delete(self, id):
         self._log.debug("handling delete")
 
+        self._jobs.remove(id)
+        self._aggregates.remove(id)
         #self._handle_status(id)
 
     # -----------------------
@@ -85,17 +175,16 @@ class JobWatcher(WatcherBase):
         }
 
         if job is None:
-            jobs = master.models.Job.objects(id=id_)
-            if len(jobs) == 0:
+            job = self._jobs.get(id_)
+            if job is None:
                 self._log.debug("_handle_status failed to find job {}".format(id_))
                 return
-            job = jobs[0]
 
         self._log.info("triggering webhook for job status change (job: {}, status: {!r})".format(
             job.id,
             new_status,
         ))
-        webhooks.trigger("job", new_status, job)
+        self._webhooks.trigger("job", new_status, job)
 
         self._log.debug("_handle_status status is {}".format(job.status["name"]))
         if job.status["name"] in switch:
@@ -106,18 +195,21 @@ class JobWatcher(WatcherBase):
         """
         self._log.info("handling job runnage")
 
+        if job.image.status["name"] != "ready":
+            # the cached image may not have caught up yet
+            self._jobs.invalidate_image(job.image.id)
+            job = self._jobs.get(job.id) or job
+
         if job.image.status["name"] != "ready":
             self._log.warn("Image is not in a ready state! cannot run the job yet, cancelling")
-            job.status = {"name": "cancelled", "desc": "image not ready"}
-            job.save()
+            self._set_status(job, {"name": "cancelled", "desc": "image not ready"})
             return
 
-        self._job_man.run_job(job)
+        # a job that is run again starts over
+        if not self._set_status(job, {"name": "running"}, fields={"finished_idxs": []}):
+            return
 
-        job.status = {
-            "name": "running"
-        }
-        job.save()
+        self._scheduler.submit(job)
 
     def _handle_stop(self, id_, job):
         """Handle stopping a job - to be used only for internal purposes. Not
@@ -125,11 +217,10 @@ class JobWatcher(WatcherBase):
         """
         self._log.info("handling job cancellation")
 
-        job.status = {
-            "name": "stopping"
-        }
-        job.save()
+        if not self._set_status(job, {"name": "stopping"}):
+            return
 
+        self._scheduler.remove(job.id)
         self._job_man.stop_job(job)
 
     def _handle_cancel(self, id_, job):
@@ -137,9 +228,60 @@ class JobWatcher(WatcherBase):
         """
         self._log.info("handling job cancellation")
 
-        job.status = {
-            "name": "cancelling"
-        }
-        job.save()
+        if not self._set_status(job, {"name": "cancelling"}):
+            return
 
+        self._scheduler.remove(job.id)
         self._job_man.cancel_job(job)
+
+    def _on_job_done(self, job_id):
+        """Called by the scheduler once every work unit of the job has run
+        """
+        job = self._jobs.get(job_id)
+        if job is None or job.status.get("name", None) != "running":
+            return
+        self._set_status(job, {"name": "finished"})
+
+    def _on_job_progress(self, job_id, ranges):
+        """Called by the scheduler with the ranges of the indices of the job
+        that have finished, so that they aren't run again if the master
+        restarts
+        """
+        job_id = bson.ObjectId(str(job_id))
+        mod = {"$set": {"finished_idxs": ranges}}
+        ns = echo.namespace(master.models.Job)
+        echo.expect(ns, job_id, mod)
+        try:
+            master.models.Job._get_collection().update({"_id": job_id}, mod)
+        except Exception:
+            echo.forget(ns, job_id, mod)
+            raise
+        self._jobs.apply(job_id, mod)
+
+    def _set_status(self, job, status, fields=None):
+        """Change the status of the job, if its status in the database still
+        allows it (see :any:`master.lib.transitions`). Since the master's own
+        writes aren't dispatched back to the watchers, the webhooks for the
+        new status are triggered here.
+
+        :returns: True if the status was changed
+        """
+        try:
+            changed = transitions.jobs.transition(job, status["name"], status=status, fields=fields)
+        except Exception:
+            self._jobs.remove(job.id)
+            raise
+        if not changed:
+            # someone else changed it first, the cached job is out of date
+            self._jobs.remove(job.id)
+            return False
+        # the master's own writes aren't seen in the oplog
+        self._jobs.put(job)
+        self._aggregates.set_status(job.id, status["name"])
+
+        self._log.info("triggering webhook for job status change (job: {}, status: {!r})".format(
+            job.id,
+            status["name"],
+        ))
+        self._webhooks.trigger("job", status["name"], job)
+        return True
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+
+"""
+This module drops the images and tasks cached along with jobs (see
+:any:`master.lib.job_cache`) when they change in the MongoDB database.
+"""
+
+
+import master.lib.transitions as transitions
+from master.lib.job_cache import JobCache
+from master.watchers import WatcherBase
+
+
+class ImageCacheWatcher(WatcherBase):
+    """Drops changed images from the job cache
+    """
+
+    collection = "talus.image"
+    dispatch_workers = 1
+    # only the fields jobs are handled with
+    subscriptions = {
+        "update": ["status", "md5"],
+        "delete": None,
+    }
+
+    def __init__(self, *args, **kwargs):
+        WatcherBase.__init__(self, *args, **kwargs)
+
+        self._jobs = JobCache.instance()
+        # the master's own status changes aren't seen in the oplog
+        transitions.images.add_handler(self._on_transition)
+
+    def insert(self, id_, obj):
+        pass
+
+    def update(self, id_, mod):
+        self._jobs.invalidate_image(id_)
+
+    def delete(self, id_):
+        self._jobs.invalidate_image(id_)
+
+    def _on_transition(self, image, source, to):
+        self._jobs.invalidate_image(image.id)
+
+
+class TaskCacheWatcher(WatcherBase):
+    """Drops changed tasks from the job cache
+    """
+
+    collection = "talus.task"
+    dispatch_workers = 1
+    subscriptions = {
+        "update": None,
+        "delete": None,
+    }
+
+    def __init__(self, *args, **kwargs):
+        WatcherBase.__init__(self, *args, **kwargs)
+
+        self._jobs = JobCache.instance()
+
+    def insert(self, id_, obj):
+        pass
+
+    def update(self, id_, mod):
+        self._jobs.invalidate_task(id_)
+
+    def delete(self, id_):
+        self._jobs.invalidate_task(id_)
@@ -2,27 +2,51 @@
 # encoding: utf-8
 
 import bson
+import collections
 import datetime
 import glob
+import multiprocessing
 import os
 import sys
+import threading
 import time
 import uuid
 
 import master.models
 from master.watchers import WatcherBase
 from master.lib.amqp_man import AmqpManager
+from master.lib.job_aggregates import JobAggregates
+from master.lib.metrics import Timings
 from master import Master
 from master.watchers.result_processors import ResultProcessorBase
 
 
 class ResultWatcher(WatcherBase):
     collection = "talus.result"
+    # crash storms can insert thousands of results a minute, don't hold them
+    # all in memory
+    queue_size = 2000
+    overflow = "spill"
+    subscriptions = {
+        "insert": None,
+    }
 
     def __init__(self, *args, **kwargs):
         WatcherBase.__init__(self, *args, **kwargs)
 
+        # results are processed in parallel, keyed by the processors'
+        # ordering keys (see dispatch_key)
+        self.dispatch_workers = int(os.environ.get("TALUS_RESULT_WORKERS", multiprocessing.cpu_count()))
+
         self._processors = []
+        # result counts of every job
+        self._aggregates = JobAggregates.instance()
+
+        self._counts_lock = threading.Lock()
+        # { <processor class name>: Counter, ... }
+        self._counts = collections.defaultdict(collections.Counter)
+        # { <processor class name>: Timings, ... }
+        self._timings = collections.defaultdict(Timings)
 
         for filename in glob.glob(os.path.join(os.path.dirname(__file__), "result_processors", "*.py")):
             filename_ = os.path.basename(filename)
@@ -50,6 +74,33 @@ class ResultWatcher(WatcherBase):
                     self._log.info("found result processor: {}".format(item.__name__))
                     self._processors.append(item())
 
+        self._build_routes()
+
+        # { <processor class name>: BoundedSemaphore, ... }
+        self._limits = {}
+        for processor in self._processors:
+            if processor.max_concurrency is not None:
+                self._limits[processor.__class__.__name__] = threading.BoundedSemaphore(max(1, processor.max_concurrency))
+
+    def dispatch_key(self, op, id_, data):
+        """Key new results by the ordering key of the first of their
+        processors that has one, so that they are processed in order
+        """
+        if op != "insert" or data is None:
+            return id_
+        result = None
+        for processor in self._routes.get(data.get("type", None), self._fallback):
+            # no need to build the document for processors that don't order
+            # their results
+            if processor.__class__.ordering_key == ResultProcessorBase.ordering_key:
+                continue
+            if result is None:
+                result = master.models.Result._from_son(data)
+            key = processor.ordering_key(result)
+            if key is not None:
+                return (processor.__class__.__name__, key)
+        return id_
+
     def insert(self, id_, obj):
         self._log.debug("handling insert")
 
@@ -63,32 +114,95 @@ class ResultWatcher(WatcherBase):
         result.tags = result.job.tags
         # save the _real_ current time so it's not dependent on the VM's time
         result.created = datetime.datetime.utcnow()
+        # nothing watches result updates, an expected echo would never be
+        # seen (see WatcherBase._save)
         result.save()
+        self._aggregates.add_result(result.job.id, result.id, result.type, result.created)
 
-        for processor in self._processors:
-            self._log.debug("seeing if processor can handle this: {}".format(processor))
-            try:
-                can_process = processor.can_process(result)
-            except NotImplemented as e:
-                self._log.error(
-                    "Result processor class '{}' does not implement the can_process function!".format(
-                        processor.__class__.__name__
+        for processor in self._routes.get(result.type, self._fallback):
+            name = processor.__class__.__name__
+            if processor.result_types is None:
+                self._log.debug("seeing if processor can handle this: {}".format(processor))
+                self._count(name, "asked")
+                try:
+                    can_process = processor.can_process(result)
+                except NotImplementedError as e:
+                    self._log.error(
+                        "Result processor class '{}' does not implement the can_process function!".format(
+                            processor.__class__.__name__
+                        )
                     )
-                )
-                continue
+                    continue
+                if not can_process:
+                    continue
 
-            if can_process:
+            limit = self._limits.get(name, None)
+            if limit is not None and not limit.acquire(False):
+                self._count(name, "throttled")
+                limit.acquire()
+
+            start = time.time()
+            try:
                 processor.process(result)
+            except Exception:
+                self._count(name, "errors")
+                raise
+            finally:
+                self._timings[name].add(time.time() - start)
+                if limit is not None:
+                    limit.release()
+            self._count(name, "processed")
 
-                try:
-                    result.reload()
-                except Exception as e:
-                    # self._log.info("error reloading result document, probably deleted?? TODO verify this is OK", exc_info=True)
-                    # if it's been deleted, then just return, as no other processors should be able to process it
-                    return
+            try:
+                result.reload()
+            except master.models.Result.DoesNotExist:
+                # if it's been deleted, then just return, as no other processors should be able to process it
+                self._aggregates.remove_result(result.job.id, result.type)
+                return
+
+    def stats(self):
+        """Return the number of results every processor handled, and how
+        long it took
+        """
+        res = []
+        for processor in self._processors:
+            name = processor.__class__.__name__
+            with self._counts_lock:
+                counts = dict(self._counts[name])
+            res.append(dict(
+                name        = name,
+                types       = processor.result_types,
+                concurrency = processor.max_concurrency,
+                counts      = counts,
+                time        = self._timings[name].stats(),
+            ))
+        return res
 
     def update(self, id, mod):
         pass
 
     def delete(self, id):
         pass
+
+    # -----------------------
+
+    def _build_routes(self):
+        """Index the processors by the result types they handle. Processors
+        without ``result_types`` are asked about results of every type.
+        """
+        # processors are still run in the order they were loaded
+        # { <result type>: [<processor>, ...], ... }
+        self._routes = {}
+        self._fallback = [p for p in self._processors if p.result_types is None]
+        types = set()
+        for processor in self._processors:
+            types.update(processor.result_types or [])
+        for type_ in types:
+            self._routes[type_] = [
+                p for p in self._processors
+                if p.result_types is None or type_ in p.result_types
+            ]
+
+    def _count(self, name, what):
+        with self._counts_lock:
+            self._counts[name][what] += 1
@@ -11,6 +11,17 @@ class ResultProcessorBase(object):
     """A result processor. Each defined result processor will
     be asked if it can process new results"""
 
+    result_types = None
+    """The types of the results this processor handles, e.g. ``["crash"]``.
+    Results of these types are routed straight to :any:`process`. If None,
+    :any:`can_process` is asked about every result instead.
+    """
+
+    max_concurrency = None
+    """The most results this processor processes at once. If None, up to
+    as many as the result watcher has workers.
+    """
+
     def __init__(self):
         """Init the result processor base
         """
@@ -23,7 +34,7 @@ class ResultProcessorBase(object):
 
         :param mongoengine.Document result: The result to process
         """
-        raise NotImplemented("Inheriting classes must implement the process function")
+        raise NotImplementedError("Inheriting classes must implement the process function")
 
     def can_process(self, result):
         """A query function to determine if this result processor can process
@@ -31,4 +42,13 @@ class ResultProcessorBase(object):
 
         :returns: True/False
         """
-        raise NotImplemented("Inheriting classes must implement the can_process function")
+        raise NotImplementedError("Inheriting classes must implement the can_process function")
+
+    def ordering_key(self, result):
+        """Results with the same ordering key are processed one at a time,
+        in the order they were inserted.
+
+        :param mongoengine.Document result: The new result, as it was inserted
+        :returns: The key, or None if the order doesn't matter
+        """
+        return None
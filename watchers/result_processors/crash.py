@@ -25,12 +25,19 @@ class CrashProcessor(processors.ResultProcessorBase):
     """A simple crash processor
     """
 
+    result_types = ["crash"]
+
     def can_process(self, result):
         """Return True/False if the result is a crash result
         """
-        self._log.info("result type: {!r}".format(result.type))
         return result.type == "crash"
 
+    def ordering_key(self, result):
+        """Crashes with the same hashes are processed in order, so that only
+        the first one creates a crash task
+        """
+        return (result.data.get("hash_major", None), result.data.get("hash_minor", None))
+
     def delete_result(self, result):
         """Completely Delete a result
         """
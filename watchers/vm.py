@@ -12,6 +12,7 @@ import uuid
 
 
 import master.models
+import master.lib.transitions as transitions
 from master.lib.vm.manage import VMManager
 from master.watchers import WatcherBase
 
@@ -20,12 +21,22 @@ logging.getLogger("sh").setLevel(logging.WARN)
 
 class VMWatcher(WatcherBase):
     collection = "talus.image"
+    # the current image status is always looked up before it's handled
+    overflow = "coalesce"
+    coalesce_window = 0.5
+    subscriptions = {
+        "insert": None,
+        "update": ["status"],
+    }
 
     def __init__(self, *args, **kwargs):
         WatcherBase.__init__(self, *args, **kwargs)
 
         self._vm_manager = master.lib.vm.manage.VMManager(on_worker_exited=self._on_worker_exited)
 
+    def catch_up(self):
+        """Handle images that were left in a transitional state
+        """
         for img in master.models.Image.objects(status__name__in=["import", "configure", "create", "delete"]):
             self._handle_status(img.id, image=img)
 
@@ -93,10 +104,9 @@ class VMWatcher(WatcherBase):
                 image.name,
             ))
             iso_file.delete()
-            image.status = {
+            self._set_status(image, {
                 "name": "iso-create error",
-            }
-            image.save()
+            })
             return
 
         vnc_info = self._vm_manager.create_from_iso(
@@ -115,11 +125,10 @@ class VMWatcher(WatcherBase):
             os.remove(iso_file.path)
         iso_file.delete()
 
-        image.status = {
+        self._set_status(image, {
             "name": "configuring",
             "vnc": vnc_info,
-        }
-        image.save()
+        })
 
         self._log.info("new VM is starting up with iso {!r}, ready for initial configuration\n    {!r}".format(
             os.path.basename(iso_path),
@@ -146,10 +155,9 @@ class VMWatcher(WatcherBase):
                 tmp_file.path
             ))
             tmp_file.delete()
-            image.status = {
+            self._set_status(image, {
                 "name": "import_error"
-            }
-            image.save()
+            })
             return
 
         vnc_info = self._vm_manager.import_image(
@@ -168,11 +176,10 @@ class VMWatcher(WatcherBase):
             os.remove(tmp_file.path)
         tmp_file.delete()
 
-        image.status = {
+        self._set_status(image, {
             "name": "configuring",
             "vnc": vnc_info
-        }
-        image.save()
+        })
 
         self._log.info("image is imported and running, ready for initial configuration:\n\t{!r}".format(vnc_info))
 
@@ -185,7 +192,7 @@ class VMWatcher(WatcherBase):
             self._log.warn("ERROR! ILLEGAL OPERATION! I WILL NOT MODIFY AN IMAGE WITH {} DEPENDENT SNAPSHOTS!".format(
                 len(child_snapshots)
             ))
-            image.status = {"name": "ready"}
+            self._set_status(image, {"name": "ready"})
             return
 
         vagrantfile = image.status.setdefault("vagrantfile", None)
@@ -203,13 +210,11 @@ class VMWatcher(WatcherBase):
         from master import Master
         Master.instance().update_status(vms=self._get_running_vms())
 
-        image = master.models.Image.objects(id=image.id)[0]
         if user_interaction:
-            image.status = {
+            self._set_status(image, {
                 "name": "configuring",
                 "vnc": vnc_info
-            }
-            image.save()
+            })
 
     def _handle_create(self, id_, image):
         """Handle creating a new VM based on an existing VM
@@ -232,24 +237,21 @@ class VMWatcher(WatcherBase):
         from master import Master
         Master.instance().update_status(vms=self._get_running_vms())
 
-        image = master.models.Image.objects(id=image.id)[0]
         if user_interaction:
-            image.status = {
+            self._set_status(image, {
                 "name": "configuring",
                 "vnc": vnc_info
-            }
-            image.save()
+            })
 
     def _handle_delete(self, id_, image):
         """Handle deleting an image from the DB and on disk"""
         child_images = master.models.Image.objects(base_image=image.id)
 
         if len(child_images) > 0:
-            image.status = {
+            self._set_status(image, {
                 "name": "ready",
                 "error": "image has child images, can't delete"
-            }
-            image.save()
+            })
         else:
             self._vm_manager.delete_image(str(image.id))
             image.delete()
@@ -273,7 +275,6 @@ class VMWatcher(WatcherBase):
         self._log.debug("images: {} ({!r})".format(images, image_name))
         image = images[0]
         self._log.debug("image: {}".format(image))
-        image.status = {"name": "ready"}
 
         path = "/var/lib/libvirt/images/{}_vagrant_box_image_0.img".format(str(image.id))
         if not os.path.exists(path):
@@ -296,8 +297,20 @@ class VMWatcher(WatcherBase):
         md5, _ = md5sum(path).split()
 
         self._log.info("new md5: {}".format(md5))
-        image.md5 = md5
-        image.timestamps["modified"] = time.time()
-        image.save()
+        changed = self._set_status(image, {"name": "ready"}, fields={
+            "md5": md5,
+            "timestamps.modified": time.time(),
+        })
+        if not changed:
+            return
 
         self._log.info("updated md5 for image {!r}".format(image_name))
+
+    def _set_status(self, image, status, fields=None):
+        """Change the status of the image (and any other ``fields``), if its
+        status in the database still allows it (see
+        :any:`master.lib.transitions`)
+
+        :returns: True if the status was changed
+        """
+        return transitions.images.transition(image, status["name"], status=status, fields=fields)
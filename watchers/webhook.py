@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+
+"""
+This module keeps the in-memory webhook registry in sync with the Webhook
+documents in the MongoDB database.
+"""
+
+
+import master.models
+from master.lib.webhook_registry import Hook, WebhookRegistry
+from master.watchers import WatcherBase
+
+
+class WebhookWatcher(WatcherBase):
+    """The watcher for the ``talus.webhook`` collection in the database.
+    """
+
+    collection = "talus.webhook"
+    # webhooks hardly ever change
+    dispatch_workers = 1
+
+    def __init__(self, *args, **kwargs):
+        WatcherBase.__init__(self, *args, **kwargs)
+
+        self._registry = WebhookRegistry.instance()
+
+    def catch_up(self):
+        """Load the webhooks that changed while the master wasn't running
+        """
+        self._registry.load()
+
+    def insert(self, id_, obj):
+        self._log.debug("handling insert")
+
+        self._registry.put(Hook.from_doc(obj))
+
+    def update(self, id_, mod):
+        self._log.debug("handling update")
+
+        # updates may only set some of the fields
+        webhook = master.models.Webhook.objects(id=id_).first()
+        if webhook is None:
+            self._registry.remove(id_)
+        else:
+            self._registry.put(Hook.from_doc(webhook))
+
+    def delete(self, id_):
+        self._log.debug("handling delete")
+
+        self._registry.remove(id_)